@@ -0,0 +1,182 @@
+#ifndef antsRegistrationControl_h
+#define antsRegistrationControl_h
+
+#include <algorithm>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <fstream>
+#include <iostream>
+#include <string>
+#include <vector>
+
+#include "itkImage.h"
+#include "itkImageFileWriter.h"
+#include "itkImageIOFactory.h"
+#include "itkTransformFileWriter.h"
+#include "itkTransformToDisplacementFieldFilter.h"
+#include "itkVector.h"
+
+namespace ants
+{
+// Stop requests written by the antsRegistration Slicer module to the file set in the
+// ANTS_REGISTRATION_CONTROL_FILE environment variable while a registration runs.
+// "level" stops the current level and is consumed, "run" stops every remaining level.
+enum RegistrationControlRequest
+{
+  NoControlRequest,
+  StopLevelRequest,
+  StopRunRequest
+};
+
+inline RegistrationControlRequest ReadRegistrationControlRequest()
+{
+  const char * controlFile = std::getenv("ANTS_REGISTRATION_CONTROL_FILE");
+  if (controlFile == nullptr || controlFile[0] == '\0')
+  {
+    return NoControlRequest;
+  }
+  std::string request;
+  {
+    std::ifstream control(controlFile);
+    if (!(control >> request))
+    {
+      return NoControlRequest;
+    }
+  }
+  if (request == "run")
+  {
+    return StopRunRequest;
+  }
+  if (request == "level")
+  {
+    std::ofstream(controlFile, std::ios::trunc);
+    return StopLevelRequest;
+  }
+  return NoControlRequest;
+}
+
+// Transform files antsRegistration should not write, set by antsRegistrationCLI in the
+// ANTS_SKIP_OUTPUT_FILES environment variable as a list of paths separated by "|".
+inline bool IsRegistrationOutputSkipped(const std::string & fileName)
+{
+  const char * skippedFiles = std::getenv("ANTS_SKIP_OUTPUT_FILES");
+  if (skippedFiles == nullptr)
+  {
+    return false;
+  }
+  const std::string files = std::string("|") + skippedFiles + "|";
+  return files.find("|" + fileName + "|") != std::string::npos;
+}
+
+// Compression of the written images, disabled by antsRegistrationCLI with ANTS_WRITE_COMPRESSION=0
+// (uncompressed I/O profiles), as patched in ReadWriteData.h for the other outputs.
+inline bool IsWriteCompressionEnabled()
+{
+  const char * compression = std::getenv("ANTS_WRITE_COMPRESSION");
+  return compression == nullptr || compression[0] != '0';
+}
+
+// Displacement field of the registration result sampled on the grid of a reference volume, computed from
+// the composite transform in memory as antsApplyTransforms does for a [field,1] output. Written to the file
+// set by antsRegistrationCLI in ANTS_DISPLACEMENT_FIELD_FILE, on the grid of the volume file set in
+// ANTS_DISPLACEMENT_FIELD_REFERENCE, of which only the header is read.
+template <typename TCompositeTransform>
+void WriteRegistrationDisplacementField(const TCompositeTransform * compositeTransform)
+{
+  const char * fieldFile = std::getenv("ANTS_DISPLACEMENT_FIELD_FILE");
+  const char * referenceFile = std::getenv("ANTS_DISPLACEMENT_FIELD_REFERENCE");
+  if (fieldFile == nullptr || fieldFile[0] == '\0' || referenceFile == nullptr || referenceFile[0] == '\0')
+  {
+    return;
+  }
+  constexpr unsigned int Dimension = TCompositeTransform::InputSpaceDimension;
+  using ScalarType = typename TCompositeTransform::ScalarType;
+  using FieldType = itk::Image<itk::Vector<ScalarType, Dimension>, Dimension>;
+  using FilterType = itk::TransformToDisplacementFieldFilter<FieldType, ScalarType>;
+
+  std::cout << "<filter-comment>" << "Displacement Field " << "</filter-comment>" << std::endl << std::flush;
+  const auto startTime = std::chrono::steady_clock::now();
+  try
+  {
+    itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(referenceFile, itk::IOFileModeEnum::ReadMode);
+    if (!imageIO)
+    {
+      std::cerr << "ERROR: unable to read " << referenceFile << std::endl;
+      return;
+    }
+    imageIO->SetFileName(referenceFile);
+    imageIO->ReadImageInformation();
+    typename FieldType::SizeType size;
+    typename FieldType::SpacingType spacing;
+    typename FieldType::PointType origin;
+    typename FieldType::DirectionType direction;
+    direction.SetIdentity();
+    size.Fill(1);
+    spacing.Fill(1.0);
+    origin.Fill(0.0);
+    for (unsigned int i = 0; i < std::min(Dimension, imageIO->GetNumberOfDimensions()); ++i)
+    {
+      size[i] = imageIO->GetDimensions(i);
+      spacing[i] = imageIO->GetSpacing(i);
+      origin[i] = imageIO->GetOrigin(i);
+      const std::vector<double> axis = imageIO->GetDirection(i);
+      for (unsigned int j = 0; j < std::min(Dimension, static_cast<unsigned int>(axis.size())); ++j)
+      {
+        direction[j][i] = axis[j];
+      }
+    }
+
+    auto filter = FilterType::New();
+    filter->SetTransform(compositeTransform);
+    filter->UseReferenceImageOff();
+    filter->SetSize(size);
+    filter->SetOutputSpacing(spacing);
+    filter->SetOutputOrigin(origin);
+    filter->SetOutputDirection(direction);
+
+    auto writer = itk::ImageFileWriter<FieldType>::New();
+    writer->SetInput(filter->GetOutput());
+    writer->SetFileName(fieldFile);
+    writer->SetUseCompression(IsWriteCompressionEnabled());
+    writer->Update();
+  }
+  catch (const itk::ExceptionObject & e)
+  {
+    std::cerr << "ERROR: unable to write the displacement field " << fieldFile << ": " << e.what() << std::endl;
+    return;
+  }
+  std::cout << "Elapsed time (displacement field): "
+            << std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime).count() << std::endl;
+}
+
+// Checkpoint of the composite transform once numberOfStages stages completed, written as
+// stage<numberOfStages>.h5 to the directory set by antsRegistrationCLI in the
+// ANTS_STAGE_CHECKPOINT_DIRECTORY environment variable. The file only appears once complete.
+template <typename TCompositeTransform>
+void WriteRegistrationCheckpoint(const TCompositeTransform * compositeTransform, unsigned int numberOfStages)
+{
+  const char * checkpointDirectory = std::getenv("ANTS_STAGE_CHECKPOINT_DIRECTORY");
+  if (checkpointDirectory == nullptr || checkpointDirectory[0] == '\0' || numberOfStages == 0)
+  {
+    return;
+  }
+  const std::string fileName = std::string(checkpointDirectory) + "/stage" + std::to_string(numberOfStages);
+  using WriterType = itk::TransformFileWriterTemplate<typename TCompositeTransform::ScalarType>;
+  auto writer = WriterType::New();
+  writer->SetInput(compositeTransform);
+  writer->SetFileName(fileName + ".partial.h5");
+  try
+  {
+    writer->Update();
+  }
+  catch (const itk::ExceptionObject & e)
+  {
+    std::cerr << "Unable to write the stage checkpoint " << fileName << ".h5: " << e.what() << std::endl;
+    return;
+  }
+  std::rename((fileName + ".partial.h5").c_str(), (fileName + ".h5").c_str());
+}
+} // namespace ants
+
+#endif
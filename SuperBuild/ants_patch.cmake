@@ -118,4 +118,144 @@ string(REPLACE
 file(WRITE ${cmakefile} "${cmakefile_src}")
 else()
 message(STATUS "ants: Filter log already patched ${cmakefile}")
-endif()
\ No newline at end of file
+endif()
+#-----------------------------------
+# Early termination requested through a control file
+
+file(COPY ${CMAKE_CURRENT_LIST_DIR}/antsRegistrationControl.h DESTINATION ${ants_SRC_DIR}/Examples/)
+
+set(cmakefile ${ants_SRC_DIR}/Examples/antsDisplacementAndVelocityFieldRegistrationCommandIterationUpdate.h)
+file(READ ${cmakefile} cmakefile_src)
+string(FIND "${cmakefile_src}" "ReadRegistrationControlRequest" found_patched)
+if ("${found_patched}" LESS 0)
+message(STATUS "ants: Patching filter control ${cmakefile}")
+string(REPLACE
+    "this->Logger() << \"1DIAGNOSTIC, \""
+    "if (ReadRegistrationControlRequest() != NoControlRequest){TFilter * controlledFilter = const_cast<TFilter *>(dynamic_cast<const TFilter *>(object)); auto iterations = controlledFilter->GetNumberOfIterationsPerLevel(); iterations[controlledFilter->GetCurrentLevel()] = lCurrentIteration; controlledFilter->SetNumberOfIterationsPerLevel(iterations);}\nthis->Logger() << \"1DIAGNOSTIC, \""
+    cmakefile_src "${cmakefile_src}")
+string(FIND "${cmakefile_src}" "ReadRegistrationControlRequest" found_patched)
+if ("${found_patched}" LESS 0)
+message(WARNING "ants: Unable to patch filter control ${cmakefile}, early termination requests will not stop deformable stages")
+endif()
+string(FIND "${cmakefile_src}" "#include \"antsRegistrationControl.h\"" found_include)
+if ("${found_include}" LESS 0)
+set(cmakefile_src "#include \"antsRegistrationControl.h\"\n${cmakefile_src}")
+endif()
+file(WRITE ${cmakefile} "${cmakefile_src}")
+else()
+message(STATUS "ants: Filter control already patched ${cmakefile}")
+endif()
+
+set(cmakefile ${ants_SRC_DIR}/Examples/antsRegistrationOptimizerCommandIterationUpdate.h)
+file(READ ${cmakefile} cmakefile_src)
+string(FIND "${cmakefile_src}" "ReadRegistrationControlRequest" found_patched)
+if ("${found_patched}" LESS 0)
+message(STATUS "ants: Patching optimizer control ${cmakefile}")
+string(REPLACE
+    "this->Logger() << \"2DIAGNOSTIC, \""
+    "if (ReadRegistrationControlRequest() != NoControlRequest){this->m_Optimizer->StopOptimization();}\nthis->Logger() << \"2DIAGNOSTIC, \""
+    cmakefile_src "${cmakefile_src}")
+string(FIND "${cmakefile_src}" "ReadRegistrationControlRequest" found_patched)
+if ("${found_patched}" LESS 0)
+message(WARNING "ants: Unable to patch optimizer control ${cmakefile}, early termination requests will not stop linear stages")
+endif()
+string(FIND "${cmakefile_src}" "#include \"antsRegistrationControl.h\"" found_include)
+if ("${found_include}" LESS 0)
+set(cmakefile_src "#include \"antsRegistrationControl.h\"\n${cmakefile_src}")
+endif()
+file(WRITE ${cmakefile} "${cmakefile_src}")
+else()
+message(STATUS "ants: Optimizer control already patched ${cmakefile}")
+endif()
+
+#-----------------------------------
+# Output compression selected by antsRegistrationCLI
+
+set(cmakefile ${ants_SRC_DIR}/Utilities/ReadWriteData.h)
+file(READ ${cmakefile} cmakefile_src)
+string(FIND "${cmakefile_src}" "ANTS_WRITE_COMPRESSION" found_patched)
+if ("${found_patched}" LESS 0)
+message(STATUS "ants: Patching write compression ${cmakefile}")
+string(REPLACE
+    "writer->SetUseCompression(true);"
+    "writer->SetUseCompression(std::getenv(\"ANTS_WRITE_COMPRESSION\") == nullptr || std::getenv(\"ANTS_WRITE_COMPRESSION\")[0] != '0');"
+    cmakefile_src "${cmakefile_src}")
+file(WRITE ${cmakefile} "${cmakefile_src}")
+else()
+message(STATUS "ants: Write compression already patched ${cmakefile}")
+endif()
+
+#-----------------------------------
+# Transform outputs not requested by antsRegistrationCLI are not written
+
+set(cmakefile ${ants_SRC_DIR}/Examples/antsRegistrationTemplateHeader.h)
+file(READ ${cmakefile} cmakefile_src)
+string(FIND "${cmakefile_src}" "IsRegistrationOutputSkipped" found_patched)
+if ("${found_patched}" LESS 0)
+message(STATUS "ants: Patching skipped outputs ${cmakefile}")
+string(REGEX REPLACE
+    "(itk::ants::WriteTransform<T, VImageDimension>\\([ \t\n]*compositeTransform,[ \t\n]*compositeTransformFileName\\.c_str\\(\\)\\);)"
+    "if (!IsRegistrationOutputSkipped(compositeTransformFileName)){\\1}"
+    cmakefile_src "${cmakefile_src}")
+string(REGEX REPLACE
+    "if[ ]*\\([ ]*inverseCompositeTransform\\.IsNotNull\\(\\)[ ]*\\)"
+    "if (inverseCompositeTransform.IsNotNull() && !IsRegistrationOutputSkipped(inverseCompositeTransformFileName))"
+    cmakefile_src "${cmakefile_src}")
+string(FIND "${cmakefile_src}" "IsRegistrationOutputSkipped" found_patched)
+if ("${found_patched}" LESS 0)
+message(WARNING "ants: Unable to patch skipped outputs ${cmakefile}, all transform files will be written")
+endif()
+string(FIND "${cmakefile_src}" "#include \"antsRegistrationControl.h\"" found_include)
+if ("${found_include}" LESS 0)
+set(cmakefile_src "#include \"antsRegistrationControl.h\"\n${cmakefile_src}")
+endif()
+file(WRITE ${cmakefile} "${cmakefile_src}")
+else()
+message(STATUS "ants: Skipped outputs already patched ${cmakefile}")
+endif()
+
+#-----------------------------------
+# Composite transform checkpoint written at the start of every stage but the first
+
+set(cmakefile ${ants_SRC_DIR}/Examples/itkantsRegistrationHelper.hxx)
+file(READ ${cmakefile} cmakefile_src)
+string(FIND "${cmakefile_src}" "WriteRegistrationCheckpoint" found_patched)
+if ("${found_patched}" LESS 0)
+message(STATUS "ants: Patching stage checkpoints ${cmakefile}")
+string(REPLACE
+    "this->Logger() << std::endl << \"Stage \""
+    "::ants::WriteRegistrationCheckpoint(this->m_CompositeTransform.GetPointer(), currentStageNumber);\nthis->Logger() << std::endl << \"Stage \""
+    cmakefile_src "${cmakefile_src}")
+string(FIND "${cmakefile_src}" "WriteRegistrationCheckpoint" found_patched)
+if ("${found_patched}" LESS 0)
+message(WARNING "ants: Unable to patch stage checkpoints ${cmakefile}, no checkpoint will be written")
+endif()
+string(FIND "${cmakefile_src}" "#include \"antsRegistrationControl.h\"" found_include)
+if ("${found_include}" LESS 0)
+set(cmakefile_src "#include \"antsRegistrationControl.h\"\n${cmakefile_src}")
+endif()
+file(WRITE ${cmakefile} "${cmakefile_src}")
+else()
+message(STATUS "ants: Stage checkpoints already patched ${cmakefile}")
+endif()
+
+#-----------------------------------
+# Displacement field output computed from the composite transform in memory
+
+set(cmakefile ${ants_SRC_DIR}/Examples/antsRegistrationTemplateHeader.h)
+file(READ ${cmakefile} cmakefile_src)
+string(FIND "${cmakefile_src}" "WriteRegistrationDisplacementField" found_patched)
+if ("${found_patched}" LESS 0)
+message(STATUS "ants: Patching displacement field output ${cmakefile}")
+string(REPLACE
+    "if (!IsRegistrationOutputSkipped(compositeTransformFileName)){"
+    "::ants::WriteRegistrationDisplacementField(compositeTransform.GetPointer());\nif (!IsRegistrationOutputSkipped(compositeTransformFileName)){"
+    cmakefile_src "${cmakefile_src}")
+string(FIND "${cmakefile_src}" "WriteRegistrationDisplacementField" found_patched)
+if ("${found_patched}" LESS 0)
+message(WARNING "ants: Unable to patch displacement field output ${cmakefile}, use displacementFieldMethod=applyTransforms")
+endif()
+file(WRITE ${cmakefile} "${cmakefile_src}")
+else()
+message(STATUS "ants: Displacement field output already patched ${cmakefile}")
+endif()
@@ -0,0 +1,98 @@
+"""
+Benchmark the registration presets on the MRBrainTumor1/2 pair bundled with antsRegistrationCLI.
+
+Usage:
+  Slicer --no-main-window --python-script antsRegistrationBenchmark.py --output results.json [--baseline baseline.json]
+         [--update-baseline] [--presets Rigid QuickSyN] [--precisions float double] [--threads N] [--calibrate]
+  Slicer --no-main-window --python-script antsRegistrationBenchmark.py --output results.json --io [--io-directory /mnt/storage]
+  Slicer --no-main-window --python-script antsRegistrationBenchmark.py --output results.json --displacement-field [--threads 1]
+
+Exits with a non zero code when a result regresses against the baseline. With --calibrate, the runtime and
+memory estimates shown before running a registration are fitted to the results.
+"""
+
+import os
+import sys
+import argparse
+
+import slicer
+
+from antsRegistrationLib.costmodel import RegistrationCostModel
+from antsRegistrationLib.benchmark import PresetBenchmark, IOProfileBenchmark, DisplacementFieldBenchmark, compareToBaseline, readResults, writeResults
+
+
+def main(argv):
+  sourceDirectory = os.path.dirname(os.path.abspath(__file__))
+  dataDirectory = os.path.join(sourceDirectory, '..', '..', '..', 'antsRegistrationCLI', 'Data', 'Input')
+
+  parser = argparse.ArgumentParser(description='Benchmark antsRegistration presets.')
+  parser.add_argument('--data-directory', default=dataDirectory)
+  parser.add_argument('--output', required=True, help='json file where results are written')
+  parser.add_argument('--baseline', default=os.path.join(sourceDirectory, 'Baseline', 'antsRegistrationBenchmark.json'))
+  parser.add_argument('--update-baseline', action='store_true', help='overwrite the baseline with the current results')
+  parser.add_argument('--presets', nargs='*', default=None)
+  parser.add_argument('--precisions', nargs='*', default=None)
+  parser.add_argument('--threads', type=int, default=0)
+  parser.add_argument('--time-tolerance', type=float, default=0.2)
+  parser.add_argument('--memory-tolerance', type=float, default=0.2)
+  parser.add_argument('--metric-tolerance', type=float, default=0.05)
+  parser.add_argument('--io', action='store_true', help='benchmark the intermediate file I/O profiles instead of the presets')
+  parser.add_argument('--io-directory', default=None, help='directory where the I/O profiles are benchmarked')
+  parser.add_argument('--io-profiles', nargs='*', default=None)
+  parser.add_argument('--calibrate', action='store_true', help='fit the cost model calibration to the preset results')
+  parser.add_argument('--displacement-field', action='store_true',
+                      help='compare the direct displacement field output with the antsApplyTransforms pass')
+  args = parser.parse_args(argv)
+
+  if args.displacement_field:
+    results = DisplacementFieldBenchmark(os.path.join(args.data_directory, 'MRBrainTumor1.nii.gz'),
+                                         os.path.join(args.data_directory, 'MRBrainTumor2.nii.gz'),
+                                         presetName=args.presets[0] if args.presets else 'QuickSyN',
+                                         numberOfThreads=args.threads).run()
+    writeResults(results, args.output)
+    for result in results['fieldResults']:
+      print('%-15s %-10s field %8ss total %8.1fs' % (result['method'], result['status'], result['displacementFieldTime'], result['wallTime']))
+    print('Maximum difference between fields: %s' % results['maximumDifference'])
+    return 0
+
+  if args.io:
+    results = IOProfileBenchmark(os.path.join(args.data_directory, 'MRBrainTumor1.nii.gz'), args.io_directory, args.io_profiles).run()
+    writeResults(results, args.output)
+    for result in results['ioResults']:
+      print('%-15s write %6.3fs read %6.3fs total %6.3fs %8.1fMB' % (result['profile'], result['writeTime'], result['readTime'],
+                                                                    result['totalTime'], result['fileSizeMB']))
+    return 0
+
+  benchmark = PresetBenchmark(os.path.join(args.data_directory, 'MRBrainTumor1.nii.gz'),
+                              os.path.join(args.data_directory, 'MRBrainTumor2.nii.gz'),
+                              presetNames=args.presets, precisions=args.precisions, numberOfThreads=args.threads)
+  results = benchmark.run()
+  writeResults(results, args.output)
+
+  for result in results['results']:
+    print('%-15s %-7s %-10s %8.1fs %8sMB metric %s' % (result['preset'], result['precision'], result['status'],
+                                                        result['wallTime'], result['peakMemoryMB'], result['finalMetricValue']))
+
+  if args.calibrate:
+    costModel = RegistrationCostModel()
+    costModel.calibrate(results)
+    costModel.save()
+    print('Cost model calibration: %s' % costModel.calibration)
+
+  regressions = []
+  if os.path.isfile(args.baseline) and not args.update_baseline:
+    regressions = compareToBaseline(results, readResults(args.baseline), args.time_tolerance,
+                                    args.memory_tolerance, args.metric_tolerance)
+    for regression in regressions:
+      print('REGRESSION: ' + regression)
+  else:
+    os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+    writeResults(results, args.baseline)
+    print('Baseline written to ' + args.baseline)
+
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  slicer.util.exit(exitCode)
@@ -5,6 +5,7 @@ from slicer.util import VTKObservationMixin
 
 import json
 import glob
+import time
 
 from antsRegistrationLib.Widgets.tables import StagesTable, MetricsTable, LevelsTable
 
@@ -86,9 +87,16 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     levelsTableLayout = qt.QVBoxLayout(self.ui.levelsFrame)
     levelsTableLayout.addWidget(self.ui.levelsTableWidget)
 
+    from antsRegistrationLib.Widgets.sweep import SweepPanel
+    self.ui.sweepCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.ui.sweepCollapsibleButton.text = 'Parameter Sweep'
+    self.ui.sweepCollapsibleButton.collapsed = True
+    self.ui.sweepPanel = SweepPanel(antsRegistrationLogic(), self.getSweepProcessParameters, self.saveStagesAsPreset)
+    qt.QVBoxLayout(self.ui.sweepCollapsibleButton).addWidget(self.ui.sweepPanel)
+    self.layout.addWidget(self.ui.sweepCollapsibleButton)
+
     self.ui.cliWidget = slicer.modules.antsregistrationcli.createNewWidgetRepresentation()
     self.layout.addWidget(self.ui.cliWidget.children()[3]) # progress bar
-    self._cliObserver = None
 
     # Set scene in MRML widgets. Make sure that in Qt designer the top-level qMRMLWidget's
     # "mrmlSceneChanged(vtkMRMLScene*)" signal in is connected to each MRML widget's.
@@ -99,6 +107,19 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # in batch mode, without a graphical user interface.
     self.logic = antsRegistrationLogic()
 
+    from antsRegistrationLib.jobs import JobQueue
+    from antsRegistrationLib.Widgets.jobs import JobQueuePanel
+    self.jobQueue = JobQueue(self.logic, onJobStarted=self.onJobStarted, onJobFinished=self.onJobFinished)
+    self.ui.jobsCollapsibleButton = ctk.ctkCollapsibleButton()
+    self.ui.jobsCollapsibleButton.text = 'Jobs'
+    self.ui.jobQueuePanel = JobQueuePanel(self.jobQueue)
+    qt.QVBoxLayout(self.ui.jobsCollapsibleButton).addWidget(self.ui.jobQueuePanel)
+    self.layout.addWidget(self.ui.jobsCollapsibleButton)
+
+    from antsRegistrationLib.Widgets.stagesmodel import StagesModel
+    self.stagesModel = StagesModel(self.logic.STAGES_JSON_PARAM)
+    self._shownStage = None
+
     self.ui.stagesPresetsComboBox.addItems(['Select...'] + PresetManager().getPresetNames())
     self.ui.openPresetsDirectoryButton.clicked.connect(self.onOpenPresetsDirectoryButtonClicked)
 
@@ -116,6 +137,9 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.outputInterpolationComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
     self.ui.outputTransformComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.outputVolumeComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    self.ui.outputInverseTransformComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    self.ui.outputInverseVolumeComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    self.ui.outputTelemetryTableComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.initialTransformTypeComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
     self.ui.initialTransformNodeComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
     self.ui.dimensionalitySpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
@@ -123,6 +147,11 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.outputDisplacementFieldCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     self.ui.winsorizeRangeWidget.connect("valuesChanged(double,double)", self.updateParameterNodeFromGUI)
     self.ui.computationPrecisionComboBox.connect("currentIndexChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.useCacheCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.useCheckpointsCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.quickLookCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+    self.ui.numberOfThreadsSpinBox.connect("valueChanged(int)", self.updateParameterNodeFromGUI)
+    self.ui.workingSpacingSpinBox.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
 
     self.ui.fixedImageNodeComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateStagesFromFixedMovingNodes)
     self.ui.movingImageNodeComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.updateStagesFromFixedMovingNodes)
@@ -149,6 +178,7 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # Buttons
     self.ui.stagesTableWidget.savePresetPushButton.connect('clicked(bool)', self.onSavePresetPushButton)
     self.ui.runRegistrationButton.connect('clicked(bool)', self.onRunRegistrationButton)
+    self.ui.purgeCacheButton.connect('clicked(bool)', self.onPurgeCacheButton)
 
     # Make sure parameter node is initialized (needed for module reload)
     self.initializeParameterNode()
@@ -161,7 +191,11 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     """
     Called when the application closes and the module widget is destroyed.
     """
+    self.stagesModel.flush()
     self.removeObservers()
+    self.jobQueue.cancelAll()
+    self.ui.jobQueuePanel.cleanup()
+    self.logic.cleanupStagedInputs()
 
   def enter(self):
     """
@@ -175,6 +209,7 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called each time the user opens a different module.
     """
     # Do not react to parameter node changes (GUI wlil be updated when the user enters into the module)
+    self.stagesModel.flush()
     self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
 
   def onSceneStartClose(self, caller, event):
@@ -215,6 +250,8 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # those are reflected immediately in the GUI.
     if self._parameterNode is not None:
       self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+    self.stagesModel.setParameterNode(inputParameterNode)
+    self._shownStage = None
     self._parameterNode = inputParameterNode
     if self._parameterNode is not None:
       self.addObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
@@ -249,6 +286,9 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self.ui.outputTransformComboBox.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.OUTPUT_TRANSFORM_REF))
     self.ui.outputVolumeComboBox.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.OUTPUT_VOLUME_REF))
+    self.ui.outputInverseTransformComboBox.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.OUTPUT_INVERSE_TRANSFORM_REF))
+    self.ui.outputInverseVolumeComboBox.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.OUTPUT_INVERSE_VOLUME_REF))
+    self.ui.outputTelemetryTableComboBox.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.OUTPUT_TELEMETRY_TABLE_REF))
     self.ui.outputInterpolationComboBox.currentText = self._parameterNode.GetParameter(self.logic.OUTPUT_INTERPOLATION_PARAM)
     self.ui.outputDisplacementFieldCheckBox.checked = int(self._parameterNode.GetParameter(self.logic.CREATE_DISPLACEMENT_FIELD_PARAM))
 
@@ -262,19 +302,37 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.ui.winsorizeRangeWidget.setMinimumValue(float(winsorizeIntensities[0]))
     self.ui.winsorizeRangeWidget.setMaximumValue(float(winsorizeIntensities[1]))
     self.ui.computationPrecisionComboBox.currentText = self._parameterNode.GetParameter(self.logic.COMPUTATION_PRECISION_PARAM)
+    self.ui.useCacheCheckBox.checked = int(self._parameterNode.GetParameter(self.logic.USE_CACHE_PARAM))
+    self.ui.useCheckpointsCheckBox.checked = int(self._parameterNode.GetParameter(self.logic.USE_CHECKPOINTS_PARAM))
+    self.ui.quickLookCheckBox.checked = int(self._parameterNode.GetParameter(self.logic.QUICK_LOOK_PARAM))
+    self.ui.numberOfThreadsSpinBox.value = int(self._parameterNode.GetParameter(self.logic.NUMBER_OF_THREADS_PARAM))
+    self.ui.workingSpacingSpinBox.value = float(self._parameterNode.GetParameter(self.logic.WORKING_SPACING_PARAM))
+    self.ui.workingSpacingSavingsLabel.text = self.logic.getWorkingSpacingSavingsText(
+      self.ui.fixedImageNodeComboBox.currentNode(), self.ui.movingImageNodeComboBox.currentNode(), self.ui.workingSpacingSpinBox.value)
+    self.ui.costEstimateLabel.text = self.logic.getCostEstimateText(
+      self.stagesModel.read(), self.ui.fixedImageNodeComboBox.currentNode(), self.ui.movingImageNodeComboBox.currentNode(),
+      {'computationPrecision': self.ui.computationPrecisionComboBox.currentText, 'numberOfThreads': self.ui.numberOfThreadsSpinBox.value},
+      self.ui.workingSpacingSpinBox.value)
 
     self.ui.runRegistrationButton.enabled = self.ui.fixedImageNodeComboBox.currentNodeID and self.ui.movingImageNodeComboBox.currentNodeID and\
-                                            (self.ui.outputTransformComboBox.currentNodeID or self.ui.outputVolumeComboBox.currentNodeID)
+                                            (self.ui.outputTransformComboBox.currentNodeID or self.ui.outputVolumeComboBox.currentNodeID or
+                                             self.ui.outputInverseTransformComboBox.currentNodeID or self.ui.outputInverseVolumeComboBox.currentNodeID)
 
     # All the GUI updates are done
     self._updatingGUIFromParameterNode = False
 
   def updateStagesGUIFromParameter(self):
-    stagesList = json.loads(self._parameterNode.GetParameter(self.logic.STAGES_JSON_PARAM))
-    self.ui.fixedImageNodeComboBox.setCurrentNodeID(stagesList[0]['metrics'][0]['fixed'])
-    self.ui.movingImageNodeComboBox.setCurrentNodeID(stagesList[0]['metrics'][0]['moving'])
-    self.setTransformsGUIFromList(stagesList)
-    self.setCurrentStagePropertiesGUIFromList(stagesList)
+    # the GUI already shows the stages edited in it, only refresh for other modifications
+    modifiedOutside = self.stagesModel.isModifiedOutside()
+    stagesList = self.stagesModel.read()
+    currentStage = int(self._parameterNode.GetParameter(self.logic.CURRENT_STAGE_PARAM))
+    if modifiedOutside:
+      self.ui.fixedImageNodeComboBox.setCurrentNodeID(stagesList[0]['metrics'][0]['fixed'])
+      self.ui.movingImageNodeComboBox.setCurrentNodeID(stagesList[0]['metrics'][0]['moving'])
+      self.setTransformsGUIFromList(stagesList)
+    if modifiedOutside or currentStage != self._shownStage:
+      self.setCurrentStagePropertiesGUIFromList(stagesList)
+      self._shownStage = currentStage
 
   def setTransformsGUIFromList(self, stagesList):
     transformsParameters = [stage['transformParameters'] for stage in stagesList]
@@ -303,6 +361,9 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     self._parameterNode.SetNodeReferenceID(self.logic.OUTPUT_TRANSFORM_REF, self.ui.outputTransformComboBox.currentNodeID)
     self._parameterNode.SetNodeReferenceID(self.logic.OUTPUT_VOLUME_REF, self.ui.outputVolumeComboBox.currentNodeID)
+    self._parameterNode.SetNodeReferenceID(self.logic.OUTPUT_INVERSE_TRANSFORM_REF, self.ui.outputInverseTransformComboBox.currentNodeID)
+    self._parameterNode.SetNodeReferenceID(self.logic.OUTPUT_INVERSE_VOLUME_REF, self.ui.outputInverseVolumeComboBox.currentNodeID)
+    self._parameterNode.SetNodeReferenceID(self.logic.OUTPUT_TELEMETRY_TABLE_REF, self.ui.outputTelemetryTableComboBox.currentNodeID)
     self._parameterNode.SetParameter(self.logic.OUTPUT_INTERPOLATION_PARAM, self.ui.outputInterpolationComboBox.currentText)
     self._parameterNode.SetParameter(self.logic.CREATE_DISPLACEMENT_FIELD_PARAM, str(int(self.ui.outputDisplacementFieldCheckBox.checked)))
 
@@ -314,6 +375,11 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self._parameterNode.SetParameter(self.logic.WINSORIZE_IMAGE_INTENSITIES_PARAM,
                                      ",".join([str(self.ui.winsorizeRangeWidget.minimumValue),str(self.ui.winsorizeRangeWidget.maximumValue)]))
     self._parameterNode.SetParameter(self.logic.COMPUTATION_PRECISION_PARAM,  self.ui.computationPrecisionComboBox.currentText)
+    self._parameterNode.SetParameter(self.logic.USE_CACHE_PARAM, str(int(self.ui.useCacheCheckBox.checked)))
+    self._parameterNode.SetParameter(self.logic.USE_CHECKPOINTS_PARAM, str(int(self.ui.useCheckpointsCheckBox.checked)))
+    self._parameterNode.SetParameter(self.logic.QUICK_LOOK_PARAM, str(int(self.ui.quickLookCheckBox.checked)))
+    self._parameterNode.SetParameter(self.logic.NUMBER_OF_THREADS_PARAM, str(self.ui.numberOfThreadsSpinBox.value))
+    self._parameterNode.SetParameter(self.logic.WORKING_SPACING_PARAM, str(self.ui.workingSpacingSpinBox.value))
 
     self._parameterNode.EndModify(wasModified)
 
@@ -321,19 +387,20 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
   def updateStagesFromFixedMovingNodes(self):
     if self._parameterNode is None or self._updatingGUIFromParameterNode:
       return
-    stagesList = json.loads(self._parameterNode.GetParameter(self.logic.STAGES_JSON_PARAM))
+    stagesList = self.stagesModel.read()
     for stage in stagesList:
       stage['metrics'][0]['fixed'] = self.ui.fixedImageNodeComboBox.currentNodeID
       stage['metrics'][0]['moving'] = self.ui.movingImageNodeComboBox.currentNodeID
-    self._parameterNode.SetParameter(self.logic.STAGES_JSON_PARAM, json.dumps(stagesList))
+    # the metrics table shows the new nodes once written
+    self.stagesModel.replace(stagesList)
 
   def updateStagesParameterFromGUI(self):
     if self._parameterNode is None or self._updatingGUIFromParameterNode:
       return
-    stagesList = json.loads(self._parameterNode.GetParameter(self.logic.STAGES_JSON_PARAM))
+    stagesList = self.stagesModel.read()
     self.setStagesTransformsToStagesList(stagesList)
     self.setCurrentStagePropertiesToStagesList(stagesList)
-    self._parameterNode.SetParameter(self.logic.STAGES_JSON_PARAM, json.dumps(stagesList))
+    self.stagesModel.modified()
 
   def setStagesTransformsToStagesList(self, stagesList):
     for stageNumber,transformParameters in enumerate(self.ui.stagesTableWidget.getParametersFromGUI()):
@@ -357,14 +424,14 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       stagesList[stageNumber]['masks'] = {'fixed': self.ui.fixedMaskComboBox.currentNodeID, 'moving': self.ui.movingMaskComboBox.currentNodeID}
 
   def onRemoveStageButtonClicked(self):
-    stagesList = json.loads(self._parameterNode.GetParameter(self.logic.STAGES_JSON_PARAM))
+    stagesList = self.stagesModel.read()
     if len(stagesList) == 1:
       return
     currentStage = int(self._parameterNode.GetParameter(self.logic.CURRENT_STAGE_PARAM))
     stagesList.pop(currentStage)
     wasModified = self._parameterNode.StartModify()  # Modify in a single batch
     self._parameterNode.SetParameter(self.logic.CURRENT_STAGE_PARAM, str(max(currentStage-1,0)))
-    self._parameterNode.SetParameter(self.logic.STAGES_JSON_PARAM, json.dumps(stagesList))
+    self.stagesModel.replace(stagesList)
     self._parameterNode.EndModify(wasModified)
 
   def onPresetSelected(self, presetName):
@@ -375,18 +442,21 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     for stage in presetParameters['stages']:
       stage['metrics'][0]['fixed'] = self.ui.fixedImageNodeComboBox.currentNodeID
       stage['metrics'][0]['moving'] = self.ui.movingImageNodeComboBox.currentNodeID
-    self._parameterNode.SetParameter(self.logic.STAGES_JSON_PARAM, json.dumps(presetParameters['stages']))
+    self.stagesModel.replace(presetParameters['stages'])
     self._parameterNode.SetParameter(self.logic.CURRENT_STAGE_PARAM, "0")
     self._parameterNode.EndModify(wasModified)
 
   def onSavePresetPushButton(self):
-    stages = json.loads(self._parameterNode.GetParameter(self.logic.STAGES_JSON_PARAM))
+    stages = json.loads(json.dumps(self.stagesModel.read()))
     for stage in stages:
       for metric in stage['metrics']:
         metric['fixed'] = None
         metric['moving'] = None
       stage['masks']['fixed'] = None
       stage['masks']['moving'] = None
+    self.saveStagesAsPreset(stages)
+
+  def saveStagesAsPreset(self, stages):
     savedPresetName = PresetManager().saveStagesAsPreset(stages)
     if savedPresetName:
       self._updatingGUIFromParameterNode = True
@@ -395,28 +465,46 @@ class antsRegistrationWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       self._updatingGUIFromParameterNode = False
 
   def onRunRegistrationButton(self):
-    if self.ui.runRegistrationButton.text == 'Cancel':
-      self.logic.cancelRegistration()
-      return
-
+    self.stagesModel.flush()
     parameters = self.logic.createProcessParameters(self._parameterNode)
-    self.logic.process(**parameters)
+    try:
+      if self.ui.quickLookCheckBox.checked:
+        self.logic.processQuickLook(jobQueue=self.jobQueue, onQuickLookFinished=self.onQuickLookFinished, **parameters)
+      else:
+        self.jobQueue.submit(parameters)
+    except ValueError as e:
+      slicer.util.errorDisplay(str(e))
+      return
+    self.ui.jobQueuePanel.updateJobs()
+
+  def onQuickLookFinished(self, job):
+    if job.status == job.COMPLETED:
+      slicer.util.showStatusMessage('Quick look done, continuing with the full schedule.', 3000)
+
+  def onJobStarted(self, job):
+    if job.resumedStageCount:
+      slicer.util.showStatusMessage('Resuming after %i checkpointed stages.' % job.resumedStageCount, 3000)
+    # the progress bar follows the last started job
+    self.ui.cliWidget.setCurrentCommandLineModuleNode(job.cliNode)
+    self.ui.jobQueuePanel.updateJobs()
+
+  def onJobFinished(self, job):
+    if job.fromCache:
+      slicer.util.showStatusMessage('Registration result loaded from cache.', 3000)
+    elif job.status == job.FAILED:
+      if job.cliNode is not None:
+        qt.QMessageBox().warning(qt.QWidget(),'Error', 'ANTs Failed. See CLI output.')
+      else:
+        slicer.util.errorDisplay(job.errorText)
+    self.ui.jobQueuePanel.updateJobs()
 
-    self.ui.cliWidget.setCurrentCommandLineModuleNode(self.logic.cliNode)
-    self._cliObserver = self.logic.cliNode.AddObserver('ModifiedEvent', self.onProcessingStatusUpdate)
-    self.ui.runRegistrationButton.text = 'Cancel'
+  def getSweepProcessParameters(self):
+    self.stagesModel.flush()
+    return self.logic.createProcessParameters(self._parameterNode)
 
-  def onProcessingStatusUpdate(self, caller, event):
-    if caller.GetStatus() & caller.Cancelled:
-      self.ui.runRegistrationButton.text = "Run Registration"
-      self.logic.cliNode.RemoveObserver(self._cliObserver)
-    elif caller.GetStatus() & caller.Completed:
-      if caller.GetStatus() & caller.ErrorsMask:
-        qt.QMessageBox().warning(qt.QWidget(),'Error', 'ANTs Failed. See CLI output.')
-      self.ui.runRegistrationButton.text = "Run Registration"
-      self.logic.cliNode.RemoveObserver(self._cliObserver)
-    else:
-      self.ui.runRegistrationButton.text = "Cancel"
+  def onPurgeCacheButton(self):
+    self.logic.purgeCache()
+    slicer.util.showStatusMessage('Registration cache and checkpoints purged.', 3000)
 
   def onOpenPresetsDirectoryButtonClicked(self):
     import platform, subprocess
@@ -445,6 +533,9 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
 
   OUTPUT_TRANSFORM_REF = "OutputTransform"
   OUTPUT_VOLUME_REF = "OutputVolume"
+  OUTPUT_INVERSE_TRANSFORM_REF = "OutputInverseTransform"
+  OUTPUT_INVERSE_VOLUME_REF = "OutputInverseVolume"
+  OUTPUT_TELEMETRY_TABLE_REF = "OutputTelemetryTable"
   INITIAL_TRANSFORM_REF = "InitialTransform"
   OUTPUT_INTERPOLATION_PARAM = "OutputInterpolation"
   STAGES_JSON_PARAM = "StagesJson"
@@ -455,6 +546,16 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
   HISTOGRAM_MATCHING_PARAM = "HistogramMatching"
   WINSORIZE_IMAGE_INTENSITIES_PARAM = "WinsorizeImageIntensities"
   COMPUTATION_PRECISION_PARAM = "ComputationPrecision"
+  USE_CACHE_PARAM = "UseCache"
+  USE_CHECKPOINTS_PARAM = "UseCheckpoints"
+  QUICK_LOOK_PARAM = "QuickLook"
+  NUMBER_OF_THREADS_PARAM = "NumberOfThreads"
+  WORKING_SPACING_PARAM = "WorkingSpacing"
+
+
+  _cliModuleType = None
+  _runningInProcessCLINodeIDs = set()
+  _cliAvailableCallbacks = []
 
   def __init__(self):
     """
@@ -476,8 +577,8 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
           module = getattr(module, modulePart)
         importlib.reload(module) # reload
 
-    self.cliNode = None
-    self._cliParams = {}
+    self._overflowStager = None
+    self._lastProcessJob = None
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -493,6 +594,12 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
       parameterNode.SetNodeReferenceID(self.OUTPUT_TRANSFORM_REF, "")
     if not parameterNode.GetNodeReference(self.OUTPUT_VOLUME_REF):
       parameterNode.SetNodeReferenceID(self.OUTPUT_VOLUME_REF, "")
+    if not parameterNode.GetNodeReference(self.OUTPUT_INVERSE_TRANSFORM_REF):
+      parameterNode.SetNodeReferenceID(self.OUTPUT_INVERSE_TRANSFORM_REF, "")
+    if not parameterNode.GetNodeReference(self.OUTPUT_INVERSE_VOLUME_REF):
+      parameterNode.SetNodeReferenceID(self.OUTPUT_INVERSE_VOLUME_REF, "")
+    if not parameterNode.GetNodeReference(self.OUTPUT_TELEMETRY_TABLE_REF):
+      parameterNode.SetNodeReferenceID(self.OUTPUT_TELEMETRY_TABLE_REF, "")
     if not parameterNode.GetParameter(self.OUTPUT_INTERPOLATION_PARAM):
       parameterNode.SetParameter(self.OUTPUT_INTERPOLATION_PARAM, str(presetParameters["outputSettings"]["interpolation"]))
     if not parameterNode.GetParameter(self.CREATE_DISPLACEMENT_FIELD_PARAM):
@@ -511,10 +618,30 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
       parameterNode.SetParameter(self.WINSORIZE_IMAGE_INTENSITIES_PARAM, ",".join([str(x) for x in presetParameters["generalSettings"]["winsorizeImageIntensities"]]))
     if not parameterNode.GetParameter(self.COMPUTATION_PRECISION_PARAM):
       parameterNode.SetParameter(self.COMPUTATION_PRECISION_PARAM, presetParameters["generalSettings"]["computationPrecision"])
+    if not parameterNode.GetParameter(self.NUMBER_OF_THREADS_PARAM):
+      parameterNode.SetParameter(self.NUMBER_OF_THREADS_PARAM, str(presetParameters["generalSettings"].get("numberOfThreads", 0)))
+    if not parameterNode.GetParameter(self.WORKING_SPACING_PARAM):
+      parameterNode.SetParameter(self.WORKING_SPACING_PARAM, "0")
+    if not parameterNode.GetParameter(self.USE_CACHE_PARAM):
+      parameterNode.SetParameter(self.USE_CACHE_PARAM, "0")
+    if not parameterNode.GetParameter(self.USE_CHECKPOINTS_PARAM):
+      parameterNode.SetParameter(self.USE_CHECKPOINTS_PARAM, "0")
+    if not parameterNode.GetParameter(self.QUICK_LOOK_PARAM):
+      parameterNode.SetParameter(self.QUICK_LOOK_PARAM, "0")
+
+  @property
+  def cliNode(self):
+    """
+    CLI node of the last registration started by process, None before its cli is launched.
+    """
+    return self._lastProcessJob.cliNode if self._lastProcessJob is not None else None
 
   def cancelRegistration(self):
-    if self.cliNode:
-      self.cliNode.Cancel()
+    """
+    Cancel the last registration started by process.
+    """
+    if self._lastProcessJob is not None:
+      self._lastProcessJob.cancel()
 
   def createProcessParameters(self, paramNode):
     parameters = {}
@@ -531,6 +658,9 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
     parameters['outputSettings'] = {}
     parameters['outputSettings']['transform'] = paramNode.GetNodeReference(self.OUTPUT_TRANSFORM_REF)
     parameters['outputSettings']['volume'] = paramNode.GetNodeReference(self.OUTPUT_VOLUME_REF)
+    parameters['outputSettings']['inverseTransform'] = paramNode.GetNodeReference(self.OUTPUT_INVERSE_TRANSFORM_REF)
+    parameters['outputSettings']['inverseVolume'] = paramNode.GetNodeReference(self.OUTPUT_INVERSE_VOLUME_REF)
+    parameters['outputSettings']['telemetryTable'] = paramNode.GetNodeReference(self.OUTPUT_TELEMETRY_TABLE_REF)
     parameters['outputSettings']['interpolation'] = paramNode.GetParameter(self.OUTPUT_INTERPOLATION_PARAM)
     parameters['outputSettings']['useDisplacementField'] = int(paramNode.GetParameter(self.CREATE_DISPLACEMENT_FIELD_PARAM))
 
@@ -544,19 +674,447 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
     parameters['generalSettings']['winsorizeImageIntensities'] = \
       [float(val) for val in paramNode.GetParameter(self.WINSORIZE_IMAGE_INTENSITIES_PARAM).split(',')]
     parameters['generalSettings']['computationPrecision'] = paramNode.GetParameter(self.COMPUTATION_PRECISION_PARAM)
+    parameters['generalSettings']['numberOfThreads'] = int(paramNode.GetParameter(self.NUMBER_OF_THREADS_PARAM))
+
+    parameters['useCache'] = bool(int(paramNode.GetParameter(self.USE_CACHE_PARAM)))
+    parameters['useCheckpoints'] = bool(int(paramNode.GetParameter(self.USE_CHECKPOINTS_PARAM)))
+
+    workingSpacing = float(paramNode.GetParameter(self.WORKING_SPACING_PARAM))
+    if workingSpacing > 0:
+      parameters['preprocessingSettings'] = {'workingSpacing': workingSpacing}
 
     return parameters
 
-  def process(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None, wait_for_completion=False):
+  def process(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None, wait_for_completion=False, useCache=False,
+              inputStager=None, earlyTermination=None, preprocessingSettings=None, useCheckpoints=False, checkpointDirectory=None):
     """
     :param stages: list defining registration stages
-    :param outputSettings: dictionary defining output settings
+    :param outputSettings: dictionary defining output settings. Optional 'telemetryTable' (vtkMRMLTableNode) and
+      'telemetryFile' (json file path) receive the per-iteration records parsed from the ANTs output.
+      Optional 'inverseTransform' (vtkMRMLTransformNode) and 'inverseVolume' (vtkMRMLScalarVolumeNode, fixed
+      volume resampled in the moving space) receive the inverse outputs, which are not computed otherwise.
+      Optional 'applyVolumes' lists companion volumes, label maps or segmentations resampled in the fixed space by the
+      same CLI run, see antsRegistrationLib.apply.TransformApplication. The outputs are in job.transformApplication
     :param initialTransformSettings: dictionary defining initial moving transform
     :param generalSettings: dictionary defining general registration settings
     :param wait_for_completion: flag to enable waiting for completion
+    :param useCache: if True, a cached result is used when available (cliNode is then None) and
+      the result is stored in the cache otherwise
+    :param inputStager: optional InputStager used to share input volume files across invocations
+    :param earlyTermination: optional dictionary of PlateauWatchdog settings ('windowSize', 'threshold', 'action',
+      'minimumIterations') to stop levels or the whole run once the metric value stops improving. Disables the cache
+    :param preprocessingSettings: optional dictionary of InputPreprocessor settings: 'cropRegion' (markups ROI, mask volume
+      or 'masks' for the masks of the stages), 'cropMargin' (mm) and 'workingSpacing' (isotropic, mm). The registration runs
+      on the cropped and resampled volumes and the outputs are computed from the original ones
+    :param useCheckpoints: if True, the transform of each completed stage is stored as a checkpoint and the run starts from
+      the checkpoint of the longest matching leading stages (resumedStageCount), computing only the remaining stages
+    :param checkpointDirectory: optional directory where the composite transform of each completed stage is written
+      (stage1.h5, stage2.h5...). Not used with useCheckpoints, which manages its own directories
     See presets examples to see how these are specified
+    :return: the RegistrationJob of the run, holding its cliNode, telemetry and resumedStageCount.
+      logic.cliNode is the cliNode of the last run
+    """
+    from antsRegistrationLib.jobs import RegistrationJob
+    job = RegistrationJob(dict(stages=stages, outputSettings=outputSettings, initialTransformSettings=initialTransformSettings,
+                               generalSettings=generalSettings, useCache=useCache, inputStager=inputStager,
+                               earlyTermination=earlyTermination, preprocessingSettings=preprocessingSettings,
+                               useCheckpoints=useCheckpoints, checkpointDirectory=checkpointDirectory))
+    self._lastProcessJob = job
+    self.runJob(job, wait_for_completion)
+    return job
+
+  def processQuickLook(self, numberOfLevels=1, iterationFactor=0.2, jobQueue=None, onQuickLookFinished=None, onFinished=None, **parameters):
+    """
+    Run the registration first on the numberOfLevels coarsest levels of each stage with the iterations scaled by
+    iterationFactor, writing a first result to the outputs within seconds, then continue with the full schedule
+    warm-started from the quick look transform of the leading linear stages.
+    :param jobQueue: optional JobQueue the two runs are submitted to
+    :param onQuickLookFinished: optional callable receiving the quick look RegistrationJob once finished
+    :param onFinished: optional callable receiving the full RegistrationJob once finished
+    :param parameters: keyword arguments of process
+    :return: QuickLookRegistration object holding the quickLookJob and fullJob
+    """
+    from antsRegistrationLib.quicklook import QuickLookRegistration
+    quickLook = QuickLookRegistration(self, parameters, numberOfLevels, iterationFactor, jobQueue=jobQueue,
+                                      onQuickLookFinished=onQuickLookFinished, onFinished=onFinished)
+    quickLook.start()
+    return quickLook
+
+  def runJob(self, job, wait_for_completion=False):
+    """
+    Launch a RegistrationJob. All the state of the run is kept in the job, so that several jobs can run at the same time.
+    Raises ValueError if the stages are not valid.
+    """
+    parameters = job.parameters
+    stages = parameters['stages']
+    outputSettings = parameters['outputSettings']
+    initialTransformSettings = parameters.get('initialTransformSettings')
+    generalSettings = parameters.get('generalSettings')
+    earlyTermination = parameters.get('earlyTermination')
+    job.startTime = time.time()
+    try:
+      if not self.canStartCLI():
+        raise RuntimeError('antsRegistrationCLI runs in process and another registration is running')
+      preprocessor = None
+      if parameters.get('preprocessingSettings'):
+        from antsRegistrationLib.preprocessing import InputPreprocessor
+        preprocessor = InputPreprocessor(**parameters['preprocessingSettings'])
+        stages, outputSettings = preprocessor.apply(stages, outputSettings)
+      checkpoints = None
+      stageKeys = None
+      if parameters.get('useCheckpoints'):
+        from antsRegistrationLib.checkpoints import StageCheckpoints
+        checkpoints = StageCheckpoints()
+        # deformable checkpoints are read back without their inverse
+        linearOnly = outputSettings.get('inverseTransform') is not None or outputSettings.get('inverseVolume') is not None
+        numberOfStages = len(stages)
+        stages, initialTransformSettings, stageKeys = checkpoints.resume(stages, initialTransformSettings, generalSettings, linearOnly)
+        job.resumedStageCount = numberOfStages - len(stages)
+      job.cliParams = self.createCLIParameters(stages, outputSettings, initialTransformSettings, generalSettings, parameters.get('inputStager'))
+      if outputSettings.get('applyVolumes'):
+        from antsRegistrationLib.apply import TransformApplication
+        job.transformApplication = TransformApplication(outputSettings['applyVolumes'], parameters.get('inputStager'))
+        job.transformApplication.addCLIParameters(job.cliParams)
+    except Exception as e:
+      if job.transformApplication is not None:
+        job.transformApplication.cleanup()
+      job.finish(job.FAILED, str(e))
+      raise
+    runDirectory = None
+    if stageKeys and not earlyTermination:
+      # early terminated stages are not checkpointed
+      runDirectory = checkpoints.createRunDirectory(stageKeys)
+      job.cliParams['checkpointDirectory'] = runDirectory
+    elif parameters.get('checkpointDirectory') and not parameters.get('useCheckpoints'):
+      job.cliParams['checkpointDirectory'] = parameters['checkpointDirectory']
+    watchdog = self.createPlateauWatchdog(job.cliParams, earlyTermination) if earlyTermination else None
+    # the cache does not hold the resampled companion volumes
+    useCache = parameters.get('useCache', False) and job.transformApplication is None
+    job.cliNode = self.runCLI(job.cliParams, wait_for_completion=wait_for_completion, useCache=useCache)
+    job.telemetry = self.createTelemetry(job.cliNode, outputSettings.get('telemetryTable'), outputSettings.get('telemetryFile'), watchdog)
+    if runDirectory is not None:
+      # checkpoints written before a failure or cancellation are kept as well
+      if job.cliNode is None:
+        checkpoints.collectRun(runDirectory)
+      else:
+        self.addCLICompletedCallback(job.cliNode, lambda: checkpoints.collectRun(runDirectory), onlyIfSucceeded=False)
+    if preprocessor is not None:
+      # cropped volumes are read by the cli until it finishes
+      if job.cliNode is None:
+        preprocessor.cleanup()
+      else:
+        self.addCLICompletedCallback(job.cliNode, preprocessor.cleanup, onlyIfSucceeded=False)
+    if job.transformApplication is not None:
+      # outputs are read before the job reports its completion
+      self.addTransformApplicationCallbacks(job.cliNode, job.transformApplication)
+    job.setRunning()
+
+  def addTransformApplicationCallbacks(self, cliNode, transformApplication, inputStager=None):
+    """
+    Read the outputs of the transform application once the cli succeeded and remove its files, and the ones of
+    inputStager if given, once it completed.
     """
+    self.addCLICompletedCallback(cliNode, transformApplication.loadOutputs)
+    self.addCLICompletedCallback(cliNode, transformApplication.cleanup, onlyIfSucceeded=False)
+    if inputStager is not None:
+      self.addCLICompletedCallback(cliNode, inputStager.cleanup, onlyIfSucceeded=False)
 
+  def applyTransformToVolumes(self, transformNode, volumes, referenceVolume, generalSettings=None, wait_for_completion=False):
+    """
+    Resample volumes on the grid of referenceVolume with a transform, without registration. The transform is read
+    once by antsRegistrationCLI for all the volumes.
+    :param transformNode: vtkMRMLTransformNode, e.g. the output transform of a registration
+    :param volumes: list of volume, label map or segmentation nodes, or of dictionaries with 'input' node and optional
+      'output' node and 'interpolation' (antsApplyTransforms --interpolation value, GenericLabel for labels by default)
+    :param referenceVolume: volume node defining the output grid
+    :param generalSettings: dictionary of 'computationPrecision' and 'numberOfThreads'
+    :param wait_for_completion: flag to enable waiting for completion
+    :return: TransformApplication, with the output nodes in outputNodes and the cli node in cliNode
+    """
+    from antsRegistrationLib.apply import TransformApplication
+    from antsRegistrationLib.cache import RegistrationCache
+    from antsRegistrationLib.ioprofiles import getIOProfile
+    from antsRegistrationLib.staging import InputStager
+    if generalSettings is None:
+      generalSettings = {}
+    # staged for this call only, removed once the cli completed
+    inputStager = InputStager()
+    transformApplication = TransformApplication(volumes, inputStager)
+    try:
+      transformFile = os.path.join(transformApplication.directory, 'transform.h5')
+      storageNode = RegistrationCache.createStorageNode(transformNode)
+      storageNode.SetFileName(transformFile)
+      if not storageNode.WriteData(transformNode):
+        raise RuntimeError('Unable to write %s to %s' % (transformNode.GetName(), transformFile))
+      cliParams = {
+        'antsCommand': '',
+        'applyTransformFile': transformFile,
+        'applyReferenceVolume': inputStager.stageNode(referenceVolume),
+        'useFloat': generalSettings.get('computationPrecision', 'float') == 'float',
+        'numberOfThreads': int(generalSettings.get('numberOfThreads', 0)),
+        'compressOutputs': getIOProfile().useCompression,
+        }
+      transformApplication.addCLIParameters(cliParams)
+    except Exception:
+      transformApplication.cleanup()
+      inputStager.cleanup()
+      raise
+    transformApplication.cliNode = self.runCLI(cliParams, wait_for_completion=wait_for_completion)
+    self.addTransformApplicationCallbacks(transformApplication.cliNode, transformApplication, inputStager)
+    return transformApplication
+
+  def getWorkingSpacingSavingsText(self, fixedNode, movingNode, workingSpacing):
+    """
+    Return a description of the voxels saved at the finest level by resampling the inputs to workingSpacing.
+    """
+    volumeNodes = [node for node in [fixedNode, movingNode] if node is not None and node.GetImageData() is not None]
+    if workingSpacing <= 0 or not volumeNodes:
+      return ''
+    from antsRegistrationLib.preprocessing import InputPreprocessor
+    preprocessor = InputPreprocessor(workingSpacing=workingSpacing)
+    nativeCount = sum(preprocessor.getVoxelCount(node) for node in volumeNodes)
+    workingCount = sum(preprocessor.estimateVoxelCount(node) for node in volumeNodes)
+    if workingCount >= nativeCount:
+      return 'No savings: inputs are not finer'
+    # memory and time of the finest level grow with the number of voxels
+    return '%.1fx fewer voxels: about %i%% less memory and time' % (nativeCount / workingCount, 100 * (1 - workingCount / nativeCount))
+
+  def getCostEstimateText(self, stages, fixedNode, movingNode, generalSettings=None, workingSpacing=0):
+    """
+    Return the runtime and peak memory predicted by the calibrated cost model for the stages, or '' if they can not be estimated.
+    """
+    volumeNodes = [fixedNode, movingNode]
+    if not stages or any(node is None or node.GetImageData() is None for node in volumeNodes):
+      return ''
+    from antsRegistrationLib.validation import validateStages
+    if validateStages(stages):
+      return ''
+    from antsRegistrationLib.costmodel import RegistrationCostModel, formatEstimate
+    from antsRegistrationLib.preprocessing import InputPreprocessor
+    preprocessor = InputPreprocessor(workingSpacing=workingSpacing if workingSpacing > 0 else None)
+    fixedDimensions, movingDimensions = [preprocessor.estimateDimensions(node) for node in volumeNodes]
+    return formatEstimate(RegistrationCostModel.load().estimate(stages, fixedDimensions, movingDimensions, generalSettings))
+
+  def createPlateauWatchdog(self, cliParams, earlyTermination):
+    """
+    Create a PlateauWatchdog with the given settings and pass its control file to the CLI parameters.
+    """
+    from antsRegistrationLib.watchdog import PlateauWatchdog
+    watchdog = PlateauWatchdog(**earlyTermination, controlDirectory=slicer.app.temporaryPath)
+    cliParams['controlFile'] = watchdog.controlFile
+    return watchdog
+
+  def createTelemetry(self, cliNode, tableNode=None, filePath=None, watchdog=None):
+    """
+    Follow the output of cliNode if telemetry outputs or a watchdog are given. Return the RegistrationTelemetry or None.
+    """
+    if cliNode is None or not (tableNode or filePath or watchdog):
+      if watchdog:
+        watchdog.cleanup()
+      return None
+    from antsRegistrationLib.telemetry import RegistrationTelemetry
+    return RegistrationTelemetry(cliNode, tableNode, filePath,
+                                 onRecords=watchdog.onRecords if watchdog else None,
+                                 onFinished=watchdog.cleanup if watchdog else None)
+
+  def runCLI(self, cliParams, wait_for_completion=False, useCache=False):
+    """
+    Run antsRegistrationCLI with the given parameters. Return the CLI node or None if the result was loaded from cache.
+    """
+    if useCache:
+      from antsRegistrationLib.cache import RegistrationCache
+      cache = RegistrationCache()
+      cacheKey = cache.getKeyFromCLIParameters(cliParams)
+      if cache.loadResult(cacheKey, cliParams):
+        return None
+    if not self.canStartCLI():
+      raise RuntimeError('antsRegistrationCLI runs in process and another registration is running')
+    cliNode = slicer.cli.run(slicer.modules.antsregistrationcli, None, cliParams,
+                             wait_for_completion=wait_for_completion, update_display=False)
+    if self.isCLIInProcess():
+      self._runningInProcessCLINodeIDs.add(cliNode.GetID())
+      self.addCLICompletedCallback(cliNode, lambda: self.onInProcessCLIFinished(cliNode.GetID()), onlyIfSucceeded=False)
+    if useCache:
+      self.addCLICompletedCallback(cliNode, lambda: cache.storeResult(cacheKey, cliParams))
+    return cliNode
+
+  @classmethod
+  def canStartCLI(cls):
+    """
+    Return True if antsRegistrationCLI can be launched now. In process, only one runs at a time: the settings it
+    passes to ANTs (control file, checkpoint directory, skipped outputs, compression) and the ITK thread count are
+    process wide. Schedulers wait for the running one with callWhenCLICanStart.
+    """
+    return not cls._runningInProcessCLINodeIDs or not cls.isCLIInProcess()
+
+  @classmethod
+  def callWhenCLICanStart(cls, callback):
+    """
+    Call callback once the running in process CLI finished.
+    """
+    if callback not in cls._cliAvailableCallbacks:
+      cls._cliAvailableCallbacks.append(callback)
+
+  @classmethod
+  def onInProcessCLIFinished(cls, cliNodeID):
+    cls._runningInProcessCLINodeIDs.discard(cliNodeID)
+    callbacks = list(cls._cliAvailableCallbacks)
+    cls._cliAvailableCallbacks.clear()
+    for callback in callbacks:
+      # after the callbacks of the finished cli node, which may launch the next one themselves
+      qt.QTimer.singleShot(0, callback)
+
+  @staticmethod
+  def addCLICompletedCallback(cliNode, callback, onlyIfSucceeded=True):
+    """
+    Call callback once cliNode completed without errors, or once it finished in any way if onlyIfSucceeded is False.
+    """
+    def isDone():
+      return (cliNode.GetStatus() & cliNode.Completed) or (cliNode.GetStatus() & cliNode.Cancelled)
+    def onStatusUpdate(caller=None, event=None):
+      if not isDone():
+        return
+      if observerTag is not None:
+        cliNode.RemoveObserver(observerTag)
+      if not onlyIfSucceeded or not (cliNode.GetStatus() & (cliNode.Cancelled | cliNode.ErrorsMask)):
+        callback()
+    observerTag = None
+    if isDone():
+      onStatusUpdate()
+    else:
+      observerTag = cliNode.AddObserver('ModifiedEvent', onStatusUpdate)
+
+  def purgeCache(self):
+    from antsRegistrationLib.cache import RegistrationCache
+    from antsRegistrationLib.checkpoints import StageCheckpoints
+    RegistrationCache().purge()
+    StageCheckpoints().purge()
+
+  def processBatch(self, stages, outputSettings, movingVolumes, initialTransformSettings=None, generalSettings=None,
+                   maxConcurrentJobs=1, outputDirectory=None, onItemFinished=None, wait_for_completion=False, useCache=False,
+                   scheduler=None, earlyTermination=None, memoryLimitMB=None):
+    """
+    Register a list of moving volumes against the fixed volume of the given stages.
+    :param stages: list defining registration stages (moving nodes in the metrics are replaced per item)
+    :param outputSettings: dictionary defining output settings. 'transform' and 'volume' are used as
+      templates: when not None, a new node of the same class is created for each item
+    :param movingVolumes: list of moving volume nodes or file paths
+    :param initialTransformSettings: dictionary defining initial moving transform
+    :param generalSettings: dictionary defining general registration settings
+    :param maxConcurrentJobs: maximum number of registrations running at the same time
+    :param scheduler: CoreScheduler splitting the cores across running registrations. Defaults to an equal split of all cores
+    :param outputDirectory: if set, outputs of each item are also saved to this directory
+    :param onItemFinished: optional callable receiving each BatchItem when it finishes
+    :param wait_for_completion: flag to enable waiting for completion of the whole batch
+    :param useCache: if True, cached results are re-used and new results are stored in the cache
+    :param earlyTermination: optional PlateauWatchdog settings applied to each item, see process
+    :param memoryLimitMB: if set, items are only launched while the peak memory predicted by the calibrated
+      RegistrationCostModel for the running items fits in this limit, e.g. costmodel.getPhysicalMemoryMB()
+    :return: BatchRegistration object reporting per item status, timing and outputs
+    """
+    from antsRegistrationLib.batch import BatchRegistration
+    batch = BatchRegistration(self, stages, outputSettings, movingVolumes, initialTransformSettings, generalSettings,
+                              maxConcurrentJobs=maxConcurrentJobs, outputDirectory=outputDirectory, onItemFinished=onItemFinished,
+                              useCache=useCache, scheduler=scheduler, earlyTermination=earlyTermination,
+                              memoryLimitMB=memoryLimitMB)
+    batch.start()
+    if wait_for_completion:
+      batch.wait()
+    return batch
+
+  def buildTemplate(self, subjects, initialTemplate, stages, outputDirectory, numberOfIterations=4, gradientStep=0.25,
+                    initialTransformSettings=None, generalSettings=None, maxConcurrentJobs=2, scheduler=None,
+                    onIterationFinished=None, onFinished=None, wait_for_completion=False):
+    """
+    Build an unbiased population template: each iteration registers all the subjects to the current template, at most
+    maxConcurrentJobs at a time, then averages the warped subjects and moves the average along the inverse of the
+    average displacement field. Started again with the same outputDirectory, building resumes after the last completed iteration.
+    :param subjects: list of subject volume nodes or file paths
+    :param initialTemplate: volume node or file path of the first template, defining the template grid
+    :param stages: list defining registration stages, fixed and moving images are replaced by the template and the subjects
+    :param outputDirectory: directory of the template of each iteration (template_iterationNN.nrrd) and of the template.json state
+    :param numberOfIterations: total number of iterations, including the ones of a resumed build
+    :param gradientStep: fraction of the average displacement the template is moved by at each iteration
+    :param onIterationFinished: optional callable receiving the TemplateBuilder after each iteration
+    :param onFinished: optional callable receiving the TemplateBuilder once finished, see its errorText
+    :param wait_for_completion: flag to enable waiting for completion of all the iterations
+    :return: TemplateBuilder object, templateNode holds the current template
+    """
+    from antsRegistrationLib.template import TemplateBuilder
+    builder = TemplateBuilder(self, subjects, initialTemplate, stages, outputDirectory, numberOfIterations, gradientStep,
+                              initialTransformSettings, generalSettings, maxConcurrentJobs=maxConcurrentJobs, scheduler=scheduler,
+                              onIterationFinished=onIterationFinished, onFinished=onFinished)
+    builder.start()
+    if wait_for_completion:
+      builder.wait()
+    return builder
+
+  def processSweep(self, stages, grid, pairs=None, initialTransformSettings=None, generalSettings=None,
+                   maxConcurrentJobs=2, scheduler=None, onItemFinished=None, onFinished=None, wait_for_completion=False):
+    """
+    Register every combination of a parameter grid over the given stages and rank them.
+    :param stages: list defining the base registration stages
+    :param grid: dictionary of parameter path: list of values, e.g. {'*.transform.gradientStep': [0.1, 0.25],
+      '0.levels.shrinkFactors': ['4x2x1', '8x4x2x1']}. See antsRegistrationLib.sweep.setStageParameter
+    :param pairs: optional list of representative (fixed, moving) nodes or file paths replacing the inputs of the stages,
+      results are aggregated over the pairs
+    :param initialTransformSettings: dictionary defining initial moving transform
+    :param generalSettings: dictionary defining general registration settings
+    :param maxConcurrentJobs: maximum number of registrations running at the same time
+    :param scheduler: CoreScheduler splitting the cores across running registrations
+    :param onItemFinished: optional callable receiving each SweepItem when it finishes
+    :param onFinished: optional callable receiving the ParameterSweep once all its items finished
+    :param wait_for_completion: flag to enable waiting for completion of the whole sweep
+    :return: ParameterSweep object, see getRanking and getWinnerStages
+    """
+    from antsRegistrationLib.sweep import ParameterSweep, formatCombination
+    from antsRegistrationLib.validation import validateStages
+    sweep = ParameterSweep(self, stages, grid, pairs, initialTransformSettings, generalSettings,
+                           maxConcurrentJobs=maxConcurrentJobs, scheduler=scheduler,
+                           onItemFinished=onItemFinished, onFinished=onFinished)
+    for combination, combinationStages in sweep.combinations:
+      errors = validateStages(combinationStages)
+      if errors:
+        raise ValueError('Invalid registration stages for %s:\n' % formatCombination(combination) + '\n'.join(errors))
+    sweep.start()
+    if wait_for_completion:
+      sweep.wait()
+    return sweep
+
+  def submit(self, backend, jobDirectory, stages, outputSettings, initialTransformSettings=None, generalSettings=None, onFinished=None):
+    """
+    Run the registration with an execution backend (e.g. LocalProcessBackend, BatchSchedulerBackend or SpoolDirectoryBackend
+    from antsRegistrationLib.backends) instead of slicer.cli.run. Inputs and the job manifest are written to jobDirectory,
+    which the executing machine must be able to reach, and the outputs are loaded into the output nodes once the job completed.
+    :param onFinished: optional callable receiving the SubmittedRegistration once finished
+    :return: SubmittedRegistration object reporting the job status
+    """
+    from antsRegistrationLib.submission import SubmittedRegistration
+    submitted = SubmittedRegistration(self, backend, jobDirectory, onFinished=onFinished)
+    submitted.submit(stages, outputSettings, initialTransformSettings, generalSettings)
+    return submitted
+
+  @classmethod
+  def isCLIInProcess(cls):
+    """
+    Return True if antsRegistrationCLI is loaded as a shared library and runs in the Slicer process.
+    Volumes are then passed to it in memory instead of through temporary files.
+    """
+    if cls._cliModuleType is None:
+      cliNode = slicer.cli.createNode(slicer.modules.antsregistrationcli)
+      cls._cliModuleType = cliNode.GetModuleType()
+      slicer.mrmlScene.RemoveNode(cliNode)
+    return cls._cliModuleType == 'SharedObjectModule'
+
+  def createCLIParameters(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None, inputStager=None):
+    """
+    Build the antsRegistrationCLI parameters dictionary for the given settings.
+    See process for a description of the arguments. Raises ValueError if the stages are not valid.
+    """
+    from antsRegistrationLib.validation import validateStages
+    errors = validateStages(stages)
+    if errors:
+      raise ValueError('Invalid registration stages:\n' + '\n'.join(errors))
     if generalSettings is None:
       generalSettings = {}
     if initialTransformSettings is None:
@@ -564,109 +1122,47 @@ class antsRegistrationLogic(ScriptedLoadableModuleLogic):
     initialTransformSettings['fixedImageNode'] = stages[0]['metrics'][0]['fixed']
     initialTransformSettings['movingImageNode'] = stages[0]['metrics'][0]['moving']
 
-    self._cliParams = {}
-    self.getOrSetCLIParam(stages[0]['metrics'][0]['fixed']) # put in first position. will be used as reference in cli
-    self._cliParams["antsCommand"] = self.getAntsRegistrationCommand(stages, outputSettings, initialTransformSettings, generalSettings)
+    from antsRegistrationLib.command import NodeCommandBuilder
+    commandBuilder = NodeCommandBuilder(inputStager, self.getOverflowStager)
+    commandBuilder.getPlaceholder(stages[0]['metrics'][0]['fixed']) # put in first position. will be used as reference in cli
+    cliParams = commandBuilder.parameters
+    cliParams["antsCommand"] = commandBuilder.getAntsRegistrationCommand(stages, outputSettings, initialTransformSettings, generalSettings)
 
     if outputSettings["transform"] is not None:
       if ("useDisplacementField" in outputSettings) and outputSettings["useDisplacementField"]:
-        self._cliParams["outputDisplacementField"] = outputSettings["transform"]
+        cliParams["outputDisplacementField"] = outputSettings["transform"]
+        if outputSettings.get("displacementFieldMethod"):
+          cliParams["displacementFieldMethod"] = outputSettings["displacementFieldMethod"]
       else:
-        self._cliParams["outputCompositeTransform"] = outputSettings["transform"]
-    
-    self._cliParams["useFloat"] = (generalSettings["computationPrecision"]  == "float")
+        cliParams["outputCompositeTransform"] = outputSettings["transform"]
+    if outputSettings.get("inverseTransform") is not None:
+      cliParams["outputInverseCompositeTransform"] = outputSettings["inverseTransform"]
+    if "nativeMovingVolume" in cliParams:
+      cliParams["outputInterpolation"] = outputSettings["interpolation"]
 
-    self.cliNode = slicer.cli.run(slicer.modules.antsregistrationcli, None, self._cliParams,
-                                  wait_for_completion=wait_for_completion, update_display=False)
+    cliParams["useFloat"] = (generalSettings.get("computationPrecision", "float")  == "float")
+    cliParams["numberOfThreads"] = int(generalSettings.get("numberOfThreads", 0))
+    from antsRegistrationLib.ioprofiles import getIOProfile
+    cliParams["compressOutputs"] = getIOProfile().useCompression
 
-  def getAntsRegistrationCommand(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None):
-    if generalSettings is None:
-      generalSettings = {}
-    if initialTransformSettings is None:
-      initialTransformSettings = {}
-    antsCommand = self.getGeneralSettingsCommand(**generalSettings)
-    antsCommand = antsCommand + self.getOutputCommand(interpolation=outputSettings['interpolation'], volume=outputSettings['volume'])
-    antsCommand = antsCommand + self.getInitialMovingTransformCommand(**initialTransformSettings)
-    for stage in stages:
-      antsCommand = antsCommand + self.getStageCommand(**stage)
-    return antsCommand
-
-  def getGeneralSettingsCommand(self, dimensionality=3, histogramMatching=False, winsorizeImageIntensities=None, computationPrecision="float"):
-    if winsorizeImageIntensities is None:
-      winsorizeImageIntensities = [0, 1]
-    command = "--dimensionality %i" % dimensionality
-    command = command + " --use-histogram-matching %i" % histogramMatching
-    command = command + " --winsorize-image-intensities [%.3f,%.3f]" % tuple(winsorizeImageIntensities)
-    command = command + " --float $useFloat"
-    command = command + " --verbose 1"
-    return command
-
-  def getOutputCommand(self, interpolation='Linear', volume=None):
-    command = " --interpolation %s" % interpolation
-    if volume is not None:
-      command = command + " --output [%s,%s]" % ("$outputBase", self.getOrSetCLIParam(volume, "outputVolume"))
-    else:
-      command = command + " --output $outputBase"
-    command = command + " --write-composite-transform 1"
-    command = command + " --collapse-output-transforms 1"
-    return command
-
-  def getInitialMovingTransformCommand(self, initialTransformNode=None, initializationFeature=-1, fixedImageNode=None, movingImageNode=None):
-    if initialTransformNode is not None:
-      return " --initial-moving-transform %s" % self.getOrSetCLIParam(initialTransformNode, "inputTransform")
-    elif initializationFeature >= 0:
-      return " --initial-moving-transform [%s,%s,%i]" % (self.getOrSetCLIParam(fixedImageNode), self.getOrSetCLIParam(movingImageNode), initializationFeature)
-    else:
-      return ""
-
-  def getStageCommand(self, transformParameters, metrics, levels, masks):
-    command = self.getTransformCommand(**transformParameters)
-    for metric in metrics:
-      command = command + self.getMetricCommand(**metric)
-    command = command + self.getLevelsCommand(**levels)
-    command = command + self.getMasksCommand(**masks)
-    return command
-
-  def getTransformCommand(self, transform, settings):
-    return " --transform %s[%s]" % (transform, settings)
-
-  def getMetricCommand(self, type, fixed, moving, settings):
-    return " --metric %s[%s,%s,%s]" % (type, self.getOrSetCLIParam(fixed), self.getOrSetCLIParam(moving), settings)
-
-  def getMasksCommand(self, fixed=None, moving=None):
-    fixedMask = self.getOrSetCLIParam(fixed) if fixed else ''
-    movingMask = self.getOrSetCLIParam(moving) if moving else ''
-    if fixedMask and movingMask:
-      return " --masks [%s,%s]" % (fixedMask, movingMask)
-    return ""
-
-  def getLevelsCommand(self, steps, convergenceThreshold, convergenceWindowSize, smoothingSigmasUnit):
-    convergence = self.joinStepsInfoForKey(steps, 'convergence')
-    smoothingSigmas = self.joinStepsInfoForKey(steps, 'smoothingSigmas')
-    shrinkFactors = self.joinStepsInfoForKey(steps, 'shrinkFactors')
-    command = " --convergence [%s,1e-%i,%i]" % (convergence, convergenceThreshold, convergenceWindowSize)
-    command = command + " --smoothing-sigmas %s%s" % (smoothingSigmas, smoothingSigmasUnit)
-    command = command + " --shrink-factors %s" % shrinkFactors
-    return command
-
-  def joinStepsInfoForKey(self, steps, key):
-    out = [str(step[key]) for step in steps]
-    return "x".join(out)
-
-  def getOrSetCLIParam(self, mrmlNode, cliparam="inputVolume"):
-    greatestInputVolume = 0
-    nodeID = mrmlNode.GetID()
-    # get part
-    for key,val in self._cliParams.items():
-      if key.startswith(cliparam) and nodeID == val:
-        return "$" + key
-      elif key.startswith("inputVolume"):
-        greatestInputVolume = int(key[-2:])
-    # set part
-    if cliparam == "inputVolume":
-      cliparam = "inputVolume%02i" % (greatestInputVolume+1)
-    self._cliParams[cliparam] = nodeID
-    return "$" + cliparam
+    return cliParams
+
+  def getOverflowStager(self):
+    """
+    Return the stager writing input volumes passed beyond the MAX_INPUT_VOLUMES declared by the cli.
+    """
+    if self._overflowStager is None:
+      from antsRegistrationLib.staging import InputStager
+      self._overflowStager = InputStager()
+    return self._overflowStager
+
+  def cleanupStagedInputs(self):
+    """
+    Remove the files of input volumes passed beyond the MAX_INPUT_VOLUMES declared by the cli.
+    """
+    if self._overflowStager is not None:
+      self._overflowStager.cleanup()
+      self._overflowStager = None
 
 
 #
@@ -730,6 +1226,36 @@ class antsRegistrationTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_antsRegistration1()
+    self.setUp()
+    self.test_cropToMasks()
+    self.setUp()
+    self.test_logParser()
+    self.setUp()
+    self.test_plateauWatchdog()
+    self.setUp()
+    self.test_coreScheduler()
+    self.setUp()
+    self.test_commandBuilder()
+    self.setUp()
+    self.test_commandBuilderInputVolumeList()
+    self.setUp()
+    self.test_validateStages()
+    self.setUp()
+    self.test_costModel()
+    self.setUp()
+    self.test_stageCheckpoints()
+    self.setUp()
+    self.test_sweepGrid()
+    self.setUp()
+    self.test_quickLookStages()
+    self.setUp()
+    self.test_updateTemplateShape()
+    self.setUp()
+    self.test_transformApplication()
+    self.setUp()
+    self.test_executionBackends()
+    self.setUp()
+    self.test_registrationCache()
 
   def test_antsRegistration1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -777,3 +1303,700 @@ class antsRegistrationTest(ScriptedLoadableModuleTest):
   def onProcessingStatusUpdate(self, caller, event):
     if caller.GetStatus() & caller.Completed:
       self.delayDisplay('Test passed!')
+
+  def test_cropToMasks(self):
+    """ Crop to the masks of the stages when only one stage has a mask, the others are unset ('').
+    """
+    import SampleData
+    import numpy as np
+    from antsRegistrationLib.preprocessing import InputPreprocessor
+    fixed = SampleData.SampleDataLogic().downloadMRBrainTumor1()
+    moving = SampleData.SampleDataLogic().downloadMRBrainTumor2()
+    mask = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    mask.CopyOrientation(fixed)
+    maskArray = np.zeros(slicer.util.arrayFromVolume(fixed).shape, dtype=np.uint8)
+    maskArray[20:40, 60:120, 60:120] = 1
+    slicer.util.updateVolumeFromArray(mask, maskArray)
+
+    presetParameters = PresetManager().getPresetParametersByName('Rigid+Affine')
+    for stage in presetParameters['stages']:
+      for metric in stage['metrics']:
+        metric['fixed'] = fixed
+        metric['moving'] = moving
+      stage['masks'] = {'fixed': '', 'moving': ''}
+    presetParameters['stages'][0]['masks']['fixed'] = mask
+    outputSettings = {'transform': None, 'volume': slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')}
+
+    preprocessor = InputPreprocessor(cropRegion='masks', cropMargin=5.0)
+    try:
+      stages, outputSettings = preprocessor.apply(presetParameters['stages'], outputSettings)
+      croppedFixed = stages[0]['metrics'][0]['fixed']
+      croppedMoving = stages[1]['metrics'][0]['moving']
+      self.assertIsNot(croppedFixed, fixed)
+      self.assertIs(stages[1]['metrics'][0]['fixed'], croppedFixed)
+      # the moving volume is cropped to the fixed mask
+      self.assertIsNot(croppedMoving, moving)
+      for original, cropped in [(fixed, croppedFixed), (moving, croppedMoving)]:
+        self.assertLess(np.prod(cropped.GetImageData().GetDimensions()), np.prod(original.GetImageData().GetDimensions()))
+      self.assertIs(outputSettings['nativeReferenceVolume'], fixed)
+      self.assertIs(outputSettings['nativeMovingVolume'], moving)
+      self.assertIsNone(preprocessor.getRegionBounds(''))
+      self.assertIsNone(preprocessor.getRegionBounds('vtkMRMLScalarVolumeNodeMissing'))
+    finally:
+      preprocessor.cleanup()
+    self.delayDisplay('Test passed!')
+
+  def test_logParser(self):
+    """ Parse the verbose output of antsRegistration fed in chunks that split lines.
+    """
+    from antsRegistrationLib.telemetry import AntsLogParser
+    log = '\n'.join([
+      'Stage 0',
+      '*** Running Euler3DTransform registration ***',
+      'DIAGNOSTIC,Iteration,metricValue,convergenceValue,ITERATION_TIME_INDEX,SINCE_LAST',
+      '  Current level = 1 of 2',
+      ' 1DIAGNOSTIC,     1, -5.000000000000e-01, inf, 1.0000e+00, 1.0000e+00, ',
+      ' 1DIAGNOSTIC,     2, -6.000000000000e-01, 1.000000000000e-02, 1.5000e+00, 5.0000e-01, ',
+      '  Current level = 2 of 2',
+      ' 2DIAGNOSTIC,     1, -7.000000000000e-01, inf, 2.0000e+00, 5.0000e-01, ',
+      '  Elapsed time (stage 0): 2.5000e+00',
+      'Stage 1',
+      '*** Running SyN registration ***',
+      '  Current level = 1 of 1',
+      ' 1DIAGNOSTIC,     1, -8.000000000000e-01, inf, 3.0000e+00, 1.0000e+00, ',
+      'Total elapsed time: 3.5000e+00',
+      'Peak resident memory (MB): 512.5',
+      ])
+    parser = AntsLogParser()
+    newRecords = []
+    for start in range(0, len(log), 37):
+      newRecords += parser.feed(log[start:start + 37])
+    newRecords += parser.flush()
+    self.assertEqual(newRecords, parser.records)
+    self.assertEqual([(r['stage'], r['transform'], r['level'], r['iteration']) for r in parser.records],
+                     [(0, 'Euler3DTransform', 1, 1), (0, 'Euler3DTransform', 1, 2), (0, 'Euler3DTransform', 2, 1), (1, 'SyN', 1, 1)])
+    self.assertEqual([r['metricValue'] for r in parser.records], [-0.5, -0.6, -0.7, -0.8])
+    self.assertEqual(parser.records[0]['convergenceValue'], float('inf'))
+    self.assertEqual(parser.records[1]['convergenceValue'], 0.01)
+    self.assertEqual(parser.getFinalMetricValue(), -0.8)
+    self.assertEqual(parser.stageElapsedTimes, {0: 2.5})
+    self.assertEqual(parser.totalElapsedTime, 3.5)
+    self.assertEqual(parser.peakMemoryMB, 512.5)
+
+    levels = parser.getLevelSummaries()
+    self.assertEqual([(level['stage'], level['level'], level['iterations']) for level in levels], [(0, 1, 2), (0, 2, 1), (1, 1, 1)])
+    self.assertEqual(levels[0]['time'], 1.5)
+    self.assertEqual(levels[0]['finalMetricValue'], -0.6)
+    # non finite values are not written to JSON
+    self.assertIsNone(parser.toDict()['records'][0]['convergenceValue'])
+    self.assertEqual(parser.toDict()['stageElapsedTimes'], {'0': 2.5})
+    self.delayDisplay('Test passed!')
+
+  def test_plateauWatchdog(self):
+    """ Request early termination once the metric stops improving, then clear the request on the next level.
+    """
+    import os
+    from antsRegistrationLib.watchdog import PlateauWatchdog
+    def records(stage, level, metricValues):
+      return [{'stage': stage, 'level': level, 'metricValue': value} for value in metricValues]
+    def readRequest(watchdog):
+      with open(watchdog.controlFile) as controlFile:
+        return controlFile.read()
+
+    with self.assertRaises(ValueError):
+      PlateauWatchdog(action='stage')
+
+    watchdog = PlateauWatchdog(windowSize=3, threshold=1e-2, action='level', controlDirectory=slicer.app.temporaryPath)
+    try:
+      # the non finite first value is ignored
+      watchdog.onRecords(records(0, 1, [float('nan'), -1.0, -1.5, -2.0, -2.5, -2.501, -2.502]))
+      self.assertEqual(watchdog.stoppedLevels, [])
+      self.assertEqual(readRequest(watchdog), '')
+      watchdog.onRecords(records(0, 1, [-2.503]))
+      self.assertEqual(watchdog.stoppedLevels, [(0, 1)])
+      self.assertEqual(readRequest(watchdog), 'level')
+      # a request not consumed before the level ended is cleared
+      watchdog.onRecords(records(0, 2, [-3.0]))
+      self.assertEqual(readRequest(watchdog), '')
+    finally:
+      watchdog.cleanup()
+    self.assertFalse(os.path.exists(watchdog.controlFile))
+
+    watchdog = PlateauWatchdog(windowSize=2, threshold=1e-2, action='run', minimumIterations=4, controlDirectory=slicer.app.temporaryPath)
+    try:
+      watchdog.onRecords(records(0, 1, [-1.0, -1.0, -1.0]))
+      self.assertEqual(watchdog.stoppedLevels, [])
+      watchdog.onRecords(records(0, 1, [-1.0]))
+      self.assertEqual(readRequest(watchdog), 'run')
+      # the run is stopped, later levels are not
+      watchdog.onRecords(records(1, 1, [-1.0, -1.0, -1.0, -1.0, -1.0]))
+      self.assertEqual(watchdog.stoppedLevels, [(0, 1)])
+      self.assertEqual(readRequest(watchdog), 'run')
+    finally:
+      watchdog.cleanup()
+    self.delayDisplay('Test passed!')
+
+  def test_coreScheduler(self):
+    """ Split the cores across concurrent jobs with a fixed number of threads per job or shared equally.
+    """
+    from antsRegistrationLib.scheduling import CoreScheduler
+    scheduler = CoreScheduler(totalCores=64, threadsPerJob=8)
+    self.assertEqual([scheduler.allocate(jobID, 16) for jobID in range(9)], [8] * 8 + [0])
+    self.assertEqual(scheduler.freeCores, 0)
+    scheduler.release(3)
+    self.assertEqual(scheduler.allocate(8), 8)
+
+    scheduler = CoreScheduler(totalCores=64)
+    self.assertEqual(scheduler.allocate('single'), 64)
+    self.assertEqual(scheduler.allocate('queued'), 0)
+    scheduler.release('single')
+    # the jobs that can be started now share the free cores
+    self.assertEqual([scheduler.allocate(jobID, 4 - jobID) for jobID in range(4)], [16, 16, 16, 16])
+    self.assertEqual(scheduler.allocatedCores, 64)
+
+    scheduler = CoreScheduler(totalCores=16, minThreadsPerJob=6)
+    self.assertEqual(scheduler.allocate('a', 4), 8)
+    self.assertEqual(scheduler.allocate('b', 3), 8)
+    self.assertFalse(scheduler.canStartJob())
+    self.assertEqual(scheduler.allocate('c', 2), 0)
+    scheduler.release('a')
+    scheduler.release('a')
+    self.assertEqual(scheduler.freeCores, 8)
+    self.delayDisplay('Test passed!')
+
+  def test_commandBuilder(self):
+    """ Build the antsRegistrationCLI parameters of a preset on files, without MRML nodes.
+    """
+    from antsRegistrationLib.command import setPresetInputs
+    from antsRegistrationLib.runner import AntsRegistrationRunner
+    presetParameters = setPresetInputs(PresetManager().getPresetParametersByName('QuickSyN'), '/data/fixed.nrrd', '/data/moving.nrrd')
+    outputSettings = {'transform': '/output/Composite.h5', 'volume': '/output/warped.nrrd', 'interpolation': 'Linear'}
+    runner = AntsRegistrationRunner('antsRegistrationCLI')
+    parameters = runner.getCLIParameters(presetParameters['stages'], outputSettings, presetParameters['initialTransformSettings'],
+                                         presetParameters['generalSettings'])
+
+    self.assertEqual(parameters['inputVolume01'], '/data/fixed.nrrd')
+    self.assertEqual(parameters['inputVolume02'], '/data/moving.nrrd')
+    self.assertNotIn('inputVolume03', parameters)
+    self.assertEqual(parameters['outputCompositeTransform'], '/output/Composite.h5')
+    self.assertEqual(parameters['outputVolume'], '/output/warped.nrrd')
+    self.assertTrue(parameters['useFloat'])
+    antsCommand = parameters['antsCommand']
+    self.assertTrue(antsCommand.startswith('--dimensionality 3 --use-histogram-matching 0 --winsorize-image-intensities [0.005,0.995] --float $useFloat'))
+    self.assertIn(' --output [$outputBase,$outputVolume]', antsCommand)
+    self.assertIn(' --initial-moving-transform [$inputVolume01,$inputVolume02,1]', antsCommand)
+    self.assertIn(' --transform SyN[0.1,3,0] --metric MI[$inputVolume01,$inputVolume02,1,32]', antsCommand)
+    self.assertIn(' --convergence [1000x500x250x0,1e-6,10] --smoothing-sigmas 4x3x2x1vox --shrink-factors 12x8x4x2', antsCommand)
+    self.assertEqual(antsCommand.count('--transform '), 3)
+    self.assertNotIn('--masks', antsCommand)
+
+    commandLine = runner.getCommandLine(parameters)
+    self.assertEqual(commandLine[0], 'antsRegistrationCLI')
+    self.assertEqual(commandLine[commandLine.index('--inputVolume01') + 1], '/data/fixed.nrrd')
+    self.assertIn('--useFloat', commandLine)
+
+    presetParameters['stages'][2]['metrics'][0]['type'] = 'MutualInformation'
+    with self.assertRaises(ValueError):
+      runner.getCLIParameters(presetParameters['stages'], outputSettings)
+    self.delayDisplay('Test passed!')
+
+  def test_commandBuilderInputVolumeList(self):
+    """ Pass the inputs beyond the 20 declared by the cli in an input volume list file.
+    """
+    import tempfile
+    import shutil
+    from antsRegistrationLib.backends import JobManifest
+    from antsRegistrationLib.command import AntsCommandBuilder, readInputVolumeList, writeInputVolumeList
+    from antsRegistrationLib.runner import AntsRegistrationRunner
+    presetParameters = PresetManager().getPresetParametersByName('Rigid')
+    stage = presetParameters['stages'][0]
+    # 12 channels, 24 inputs, some with commas in their path
+    channelFiles = [('/data/fixed,%i.nrrd' % channel, '/data/moving %i.nrrd' % channel) for channel in range(12)]
+    stage['metrics'] = [dict(stage['metrics'][0], fixed=fixed, moving=moving) for fixed, moving in channelFiles]
+    outputSettings = {'transform': '/output/Composite.h5', 'volume': None, 'interpolation': 'Linear'}
+    parameters = AntsRegistrationRunner('antsRegistrationCLI').getCLIParameters(presetParameters['stages'], outputSettings)
+
+    inputFiles = [filePath for channel in channelFiles for filePath in channel]
+    self.assertEqual([parameters['inputVolume%02i' % index] for index in range(1, 21)], inputFiles[:20])
+    self.assertNotIn('inputVolume21', parameters)
+    self.assertEqual(parameters['inputVolumeList'], inputFiles[20:])
+    self.assertIn('--metric MI[$inputFile1,$inputFile2,', parameters['antsCommand'])
+    self.assertIn('--metric MI[$inputFile3,$inputFile4,', parameters['antsCommand'])
+    self.assertEqual(sorted(JobManifest('job', parameters).getInputFiles()), sorted(inputFiles))
+
+    # an input used again keeps its placeholder
+    commandBuilder = AntsCommandBuilder()
+    placeholders = [commandBuilder.getPlaceholder(filePath) for filePath in inputFiles]
+    self.assertEqual(commandBuilder.getPlaceholder(inputFiles[22]), placeholders[22])
+    self.assertEqual(placeholders[22], '$inputFile3')
+    self.assertEqual(commandBuilder.inputFiles, inputFiles[20:])
+
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      listFile = writeInputVolumeList(inputFiles[20:], directory)
+      self.assertEqual(readInputVolumeList(listFile), inputFiles[20:])
+      self.assertEqual(writeInputVolumeList(inputFiles[20:], directory), listFile)
+      self.assertNotEqual(writeInputVolumeList(inputFiles[21:], directory), listFile)
+      manifest = JobManifest(directory, dict(parameters, inputVolumeList=listFile))
+      self.assertEqual(sorted(manifest.getInputFiles()), sorted(inputFiles + [listFile]))
+    finally:
+      shutil.rmtree(directory)
+    self.assertEqual(JobManifest(directory, {'inputVolumeList': listFile}).getInputFiles(), [listFile])
+    self.delayDisplay('Test passed!')
+
+  def test_validateStages(self):
+    """ Report every problem of the stages, accepting the optional settings antsRegistration takes.
+    """
+    from antsRegistrationLib.command import setPresetInputs
+    from antsRegistrationLib.validation import validateStages
+    stages = setPresetInputs(PresetManager().getPresetParametersByName('QuickSyN'), 'fixed.nrrd', 'moving.nrrd')['stages']
+    self.assertEqual(validateStages(stages), [])
+    self.assertEqual(validateStages([]), ['No registration stage'])
+
+    # trailing optional settings: gradient filter of the metrics, spline order of the transforms
+    stages[0]['metrics'][0]['settings'] = '1,32,Regular,0.25,1'
+    stages[1]['metrics'][0]['settings'] = '1,32,,,true'
+    stages[2]['transformParameters'] = {'transform': 'BSplineSyN', 'settings': '0.1,26x26x26,0,3'}
+    self.assertEqual(validateStages(stages), [])
+
+    stages[0]['transformParameters']['settings'] = ''
+    stages[0]['metrics'][0]['settings'] = '1,32,Regular,0.25,1,1'
+    stages[1]['metrics'][0]['settings'] = '1,32,Sparse,1.5'
+    stages[1]['metrics'][0]['moving'] = None
+    stages[2]['levels']['steps'][1]['shrinkFactors'] = 0
+    stages[2]['levels']['smoothingSigmasUnit'] = 'voxels'
+    self.assertEqual(validateStages(stages), [
+      'Stage 1: Rigid gradientStep is required',
+      'Stage 1: metric 1: MI 6 settings given, at most 5 expected',
+      'Stage 2: metric 1: MI samplingStrategy must be one of None, Regular, Random, not Sparse',
+      'Stage 2: metric 1: MI samplingPercentage must be in [0,1], not 1.5',
+      'Stage 2: metric 1: no moving image',
+      'Stage 3: level 2: shrinkFactors must be an integer >= 1, not 0',
+      'Stage 3: smoothing sigmas unit must be one of vox, mm',
+      ])
+
+    stages = [{'transformParameters': {'transform': 'Rigidd', 'settings': '0.1'}, 'metrics': [], 'levels': {}}]
+    self.assertEqual(validateStages(stages), ['Stage 1: unknown transform Rigidd', 'Stage 1: no metric', 'Stage 1: no level'])
+    self.delayDisplay('Test passed!')
+
+  def test_costModel(self):
+    """ Estimate the runtime and memory of presets and fit the calibration to benchmark results.
+    """
+    from antsRegistrationLib.costmodel import RegistrationCostModel
+    quickSyN = PresetManager().getPresetParametersByName('QuickSyN')['stages']
+    rigid = PresetManager().getPresetParametersByName('Rigid')['stages']
+    dimensions = [96, 96, 64]
+    generalSettings = {'numberOfThreads': 4}
+    model = RegistrationCostModel({'numberOfThreads': 4})
+
+    estimate = model.estimate(quickSyN, dimensions, dimensions, generalSettings)
+    self.assertFalse(estimate['calibrated'])
+    self.assertEqual([stage['transform'] for stage in estimate['stages']], ['Rigid', 'Affine', 'SyN'])
+    self.assertAlmostEqual(estimate['runtime'], model.calibration['overheadSeconds'] + sum(stage['runtime'] for stage in estimate['stages']))
+    self.assertEqual(estimate['peakMemoryMB'], max(stage['peakMemoryMB'] for stage in estimate['stages']))
+    # the deformable stage holds vector fields on top of the inputs
+    self.assertGreater(estimate['stages'][2]['peakMemoryMB'], estimate['stages'][0]['peakMemoryMB'])
+    larger = model.estimate(quickSyN, [2 * size for size in dimensions], dimensions, generalSettings)
+    self.assertGreater(larger['runtime'], estimate['runtime'])
+    self.assertGreater(larger['peakMemoryMB'], estimate['peakMemoryMB'])
+    double = model.estimate(quickSyN, dimensions, dimensions, {'numberOfThreads': 4, 'computationPrecision': 'double'})
+    self.assertGreater(double['peakMemoryMB'], estimate['peakMemoryMB'])
+    parallel = model.estimate(quickSyN, dimensions, dimensions, {'numberOfThreads': 8})
+    self.assertAlmostEqual(parallel['stages'][2]['runtime'], estimate['stages'][2]['runtime'] / 2 ** 0.8)
+
+    # benchmark results of a model taking 1e-6 s per work unit and 100 MB + twice the predicted memory
+    results = []
+    for stages in [rigid, quickSyN]:
+      units = sum(model.getWorkUnits(stages, dimensions, dimensions))
+      memoryMB = max(model.getMemoryBytes(stages, dimensions, dimensions, 4)) / (1024.0 * 1024.0)
+      results.append({'status': 'Completed', 'stages': stages, 'precision': 'float', 'wallTime': units * 1e-6, 'peakMemoryMB': 100 + 2 * memoryMB})
+    results.append({'status': 'Failed', 'stages': quickSyN, 'precision': 'float', 'wallTime': 1.0, 'peakMemoryMB': 1.0})
+    benchmarkResults = {'geometry': {'fixed': dimensions, 'moving': dimensions}, 'numberOfThreads': 4, 'results': results}
+    calibration = RegistrationCostModel().calibrate(benchmarkResults)
+    self.assertTrue(calibration['calibrated'])
+    self.assertEqual(calibration['numberOfThreads'], 4)
+    self.assertAlmostEqual(calibration['secondsPerUnit']['float'] / 1e-6, 1.0)
+    # no double precision results, the default ratio is kept
+    self.assertAlmostEqual(calibration['secondsPerUnit']['double'] / 1e-6, 1.5)
+    self.assertAlmostEqual(calibration['memoryScale'], 2.0)
+    self.assertAlmostEqual(calibration['memoryOverheadMB'], 100.0)
+    calibrated = RegistrationCostModel(calibration).estimate(rigid, dimensions, dimensions, generalSettings)
+    self.assertTrue(calibrated['calibrated'])
+    self.assertAlmostEqual(calibrated['runtime'], results[0]['wallTime'])
+    self.assertAlmostEqual(calibrated['peakMemoryMB'], results[0]['peakMemoryMB'])
+
+    with self.assertRaises(ValueError):
+      RegistrationCostModel().calibrate(dict(benchmarkResults, results=results[2:]))
+    self.delayDisplay('Test passed!')
+
+  def test_stageCheckpoints(self):
+    """ Key the checkpoints on the leading stages and resume from the longest stored one.
+    """
+    import os
+    import shutil
+    import tempfile
+    import numpy as np
+    from antsRegistrationLib.batch import copyParameters
+    from antsRegistrationLib.checkpoints import StageCheckpoints
+    from antsRegistrationLib.command import setPresetInputs
+    fixed = slicer.util.addVolumeFromArray(np.arange(20 * 20 * 20, dtype=np.float32).reshape((20, 20, 20)))
+    moving = slicer.util.addVolumeFromArray(np.ones((20, 20, 20), dtype=np.float32))
+    stages = setPresetInputs(PresetManager().getPresetParametersByName('QuickSyN'), fixed, moving)['stages']
+    initialTransformSettings = {'initializationFeature': 1}
+
+    checkpoints = StageCheckpoints(tempfile.mkdtemp(dir=slicer.app.temporaryPath), sizeLimitMB=100)
+    try:
+      keys = checkpoints.getStageKeys(stages, initialTransformSettings, {'numberOfThreads': 4})
+      self.assertEqual(len(set(keys)), 3)
+      # the number of threads does not change the result, the precision does
+      self.assertEqual(checkpoints.getStageKeys(stages, initialTransformSettings, {'numberOfThreads': 8}), keys)
+      self.assertTrue(set(keys).isdisjoint(checkpoints.getStageKeys(stages, initialTransformSettings, {'computationPrecision': 'double'})))
+      self.assertNotEqual(checkpoints.getStageKeys(stages, {'initializationFeature': -1})[0], keys[0])
+      otherSyNStages = copyParameters(stages)
+      otherSyNStages[2]['transformParameters']['settings'] = '0.2,3,0'
+      otherSyNKeys = checkpoints.getStageKeys(otherSyNStages, initialTransformSettings)
+      self.assertEqual(otherSyNKeys[:2], keys[:2])
+      self.assertNotEqual(otherSyNKeys[2], keys[2])
+      emptyInputStages = copyParameters(stages)
+      emptyInputStages[1]['metrics'][0]['moving'] = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+      self.assertIsNone(checkpoints.getStageKeys(emptyInputStages, initialTransformSettings))
+
+      self.assertEqual(checkpoints.getResumeStageCount(None, stages), 0)
+      self.assertEqual(checkpoints.getResumeStageCount(keys, stages), 0)
+      # a run writes the checkpoints of all its stages, the last stage is always computed
+      runDirectory = checkpoints.createRunDirectory(keys)
+      for numberOfStages in range(1, 4):
+        with open(os.path.join(runDirectory, 'stage%i.h5' % numberOfStages), 'w') as checkpointFile:
+          checkpointFile.write('stage%i' % numberOfStages)
+      checkpoints.collectRun(runDirectory)
+      self.assertFalse(os.path.exists(runDirectory))
+      self.assertTrue(all(checkpoints.entries.hasEntry(key) for key in keys))
+      self.assertEqual(checkpoints.getResumeStageCount(keys, stages), 2)
+      self.assertEqual(checkpoints.getResumeStageCount(otherSyNKeys, otherSyNStages), 2)
+      remainingStages, resumeSettings, remainingKeys = checkpoints.resume(otherSyNStages, initialTransformSettings)
+      self.assertEqual(remainingStages, otherSyNStages[2:])
+      self.assertEqual(resumeSettings, {'initialTransformFile': checkpoints.getCheckpointFile(keys[1])})
+      self.assertEqual(remainingKeys, otherSyNKeys[2:])
+
+      # deformable checkpoints are only resumed from when allowed
+      deformableStages = copyParameters(stages)
+      deformableStages[1] = copyParameters(stages[2])
+      deformableKeys = checkpoints.getStageKeys(deformableStages, initialTransformSettings)
+      runDirectory = checkpoints.createRunDirectory(deformableKeys)
+      for numberOfStages in range(1, 3):
+        with open(os.path.join(runDirectory, 'stage%i.h5' % numberOfStages), 'w') as checkpointFile:
+          checkpointFile.write('stage%i' % numberOfStages)
+      checkpoints.collectRun(runDirectory)
+      self.assertEqual(checkpoints.getResumeStageCount(deformableKeys, deformableStages), 2)
+      self.assertEqual(checkpoints.getResumeStageCount(deformableKeys, deformableStages, linearOnly=True), 1)
+
+      # a modified input invalidates all the checkpoints
+      slicer.util.updateVolumeFromArray(moving, np.zeros((20, 20, 20), dtype=np.float32))
+      self.assertTrue(set(keys).isdisjoint(checkpoints.getStageKeys(stages, initialTransformSettings)))
+    finally:
+      checkpoints.purge()
+    self.delayDisplay('Test passed!')
+
+  def test_sweepGrid(self):
+    """ Expand a parameter grid into one copy of the stages per combination.
+    """
+    from antsRegistrationLib.sweep import expandGrid, setStageParameter
+    stages = PresetManager().getPresetParametersByName('QuickSyN')['stages']
+
+    setStageParameter(stages, '2.transform.totalFieldVarianceInVoxelSpace', 0.5)
+    self.assertEqual(stages[2]['transformParameters']['settings'], '0.1,3,0.5')
+    # missing settings are filled with the defaults
+    setStageParameter(stages, '2.metrics.0.samplingPercentage', 0.1)
+    self.assertEqual(stages[2]['metrics'][0]['settings'], '1,32,Random,0.1')
+    setStageParameter(stages, '*.metrics.0.numberOfBins', 64)
+    self.assertEqual([stage['metrics'][0]['settings'].split(',')[1] for stage in stages], ['64', '64', '64'])
+    # a schedule with more levels repeats the last one
+    setStageParameter(stages, '0.levels.shrinkFactors', '8x4x2x1x1')
+    self.assertEqual([step['shrinkFactors'] for step in stages[0]['levels']['steps']], [8, 4, 2, 1, 1])
+    self.assertEqual(stages[0]['levels']['steps'][4]['smoothingSigmas'], 1)
+    setStageParameter(stages, '0.levels.smoothingSigmas', '2x1.5')
+    self.assertEqual([step['smoothingSigmas'] for step in stages[0]['levels']['steps']], [2, 1.5])
+    setStageParameter(stages, '1.levels.convergenceThreshold', '8')
+    self.assertEqual(stages[1]['levels']['convergenceThreshold'], 8)
+    for path in ['3.transform.gradientStep', '0.transform.numberOfBins', '0.levels.iterations', '0.masks.fixed']:
+      with self.assertRaises(ValueError):
+        setStageParameter(stages, path, 1)
+
+    grid = {'2.transform.gradientStep': [0.1, 0.2, 0.3], '*.levels.convergenceWindowSize': [5, 10]}
+    combinations = expandGrid(stages, grid)
+    self.assertEqual([combination for combination, _ in combinations],
+                     [{'2.transform.gradientStep': step, '*.levels.convergenceWindowSize': window} for step in [0.1, 0.2, 0.3] for window in [5, 10]])
+    for combination, combinationStages in combinations:
+      self.assertEqual(combinationStages[2]['transformParameters']['settings'].split(',')[0], str(combination['2.transform.gradientStep']))
+      self.assertEqual([stage['levels']['convergenceWindowSize'] for stage in combinationStages], [combination['*.levels.convergenceWindowSize']] * 3)
+    # the stages are copied
+    self.assertEqual(stages[2]['transformParameters']['settings'], '0.1,3,0.5')
+    self.assertEqual(stages[0]['levels']['convergenceWindowSize'], 10)
+    self.assertIsNot(combinations[0][1][0]['levels'], combinations[1][1][0]['levels'])
+    self.delayDisplay('Test passed!')
+
+  def test_quickLookStages(self):
+    """ Truncate the stages to their coarsest levels for the quick look and warm start the full run from its linear stages.
+    """
+    import os
+    import shutil
+    import tempfile
+    from antsRegistrationLib.quicklook import QuickLookRegistration, getNumberOfLeadingLinearStages, getQuickLookStages
+    parameters = PresetManager().getPresetParametersByName('QuickSyN')
+    stages = parameters['stages']
+    def getIterations(stages):
+      return [[step['convergence'] for step in stage['levels']['steps']] for stage in stages]
+
+    quickStages = getQuickLookStages(stages)
+    self.assertEqual(getIterations(quickStages), [[200], [200], [20]])
+    self.assertEqual([stage['levels']['steps'][0]['shrinkFactors'] for stage in quickStages], [12, 12, 10])
+    # at least minimumIterations, never more than the full schedule
+    self.assertEqual(getIterations(getQuickLookStages(stages, 2, 0.05)), [[50, 25], [50, 25], [10, 10]])
+    self.assertEqual(getIterations(getQuickLookStages(stages, 4, 0.2, minimumIterations=300))[0], [300, 300, 250, 0])
+    self.assertEqual(getIterations(getQuickLookStages(stages, 0)), getIterations(quickStages))
+    self.assertEqual(getIterations(stages)[0], [1000, 500, 250, 0])
+    self.assertEqual(getNumberOfLeadingLinearStages(stages), 2)
+
+    quickLook = QuickLookRegistration(None, parameters)
+    quickLook.checkpointDirectory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      quickLookParameters = quickLook.getQuickLookParameters()
+      self.assertEqual(getIterations(quickLookParameters['stages']), getIterations(quickStages))
+      self.assertFalse(quickLookParameters['useCheckpoints'])
+      self.assertEqual(quickLookParameters['checkpointDirectory'], quickLook.checkpointDirectory)
+      self.assertIsNone(quickLookParameters['outputSettings']['inverseTransform'])
+      self.assertIs(quickLookParameters['outputSettings']['volume'], parameters['outputSettings']['volume'])
+      # the full run starts from the linear stages of the quick look once they are written
+      self.assertEqual(quickLook.getFullParameters()['initialTransformSettings'], parameters['initialTransformSettings'])
+      warmStartFile = os.path.join(quickLook.checkpointDirectory, 'stage2.h5')
+      open(warmStartFile, 'w').close()
+      fullParameters = quickLook.getFullParameters()
+      self.assertEqual(fullParameters['initialTransformSettings'], {'initialTransformFile': warmStartFile})
+      self.assertIs(fullParameters['stages'], stages)
+    finally:
+      shutil.rmtree(quickLook.checkpointDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_updateTemplateShape(self):
+    """ Move the template along the inverse of the average displacement, in the voxel axes of its grid.
+    """
+    import numpy as np
+    from antsRegistrationLib.template import updateTemplateShape
+    shape = (6, 7, 8)
+    kji = np.indices(shape, dtype=float)
+    # intensity ramps along i (R) and k (S)
+    averageImage = kji[2] + 10 * kji[0]
+    def getDisplacement(ras):
+      return np.tile(np.array(ras, dtype=float), shape + (1,))
+
+    identity = np.eye(4)
+    np.testing.assert_allclose(updateTemplateShape(averageImage, getDisplacement([0, 0, 0]), identity), averageImage)
+    # the subjects are 2 mm to the right: half a step moves the template 1 voxel to the right
+    updated = updateTemplateShape(averageImage, getDisplacement([2, 0, 0]), identity, gradientStep=0.5)
+    np.testing.assert_allclose(updated[:, :, 1:], averageImage[:, :, :-1])
+    # coordinates are clamped to the grid
+    np.testing.assert_allclose(updated[:, :, 0], averageImage[:, :, 0])
+    np.testing.assert_allclose(updateTemplateShape(averageImage, getDisplacement([0, 0, 4]), np.diag([2, 2, 2, 1]), gradientStep=0.5)[1:],
+                               averageImage[:-1])
+    # i axis pointing left
+    flipped = updateTemplateShape(averageImage, getDisplacement([2, 0, 0]), np.diag([-1, 1, 1, 1]), gradientStep=0.5)
+    np.testing.assert_allclose(flipped[:, :, :-1], averageImage[:, :, 1:])
+    # linear interpolation between voxels
+    halfVoxel = updateTemplateShape(averageImage, getDisplacement([1, 0, 0]), identity, gradientStep=0.5)
+    np.testing.assert_allclose(halfVoxel[:, :, 1:], averageImage[:, :, 1:] - 0.5)
+
+    integerImage = averageImage.astype(np.int16)
+    self.assertEqual(updateTemplateShape(integerImage, getDisplacement([2, 0, 0]), identity).dtype, np.int16)
+    self.delayDisplay('Test passed!')
+
+  def test_transformApplication(self):
+    """ Pass the volumes to resample in an apply volume list, label maps and segmentations with GenericLabel interpolation.
+    """
+    import os
+    import shutil
+    import numpy as np
+    from antsRegistrationLib.apply import TransformApplication
+    from antsRegistrationLib.staging import InputStager
+    volume = slicer.util.addVolumeFromArray(np.arange(10 * 10 * 10, dtype=np.float32).reshape((10, 10, 10)), name='volume, with comma')
+    labels = np.zeros((10, 10, 10), dtype=np.int16)
+    labels[2:5] = 1
+    labels[6:9] = 2
+    labelmap = slicer.util.addVolumeFromArray(labels, nodeClassName='vtkMRMLLabelMapVolumeNode')
+    segmentation = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmap, segmentation)
+    bsplineOutput = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+
+    inputStager = InputStager()
+    transformApplication = TransformApplication([volume, labelmap, segmentation,
+                                                 {'input': volume, 'output': bsplineOutput, 'interpolation': 'BSpline'}], inputStager)
+    try:
+      self.assertEqual([node.GetClassName() for node in transformApplication.outputNodes],
+                       ['vtkMRMLScalarVolumeNode', 'vtkMRMLLabelMapVolumeNode', 'vtkMRMLSegmentationNode', 'vtkMRMLScalarVolumeNode'])
+      self.assertIs(transformApplication.outputNodes[3], bsplineOutput)
+      cliParams = transformApplication.addCLIParameters({'antsCommand': ''})
+      self.assertNotIn('applyInputVolumes', cliParams)
+      with open(cliParams['applyVolumeList'], encoding='utf-8') as infile:
+        lines = [line.rstrip('\n').split('\t') for line in infile]
+      self.assertEqual([line[2] for line in lines], ['Linear', 'GenericLabel', 'GenericLabel', 'BSpline'])
+      self.assertEqual([line[1] for line in lines], transformApplication.outputFiles)
+      # volumes are staged once, segmentations are exported as label maps next to the outputs
+      self.assertEqual(lines[0][0], lines[3][0])
+      self.assertEqual(os.path.dirname(lines[0][0]), inputStager.stagingDirectory)
+      self.assertEqual(os.path.dirname(lines[2][0]), transformApplication.directory)
+      self.assertTrue(all(os.path.isfile(line[0]) for line in lines))
+
+      # resampling with the identity: the outputs are the inputs
+      for inputFile, outputFile, interpolation in lines:
+        shutil.copyfile(inputFile, outputFile)
+      transformApplication.loadOutputs()
+      self.assertEqual(transformApplication.errorText, '')
+      np.testing.assert_array_equal(slicer.util.arrayFromVolume(transformApplication.outputNodes[1]), labels)
+      outputSegmentation = transformApplication.outputNodes[2].GetSegmentation()
+      self.assertEqual(outputSegmentation.GetNumberOfSegments(), 2)
+      self.assertEqual(outputSegmentation.GetSegmentIDs(), segmentation.GetSegmentation().GetSegmentIDs())
+    finally:
+      transformApplication.cleanup()
+      inputStager.cleanup()
+    self.assertFalse(os.path.exists(cliParams['applyVolumeList']))
+    self.delayDisplay('Test passed!')
+
+  def test_executionBackends(self):
+    """ Execute job manifests from a spool directory with a stub runner, a cancelled job keeping its status.
+    """
+    import os
+    import sys
+    import shlex
+    import shutil
+    import tempfile
+    from antsRegistrationLib.backends import JobManifest, SpoolDirectoryBackend, SpoolWorker, BatchSchedulerBackend, runJob
+
+    class StubRunner:
+      def __init__(self):
+        self.parameters = []
+      def runParameters(self, parameters, onOutput):
+        self.parameters.append(parameters)
+        onOutput('Stage 0\n')
+        if parameters['antsCommand'] == 'fail':
+          raise RuntimeError('stub failure')
+        with open(parameters['outputCompositeTransform'], 'w') as outfile:
+          outfile.write('transform')
+
+    directory = tempfile.mkdtemp(prefix='ants backends ', dir=slicer.app.temporaryPath)
+    try:
+      inputFile = os.path.join(directory, 'fixed.nrrd')
+      with open(inputFile, 'w') as outfile:
+        outfile.write('volume')
+      def createManifest(name, antsCommand='register'):
+        jobDirectory = os.path.join(directory, name)
+        return JobManifest(jobDirectory, {'antsCommand': antsCommand, 'inputVolume01': inputFile,
+                                          'outputCompositeTransform': os.path.join(jobDirectory, 'Composite.h5')})
+
+      manifest = createManifest('job0')
+      manifest.write()
+      readManifest = JobManifest.read(manifest.jobDirectory)
+      self.assertEqual(readManifest.jobID, manifest.jobID)
+      self.assertEqual(readManifest.parameters, manifest.parameters)
+      self.assertEqual(readManifest.getInputFiles(), [inputFile])
+      self.assertEqual(readManifest.getOutputFiles(), {'outputCompositeTransform': manifest.parameters['outputCompositeTransform']})
+      self.assertEqual(readManifest.getStatus(), {'status': JobManifest.SUBMITTED})
+
+      spoolDirectory = os.path.join(directory, 'spool')
+      backend = SpoolDirectoryBackend(spoolDirectory)
+      manifests = [createManifest('job%i' % index, antsCommand) for index, antsCommand in enumerate(['register', 'fail', 'register'])]
+      for manifest in manifests:
+        backend.submit(manifest)
+      # a cancelled job is not executed, and keeps its status when a worker finishes it anyway
+      backend.cancel(manifests[2])
+      self.assertEqual(manifests[2].getStatus()['status'], JobManifest.CANCELLED)
+      self.assertFalse(manifests[2].setStatus(JobManifest.COMPLETED))
+      self.assertEqual(manifests[2].getStatus()['status'], JobManifest.CANCELLED)
+      runner = StubRunner()
+      self.assertFalse(runJob(manifests[2].jobDirectory, runner))
+      self.assertEqual(runner.parameters, [])
+
+      # each pending job is claimed by one worker only
+      firstWorker, secondWorker = SpoolWorker(spoolDirectory, runner), SpoolWorker(spoolDirectory, runner)
+      claimedFiles = [firstWorker.claimNextJob(), secondWorker.claimNextJob()]
+      self.assertEqual(sorted(os.path.basename(claimedFile) for claimedFile in claimedFiles),
+                       sorted(manifest.jobID + '.job' for manifest in manifests[:2]))
+      self.assertIsNone(firstWorker.claimNextJob())
+      for fileName in os.listdir(os.path.join(spoolDirectory, SpoolDirectoryBackend.CLAIMED)):
+        os.replace(os.path.join(spoolDirectory, SpoolDirectoryBackend.CLAIMED, fileName),
+                   os.path.join(spoolDirectory, SpoolDirectoryBackend.PENDING, fileName))
+      self.assertEqual(firstWorker.runPendingJobs(), 2)
+      self.assertEqual(len(os.listdir(os.path.join(spoolDirectory, SpoolDirectoryBackend.DONE))), 2)
+      self.assertEqual(manifests[0].getStatus()['status'], JobManifest.COMPLETED)
+      self.assertTrue(os.path.isfile(manifests[0].parameters['outputCompositeTransform']))
+      with open(manifests[0].logFile) as infile:
+        self.assertEqual(infile.read(), 'Stage 0\n')
+      self.assertEqual(manifests[1].getStatus()['status'], JobManifest.FAILED)
+      self.assertEqual(manifests[1].getStatus()['errorText'], 'stub failure')
+      backend.cancel(manifests[0])
+      self.assertEqual(manifests[0].getStatus()['status'], JobManifest.COMPLETED)
+
+      # job directories with spaces are passed to the submit command as one argument
+      countArguments = shlex.quote(sys.executable) + ' -c "import sys; print(len(sys.argv))" {jobDirectory}/scheduler.txt {logFile}'
+      schedulerBackend = BatchSchedulerBackend(submitCommand=countArguments, cancelCommand='')
+      manifest = createManifest('scheduler job')
+      schedulerBackend.submit(manifest)
+      self.assertEqual(schedulerBackend._schedulerJobIDs[manifest.jobID], '3')
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_registrationCache(self):
+    """ Key the cached results on the command and the input voxels, and evict the least recently used ones beyond the size limit.
+    """
+    import os
+    import json
+    import shutil
+    import tempfile
+    import numpy as np
+    from antsRegistrationLib.cache import RegistrationCache
+    fixed = slicer.util.addVolumeFromArray(np.arange(10 * 10 * 10, dtype=np.float32).reshape((10, 10, 10)))
+    moving = slicer.util.addVolumeFromArray(np.ones((10, 10, 10), dtype=np.float32))
+    outputTransform = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+    cliParams = {'antsCommand': '--transform Rigid[0.1] --metric MI[$inputVolume01,$inputVolume02,1,32]',
+                 'inputVolume01': fixed.GetID(), 'inputVolume02': moving.GetID(),
+                 'outputCompositeTransform': outputTransform.GetID(), 'numberOfThreads': 4}
+
+    cache = RegistrationCache(tempfile.mkdtemp(dir=slicer.app.temporaryPath), sizeLimitMB=1)
+    try:
+      key = cache.getKeyFromCLIParameters(cliParams)
+      self.assertIsNotNone(key)
+      # the key does not depend on the instance or the number of threads
+      self.assertEqual(RegistrationCache(cache.cacheDirectory, sizeLimitMB=1).getKeyFromCLIParameters(dict(cliParams, numberOfThreads=8)), key)
+      self.assertNotEqual(cache.getKeyFromCLIParameters(dict(cliParams, antsCommand=cliParams['antsCommand'] + ' --float 1')), key)
+      self.assertNotEqual(cache.getKeyFromCLIParameters(dict(cliParams, useFloat=False)), key)
+      self.assertNotEqual(cache.getKeyFromCLIParameters(dict(cliParams, outputVolume=fixed.GetID())), key)
+      self.assertIsNone(cache.getKeyFromCLIParameters(dict(cliParams, controlFile='control.txt')))
+      self.assertIsNone(cache.getKeyFromCLIParameters(dict(cliParams, inputVolume03='vtkMRMLScalarVolumeNodeMissing')))
+
+      self.assertFalse(cache.hasEntry(key))
+      self.assertFalse(cache.loadResult(key, cliParams))
+      cache.storeResult(key, cliParams)
+      self.assertTrue(cache.hasEntry(key))
+      self.assertTrue(cache.loadResult(key, cliParams))
+      # new voxels, new key
+      slicer.util.updateVolumeFromArray(moving, np.full((10, 10, 10), 2, dtype=np.float32))
+      movedKey = cache.getKeyFromCLIParameters(cliParams)
+      self.assertNotEqual(movedKey, key)
+      self.assertFalse(cache.loadResult(movedKey, cliParams))
+
+      # entries of 400 kB each, used in the order of their names
+      cache.purge()
+      for index, name in enumerate(['first', 'second', 'third']):
+        entryDirectory = cache.getEntryDirectory(name)
+        os.makedirs(entryDirectory)
+        with open(os.path.join(entryDirectory, 'entry.json'), 'w') as entryFile:
+          json.dump({'outputs': [], 'files': {}}, entryFile)
+        with open(os.path.join(entryDirectory, 'padding'), 'wb') as paddingFile:
+          paddingFile.write(bytes(400 * 1024))
+        os.utime(entryDirectory, (1000 * (index + 1), 1000 * (index + 1)))
+      self.assertTrue(cache.loadResult('first', {}))
+      cache.evict()
+      self.assertEqual([cache.hasEntry(name) for name in ['first', 'second', 'third']], [True, False, True])
+      self.assertLessEqual(cache.getSize(), cache.sizeLimitBytes)
+    finally:
+      shutil.rmtree(cache.cacheDirectory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
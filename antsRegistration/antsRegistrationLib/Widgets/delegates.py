@@ -42,6 +42,11 @@ class TextEditDelegate(qt.QItemDelegate):
 
   def setModelData(self, editor, model, index):
     model.setData(index, editor.text)
+    name = model.data(index.siblingAtColumn(0))
+    subClass = antsBase().getSubClassByName(name)
+    errors = subClass.validateSettings(editor.text) if subClass else []
+    model.setData(index, '\n'.join(errors) if errors else None, qt.Qt.ToolTipRole)
+    model.setData(index, qt.QBrush(qt.Qt.red) if errors else None, qt.Qt.ForegroundRole)
 
 
 class MRMLComboDelegate(qt.QItemDelegate):
@@ -0,0 +1,107 @@
+import qt
+
+
+class JobQueuePanel(qt.QWidget):
+  """
+  Lists the running, queued and finished jobs of a JobQueue with their elapsed times.
+  The selected job can be cancelled or moved in the queue by changing its priority.
+  """
+
+  COLUMNS = ['Name', 'Status', 'Priority', 'Elapsed (s)']
+
+  def __init__(self, jobQueue):
+    qt.QWidget.__init__(self)
+    self.jobQueue = jobQueue
+    self._shownJobs = []
+
+    self.table = qt.QTableWidget(0, len(self.COLUMNS))
+    self.table.setHorizontalHeaderLabels(self.COLUMNS)
+    self.table.horizontalHeader().setStretchLastSection(True)
+    self.table.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.table.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.table.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.table.setFixedHeight(130)
+
+    self.cancelButton = qt.QPushButton('Cancel')
+    self.cancelButton.toolTip = 'Cancel the selected job.'
+    self.cancelButton.clicked.connect(self.onCancelButton)
+    self.raisePriorityButton = qt.QPushButton('Raise Priority')
+    self.raisePriorityButton.clicked.connect(lambda: self.changeSelectedJobPriority(1))
+    self.lowerPriorityButton = qt.QPushButton('Lower Priority')
+    self.lowerPriorityButton.clicked.connect(lambda: self.changeSelectedJobPriority(-1))
+    self.clearFinishedButton = qt.QPushButton('Clear Finished')
+    self.clearFinishedButton.clicked.connect(self.onClearFinishedButton)
+
+    self.maxConcurrentJobsSpinBox = qt.QSpinBox()
+    self.maxConcurrentJobsSpinBox.setRange(1, 64)
+    self.maxConcurrentJobsSpinBox.value = self.jobQueue.maxConcurrentJobs
+    self.maxConcurrentJobsSpinBox.toolTip = 'Maximum number of registrations running at the same time. Cores are split between them.'
+    self.maxConcurrentJobsSpinBox.connect('valueChanged(int)', self.onMaxConcurrentJobsChanged)
+
+    buttonsLayout = qt.QHBoxLayout()
+    buttonsLayout.addWidget(self.cancelButton)
+    buttonsLayout.addWidget(self.raisePriorityButton)
+    buttonsLayout.addWidget(self.lowerPriorityButton)
+    buttonsLayout.addWidget(self.clearFinishedButton)
+    buttonsLayout.addWidget(qt.QLabel('Concurrent jobs:'))
+    buttonsLayout.addWidget(self.maxConcurrentJobsSpinBox)
+
+    layout = qt.QVBoxLayout(self)
+    layout.addWidget(self.table)
+    layout.addLayout(buttonsLayout)
+
+    # elapsed times of running jobs
+    self._updateTimer = qt.QTimer()
+    self._updateTimer.setInterval(1000)
+    self._updateTimer.connect('timeout()', self.updateJobs)
+
+  def getOrderedJobs(self):
+    """
+    Return running jobs, then queued jobs in their start order, then finished jobs.
+    """
+    return self.jobQueue.getRunningJobs() + self.jobQueue.getQueuedJobs() + self.jobQueue.getFinishedJobs()
+
+  def getSelectedJob(self):
+    row = self.table.currentRow()
+    return self._shownJobs[row] if 0 <= row < len(self._shownJobs) else None
+
+  def updateJobs(self):
+    selectedJob = self.getSelectedJob()
+    self._shownJobs = self.getOrderedJobs()
+    self.table.setRowCount(len(self._shownJobs))
+    for row, job in enumerate(self._shownJobs):
+      for column, value in enumerate([job.name, job.status, str(job.priority), '%.0f' % job.elapsedTime]):
+        item = qt.QTableWidgetItem(value)
+        if job.errorText:
+          item.setToolTip(job.errorText)
+        self.table.setItem(row, column, item)
+    if selectedJob in self._shownJobs:
+      self.table.selectRow(self._shownJobs.index(selectedJob))
+    if self.jobQueue.getRunningJobs():
+      self._updateTimer.start()
+    else:
+      self._updateTimer.stop()
+
+  def onCancelButton(self):
+    job = self.getSelectedJob()
+    if job is not None:
+      self.jobQueue.cancel(job)
+      self.updateJobs()
+
+  def changeSelectedJobPriority(self, change):
+    job = self.getSelectedJob()
+    if job is not None and job.status == job.QUEUED:
+      self.jobQueue.setPriority(job, job.priority + change)
+      self.updateJobs()
+
+  def onClearFinishedButton(self):
+    self.jobQueue.clearFinished()
+    self.updateJobs()
+
+  def onMaxConcurrentJobsChanged(self, value):
+    self.jobQueue.maxConcurrentJobs = value
+    self.jobQueue.launchQueuedJobs()
+    self.updateJobs()
+
+  def cleanup(self):
+    self._updateTimer.stop()
@@ -0,0 +1,81 @@
+import json
+import qt
+
+
+class StagesModel:
+  """
+  In-memory stages list of the module GUI, synchronized with a JSON parameter of the parameter node.
+  GUI edits modify the list in place and are written once edits pause for writeDelay ms, instead of
+  parsing and serializing the whole list on every edit. The parameter is only parsed again when it
+  was modified by something else than this model (script, scene load, preset).
+  """
+
+  def __init__(self, parameterName, writeDelay=300):
+    self.parameterName = parameterName
+    self.parameterNode = None
+    self.stages = []
+    self._text = None  # parameter value the stages were read from or written to
+    self._pending = False
+    self._writeTimer = qt.QTimer()
+    self._writeTimer.setSingleShot(True)
+    self._writeTimer.setInterval(writeDelay)
+    self._writeTimer.connect('timeout()', self.flush)
+
+  def setParameterNode(self, parameterNode):
+    if parameterNode is self.parameterNode:
+      return
+    self.flush()
+    self.parameterNode = parameterNode
+    self.stages = []
+    self._text = None
+
+  def isModifiedOutside(self):
+    """
+    Return True if the parameter holds stages the GUI does not show yet.
+    """
+    if self.parameterNode is None or self._pending:
+      return False  # pending GUI edits are newer
+    return self.parameterNode.GetParameter(self.parameterName) != self._text
+
+  def read(self):
+    """
+    Return the stages, parsing the parameter only if it was modified outside of this model.
+    """
+    if self.isModifiedOutside():
+      self._text = self.parameterNode.GetParameter(self.parameterName)
+      self.stages = json.loads(self._text) if self._text else []
+    return self.stages
+
+  def modified(self):
+    """
+    Schedule writing the stages, after they were modified in place from the GUI.
+    """
+    if self.parameterNode is not None:
+      self._pending = True
+      self._writeTimer.start()
+
+  def flush(self):
+    """
+    Write pending modifications to the parameter node now.
+    """
+    if not self._pending:
+      return
+    self._pending = False
+    self._writeTimer.stop()
+    self._text = json.dumps(self.stages)
+    self.parameterNode.SetParameter(self.parameterName, self._text)
+
+  def replace(self, stages):
+    """
+    Write new stages now. The GUI is refreshed from them as from any modification made outside of the GUI.
+    """
+    self._pending = False
+    self._writeTimer.stop()
+    if self.parameterNode is None:
+      return
+    self._text = None
+    text = json.dumps(stages)
+    if self.parameterNode.GetParameter(self.parameterName) == text:
+      self.parameterNode.Modified()  # unwritten GUI edits are discarded
+    else:
+      self.parameterNode.SetParameter(self.parameterName, text)
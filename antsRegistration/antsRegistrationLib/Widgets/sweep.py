@@ -0,0 +1,122 @@
+import qt, slicer
+
+
+class SweepPanel(qt.QWidget):
+  """
+  Parameter sweep over the current stages: a grid of parameter paths with their values, run concurrently
+  within the cores and ranked on the final metric value. The best stages can be saved as a preset.
+  :param getProcessParameters: callable returning the process parameters of the module (stages, settings)
+  :param saveStagesAsPreset: callable saving a stages list as a preset
+  """
+
+  GRID_COLUMNS = ['Parameter', 'Values']
+  RESULT_COLUMNS = ['Parameters', 'Status', 'Final Metric', 'Wall Time (s)', 'Peak Memory (MB)']
+
+  def __init__(self, logic, getProcessParameters, saveStagesAsPreset):
+    qt.QWidget.__init__(self)
+    self.logic = logic
+    self.getProcessParameters = getProcessParameters
+    self.saveStagesAsPreset = saveStagesAsPreset
+    self.sweep = None
+
+    self.gridTable = qt.QTableWidget(1, len(self.GRID_COLUMNS))
+    self.gridTable.setHorizontalHeaderLabels(self.GRID_COLUMNS)
+    self.gridTable.horizontalHeader().setStretchLastSection(True)
+    self.gridTable.toolTip = "One parameter per row, values separated by spaces. Parameters are '<stage>.transform.<setting>', " \
+                             "'<stage>.metrics.<metric>.<setting>' or '<stage>.levels.<key>' with * for all the stages, " \
+                             "e.g. '*.transform.gradientStep' with values '0.1 0.25' or '0.levels.shrinkFactors' with values '4x2x1 8x4x2x1'."
+    self.gridTable.setFixedHeight(110)
+
+    self.addRowButton = qt.QPushButton('+')
+    self.addRowButton.clicked.connect(lambda: self.gridTable.insertRow(self.gridTable.rowCount))
+    self.removeRowButton = qt.QPushButton('-')
+    self.removeRowButton.clicked.connect(lambda: self.gridTable.removeRow(self.gridTable.currentRow()))
+
+    self.concurrentJobsSpinBox = qt.QSpinBox()
+    self.concurrentJobsSpinBox.setRange(1, 64)
+    self.concurrentJobsSpinBox.value = 2
+    self.concurrentJobsSpinBox.toolTip = 'Maximum number of registrations running at the same time. Cores are split between them.'
+
+    self.runButton = qt.QPushButton('Run Sweep')
+    self.runButton.clicked.connect(self.onRunButton)
+
+    self.resultsTable = qt.QTableWidget(0, len(self.RESULT_COLUMNS))
+    self.resultsTable.setHorizontalHeaderLabels(self.RESULT_COLUMNS)
+    self.resultsTable.horizontalHeader().setStretchLastSection(True)
+    self.resultsTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.resultsTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+
+    self.saveBestButton = qt.QPushButton('Save Best as Preset')
+    self.saveBestButton.enabled = False
+    self.saveBestButton.clicked.connect(self.onSaveBestButton)
+
+    buttonsLayout = qt.QHBoxLayout()
+    buttonsLayout.addWidget(self.addRowButton)
+    buttonsLayout.addWidget(self.removeRowButton)
+    buttonsLayout.addWidget(qt.QLabel('Concurrent jobs:'))
+    buttonsLayout.addWidget(self.concurrentJobsSpinBox)
+
+    layout = qt.QVBoxLayout(self)
+    layout.addLayout(buttonsLayout)
+    layout.addWidget(self.gridTable)
+    layout.addWidget(self.runButton)
+    layout.addWidget(self.resultsTable)
+    layout.addWidget(self.saveBestButton)
+
+  def getGrid(self):
+    grid = {}
+    for row in range(self.gridTable.rowCount):
+      pathItem = self.gridTable.item(row, 0)
+      valuesItem = self.gridTable.item(row, 1)
+      if pathItem is None or not pathItem.text().strip():
+        continue
+      values = valuesItem.text().split() if valuesItem is not None else []
+      if not values:
+        raise ValueError('No values for sweep parameter %s' % pathItem.text().strip())
+      grid[pathItem.text().strip()] = values
+    if not grid:
+      raise ValueError('No sweep parameter')
+    return grid
+
+  def onRunButton(self):
+    if self.sweep is not None and not self.sweep.isFinished():
+      self.sweep.cancel()
+      return
+    parameters = self.getProcessParameters()
+    try:
+      self.sweep = self.logic.processSweep(parameters['stages'], self.getGrid(),
+                                           initialTransformSettings=parameters['initialTransformSettings'],
+                                           generalSettings=parameters['generalSettings'],
+                                           maxConcurrentJobs=self.concurrentJobsSpinBox.value,
+                                           onItemFinished=lambda item: self.updateResults(),
+                                           onFinished=lambda sweep: self.onSweepFinished())
+    except ValueError as e:
+      slicer.util.errorDisplay(str(e))
+      return
+    self.saveBestButton.enabled = False
+    self.runButton.text = 'Cancel Sweep'
+    self.updateResults()
+
+  def onSweepFinished(self):
+    self.runButton.text = 'Run Sweep'
+    self.updateResults()
+    self.saveBestButton.enabled = self.sweep.getWinnerStages() is not None
+
+  def updateResults(self):
+    ranking = self.sweep.getRanking()
+    self.resultsTable.setRowCount(len(ranking))
+    for row, result in enumerate(ranking):
+      values = [result['parameters'], result['status'],
+                '%g' % result['finalMetricValue'] if result['finalMetricValue'] is not None else '',
+                '%.1f' % result['wallTime'],
+                '%.0f' % result['peakMemoryMB'] if result['peakMemoryMB'] is not None else '']
+      for column, value in enumerate(values):
+        item = qt.QTableWidgetItem(value)
+        if result['errorText']:
+          item.setToolTip(result['errorText'])
+        self.resultsTable.setItem(row, column, item)
+
+  def onSaveBestButton(self):
+    stages = self.sweep.getWinnerStages() if self.sweep is not None else None
+    if stages:
+      self.saveStagesAsPreset(stages)
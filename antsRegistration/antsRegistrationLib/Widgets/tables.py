@@ -113,19 +113,19 @@ class CustomTable(qt.QWidget):
     for N,params in enumerate(parameters):
       if N == self.model.rowCount():
         self.addRowAndSetHeight()
-      self.setNthRowGUIFromParameters(N, params)
+      if self.getNthRowParametersFromGUI(N) != params: # only refresh modified rows
+        self.setNthRowGUIFromParameters(N, params)
     while self.model.rowCount()-1 > N:
       self.removeRowAndSetHeight(self.model.rowCount()-1)
 
   def setNthRowGUIFromParameters(self, N, parameters):
     for col,val in enumerate(parameters.values()):
       index = self.model.index(N, col)
-      try: # check if value is mrml node and save as user role
-        node = slicer.util.getNode(val)
-        self.model.setData(index, val, qt.Qt.UserRole)
+      # node IDs are shown with the node name and kept in the user role
+      node = slicer.mrmlScene.GetNodeByID(val) if isinstance(val, str) and val else None
+      self.model.setData(index, val if node else None, qt.Qt.UserRole)
+      if node:
         val = node.GetName()
-      except:
-        pass
       self.model.setData(index, val, qt.Qt.DisplayRole)
 
 
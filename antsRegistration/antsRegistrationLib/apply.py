@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import slicer
+
+from .ioprofiles import getIOProfile
+
+
+def getDefaultInterpolation(node):
+  """
+  Return the antsApplyTransforms interpolation of a node: GenericLabel for label maps and segmentations, Linear otherwise.
+  """
+  if node.IsA('vtkMRMLLabelMapVolumeNode') or node.IsA('vtkMRMLSegmentationNode'):
+    return 'GenericLabel'
+  return 'Linear'
+
+
+class TransformApplication:
+  """
+  Companion volumes resampled on the reference grid by antsRegistrationCLI with the transform it computed or was given,
+  which it reads once for all of them. Segmentations are passed as label maps, one label value per segment, so
+  overlapping segments keep only the last one.
+  :param volumes: list of input nodes, or of dictionaries with 'input' node and optional 'output' node and 'interpolation'.
+    An output node of the class of the input is created when not given, the interpolation is the one of getDefaultInterpolation
+  """
+
+  def __init__(self, volumes, inputStager=None, ioProfile=None):
+    self.volumes = []
+    for volume in volumes:
+      if not isinstance(volume, dict):
+        volume = {'input': volume}
+      inputNode = volume['input']
+      outputNode = volume.get('output')
+      if outputNode is None:
+        outputNode = slicer.mrmlScene.AddNewNodeByClass(inputNode.GetClassName(), inputNode.GetName() + '_resampled')
+      self.volumes.append({'input': inputNode, 'output': outputNode,
+                           'interpolation': volume.get('interpolation') or getDefaultInterpolation(inputNode)})
+    self.inputStager = inputStager
+    self.ioProfile = getIOProfile(ioProfile)
+    self.directory = tempfile.mkdtemp(prefix='antsApply', dir=slicer.app.temporaryPath)
+    self.outputFiles = []
+    self.cliNode = None
+    self.errorText = ''
+
+  @property
+  def outputNodes(self):
+    return [volume['output'] for volume in self.volumes]
+
+  def writeInput(self, node, index):
+    if node.IsA('vtkMRMLSegmentationNode'):
+      labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+      try:
+        slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(node, labelmapNode, slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
+        filePath = os.path.join(self.directory, self.ioProfile.getFileName('input%i' % index))
+        self.ioProfile.writeVolume(labelmapNode, filePath)
+      finally:
+        slicer.mrmlScene.RemoveNode(labelmapNode)
+      return filePath
+    if self.inputStager is not None:
+      return self.inputStager.stageNode(node)
+    filePath = os.path.join(self.directory, self.ioProfile.getFileName('input%i' % index))
+    self.ioProfile.writeVolume(node, filePath)
+    return filePath
+
+  def addCLIParameters(self, cliParams):
+    """
+    Write the inputs and add their apply parameters to the antsRegistrationCLI parameters.
+    """
+    inputFiles = [self.writeInput(volume['input'], index) for index, volume in enumerate(self.volumes)]
+    self.outputFiles = [os.path.join(self.directory, self.ioProfile.getFileName('output%i' % index)) for index in range(len(self.volumes))]
+    cliParams['applyVolumeList'] = self.writeVolumeList(inputFiles)
+    return cliParams
+
+  def writeVolumeList(self, inputFiles):
+    """
+    Write the applyVolumeList file of antsRegistrationCLI, one tab separated input file, output file and interpolation
+    per line, and return its path.
+    """
+    filePath = os.path.join(self.directory, 'applyVolumes.txt')
+    with open(filePath, 'w', encoding='utf-8') as outfile:
+      for inputFile, outputFile, volume in zip(inputFiles, self.outputFiles, self.volumes):
+        outfile.write('%s\t%s\t%s\n' % (inputFile, outputFile, volume['interpolation']))
+    return filePath
+
+  def loadOutputs(self):
+    """
+    Read the resampled volumes into the output nodes. Segmentations get the segments of their input.
+    """
+    for volume, filePath in zip(self.volumes, self.outputFiles):
+      outputNode = volume['output']
+      if not outputNode.IsA('vtkMRMLSegmentationNode'):
+        if not self.ioProfile.readVolume(outputNode, filePath):
+          self.errorText = 'Unable to read %s' % filePath
+        continue
+      labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+      try:
+        if not self.ioProfile.readVolume(labelmapNode, filePath):
+          self.errorText = 'Unable to read %s' % filePath
+          continue
+        self.importSegments(volume['input'], outputNode, labelmapNode)
+      finally:
+        slicer.mrmlScene.RemoveNode(labelmapNode)
+
+  @staticmethod
+  def importSegments(inputNode, outputNode, labelmapNode):
+    import vtk
+    if outputNode is not inputNode:
+      outputNode.GetSegmentation().DeepCopy(inputNode.GetSegmentation())
+    outputNode.SetReferenceImageGeometryParameterFromVolumeNode(labelmapNode)
+    # label values were given in segment order
+    segmentIDs = vtk.vtkStringArray()
+    inputNode.GetSegmentation().GetSegmentIDs(segmentIDs)
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, outputNode, segmentIDs)
+
+  def cleanup(self):
+    if self.directory is not None:
+      shutil.rmtree(self.directory, ignore_errors=True)
+      self.directory = None
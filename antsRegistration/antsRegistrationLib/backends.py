@@ -0,0 +1,375 @@
+"""
+Execution backends for antsRegistrationCLI jobs described by self-contained manifests.
+Does not depend on Slicer, so that jobs can be executed on compute nodes with:
+  python -m antsRegistrationLib.backends run <jobDirectory>
+  python -m antsRegistrationLib.backends spool <spoolDirectory> [--once]
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import signal
+import platform
+import uuid
+import argparse
+import subprocess
+
+from .command import readInputVolumeList
+from .runner import AntsRegistrationRunner
+
+
+class JobManifest:
+  """
+  Self-contained description of a registration job: the antsRegistrationCLI parameters (command and
+  file paths), the input files it reads and the output files it is expected to write.
+  The manifest, log and status files are kept in the job directory, which must be reachable from
+  both the submitting machine and the machine executing the job.
+  """
+
+  MANIFEST_FILE_NAME = 'manifest.json'
+  STATUS_FILE_NAME = 'status.json'
+  LOG_FILE_NAME = 'log.txt'
+
+  SUBMITTED = 'Submitted'
+  RUNNING = 'Running'
+  COMPLETED = 'Completed'
+  FAILED = 'Failed'
+  CANCELLED = 'Cancelled'
+
+  def __init__(self, jobDirectory, parameters, inputs=None, outputs=None, jobID=None):
+    self.jobDirectory = os.path.abspath(jobDirectory)
+    self.parameters = parameters
+    self.inputs = inputs if inputs is not None else []
+    self.outputs = outputs if outputs is not None else {}
+    self.jobID = jobID if jobID else uuid.uuid4().hex[:12]
+
+  @classmethod
+  def fromFiles(cls, jobDirectory, stages, outputSettings, initialTransformSettings=None, generalSettings=None):
+    """
+    Create the manifest of a preset run on files, see AntsRegistrationRunner.
+    """
+    runner = AntsRegistrationRunner(executable=AntsRegistrationRunner.EXECUTABLE_NAME)
+    parameters = runner.getCLIParameters(stages, outputSettings, initialTransformSettings, generalSettings)
+    return cls(jobDirectory, parameters)
+
+  @property
+  def manifestFile(self):
+    return os.path.join(self.jobDirectory, self.MANIFEST_FILE_NAME)
+
+  @property
+  def statusFile(self):
+    return os.path.join(self.jobDirectory, self.STATUS_FILE_NAME)
+
+  @property
+  def logFile(self):
+    return os.path.join(self.jobDirectory, self.LOG_FILE_NAME)
+
+  def getInputFiles(self):
+    inputs = list(self.inputs)
+    for name, value in self.parameters.items():
+      if name == 'inputVolumeList':
+        # a list file written by NodeCommandBuilder, or the list of files of AntsCommandBuilder
+        if isinstance(value, str):
+          inputs.append(value)
+          value = readInputVolumeList(value) if os.path.isfile(value) else []
+        inputs += value
+      elif name.startswith('inputVolume') or name in ['inputTransform', 'initialTransformFile', 'nativeReferenceVolume', 'nativeMovingVolume']:
+        inputs.append(value)
+    return sorted(set(inputs))
+
+  def getOutputFiles(self):
+    outputs = dict(self.outputs)
+    for name in ['outputCompositeTransform', 'outputDisplacementField', 'outputVolume',
+                 'outputInverseCompositeTransform', 'outputInverseVolume']:
+      if name in self.parameters:
+        outputs.setdefault(name, self.parameters[name])
+    return outputs
+
+  def toDict(self):
+    return {
+      'jobID': self.jobID,
+      'parameters': self.parameters,
+      'inputs': self.getInputFiles(),
+      'outputs': self.getOutputFiles(),
+      }
+
+  def write(self):
+    os.makedirs(self.jobDirectory, exist_ok=True)
+    with open(self.manifestFile, 'w') as outfile:
+      json.dump(self.toDict(), outfile, indent=2)
+    if os.path.isfile(self.statusFile):
+      # job directory submitted again
+      os.remove(self.statusFile)
+    self.setStatus(self.SUBMITTED)
+
+  @classmethod
+  def read(cls, jobDirectory):
+    with open(os.path.join(jobDirectory, cls.MANIFEST_FILE_NAME)) as infile:
+      manifest = json.load(infile)
+    return cls(jobDirectory, manifest['parameters'], manifest['inputs'], manifest['outputs'], manifest['jobID'])
+
+  def getStatus(self):
+    """
+    Return the status dictionary of the job: 'status', 'host' once running and 'errorText' and 'elapsedTime' once finished.
+    """
+    try:
+      with open(self.statusFile) as infile:
+        return json.load(infile)
+    except (OSError, ValueError):
+      return {'status': self.SUBMITTED}
+
+  def setStatus(self, status, **info):
+    """
+    Write the status of the job. A finished job keeps its status, so that a worker finishing a cancelled job
+    does not report it as completed or failed. Return False if the status was not changed.
+    """
+    if self.isFinished():
+      return False
+    info['status'] = status
+    temporaryFile = self.statusFile + '.tmp'
+    with open(temporaryFile, 'w') as outfile:
+      json.dump(info, outfile)
+    os.replace(temporaryFile, self.statusFile)
+    return True
+
+  def isFinished(self):
+    return self.getStatus()['status'] in [self.COMPLETED, self.FAILED, self.CANCELLED]
+
+
+def runJob(jobDirectory, runner=None):
+  """
+  Execute the job of a manifest, writing its log and status to the job directory. Return True on success.
+  """
+  manifest = JobManifest.read(jobDirectory)
+  if manifest.getStatus()['status'] == JobManifest.CANCELLED:
+    return False
+  runner = runner if runner else AntsRegistrationRunner()
+  missingInputs = [filePath for filePath in manifest.getInputFiles() if not os.path.isfile(filePath)]
+  if missingInputs:
+    manifest.setStatus(JobManifest.FAILED, errorText='Missing inputs: ' + ', '.join(missingInputs))
+    return False
+  if not manifest.setStatus(JobManifest.RUNNING, host=platform.node()):
+    return False  # cancelled meanwhile
+  startTime = time.time()
+  with open(manifest.logFile, 'w') as logFile:
+    def onOutput(line):
+      logFile.write(line)
+      logFile.flush()
+    try:
+      runner.runParameters(manifest.parameters, onOutput)
+    except Exception as e:
+      manifest.setStatus(JobManifest.FAILED, errorText=str(e), elapsedTime=time.time() - startTime)
+      return False
+  manifest.setStatus(JobManifest.COMPLETED, elapsedTime=time.time() - startTime)
+  return True
+
+
+class ExecutionBackend:
+  """
+  Base class of the backends executing job manifests. Job status is always read back from the job directory.
+  """
+
+  def __init__(self, pythonExecutable=None):
+    self.pythonExecutable = pythonExecutable if pythonExecutable else sys.executable
+
+  def getWorkerCommandLine(self, manifest):
+    """
+    Return the command line executing the manifest with the job runner of this module.
+    """
+    return [self.pythonExecutable, '-m', 'antsRegistrationLib.backends', 'run', manifest.jobDirectory]
+
+  def getWorkerEnvironment(self):
+    modulesDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, [modulesDirectory, environment.get('PYTHONPATH')]))
+    return environment
+
+  def submit(self, manifest):
+    raise NotImplementedError
+
+  def cancel(self, manifest):
+    if not manifest.isFinished():
+      manifest.setStatus(JobManifest.CANCELLED)
+
+
+class LocalProcessBackend(ExecutionBackend):
+  """
+  Executes each job in a local process. The worker and the antsRegistrationCLI it starts run in their own
+  process group, which is killed as a whole when the job is cancelled.
+  """
+
+  def __init__(self, pythonExecutable=None):
+    ExecutionBackend.__init__(self, pythonExecutable)
+    self._processes = {}  # jobID: subprocess.Popen
+
+  def submit(self, manifest):
+    manifest.write()
+    if platform.system() == 'Windows':
+      processGroupArguments = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+      processGroupArguments = {'start_new_session': True}
+    self._processes[manifest.jobID] = subprocess.Popen(self.getWorkerCommandLine(manifest), env=self.getWorkerEnvironment(),
+                                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                                       **processGroupArguments)
+    return manifest.jobID
+
+  def cancel(self, manifest):
+    # status first, so that the killed worker does not report the job as failed
+    ExecutionBackend.cancel(self, manifest)
+    process = self._processes.pop(manifest.jobID, None)
+    if process is not None and process.poll() is None:
+      self.killProcessGroup(process)
+
+  @staticmethod
+  def killProcessGroup(process):
+    if platform.system() == 'Windows':
+      # the whole tree of the worker, including antsRegistrationCLI
+      subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+      try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+      except ProcessLookupError:
+        return
+      except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+
+
+class BatchSchedulerBackend(ExecutionBackend):
+  """
+  Submits each job to a batch scheduler. The submit command is formatted with the job ID, the job directory,
+  the log file path and the worker command; the scheduler job ID is read from the last word of its output.
+  The paths are quoted and the worker command is a quoted shell command line. Defaults are for SLURM.
+  """
+
+  def __init__(self, submitCommand='sbatch --parsable --job-name {jobID} --output {jobDirectory}/scheduler.txt --wrap {command}',
+               cancelCommand='scancel {schedulerJobID}', pythonExecutable=None):
+    ExecutionBackend.__init__(self, pythonExecutable)
+    self.submitCommand = submitCommand
+    self.cancelCommand = cancelCommand
+    self._schedulerJobIDs = {}  # jobID: scheduler job ID
+
+  def submit(self, manifest):
+    manifest.write()
+    workerCommand = ' '.join(shlex.quote(argument) for argument in self.getWorkerCommandLine(manifest))
+    modulesDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    workerCommand = 'PYTHONPATH=%s %s' % (shlex.quote(modulesDirectory), workerCommand)
+    submitCommand = self.submitCommand.format(jobID=manifest.jobID, jobDirectory=shlex.quote(manifest.jobDirectory),
+                                              logFile=shlex.quote(manifest.logFile), command=shlex.quote(workerCommand))
+    result = subprocess.run(shlex.split(submitCommand), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    if result.returncode != 0:
+      manifest.setStatus(JobManifest.FAILED, errorText=result.stdout)
+      raise RuntimeError('Job submission failed: %s' % result.stdout)
+    output = result.stdout.split()
+    self._schedulerJobIDs[manifest.jobID] = output[-1].split(';')[0] if output else ''
+    return manifest.jobID
+
+  def cancel(self, manifest):
+    schedulerJobID = self._schedulerJobIDs.pop(manifest.jobID, None)
+    if schedulerJobID and not manifest.isFinished():
+      subprocess.run(shlex.split(self.cancelCommand.format(schedulerJobID=schedulerJobID)))
+    ExecutionBackend.cancel(self, manifest)
+
+
+class SpoolDirectoryBackend(ExecutionBackend):
+  """
+  Stands in for a batch scheduler: jobs are queued as files in a spool directory and executed
+  by any number of SpoolWorker processes watching it.
+  """
+
+  PENDING = 'pending'
+  CLAIMED = 'claimed'
+  DONE = 'done'
+
+  def __init__(self, spoolDirectory):
+    ExecutionBackend.__init__(self)
+    self.spoolDirectory = spoolDirectory
+    for subdirectory in [self.PENDING, self.CLAIMED, self.DONE]:
+      os.makedirs(os.path.join(spoolDirectory, subdirectory), exist_ok=True)
+
+  def submit(self, manifest):
+    manifest.write()
+    temporaryFile = os.path.join(self.spoolDirectory, manifest.jobID + '.tmp')
+    with open(temporaryFile, 'w') as outfile:
+      outfile.write(manifest.jobDirectory)
+    os.replace(temporaryFile, os.path.join(self.spoolDirectory, self.PENDING, manifest.jobID + '.job'))
+    return manifest.jobID
+
+  def cancel(self, manifest):
+    pendingFile = os.path.join(self.spoolDirectory, self.PENDING, manifest.jobID + '.job')
+    if os.path.isfile(pendingFile):
+      os.remove(pendingFile)
+    ExecutionBackend.cancel(self, manifest)
+
+
+class SpoolWorker:
+  """
+  Executes the jobs queued in a spool directory. Jobs are claimed by an atomic rename so that
+  several workers can share the same directory.
+  """
+
+  def __init__(self, spoolDirectory, runner=None):
+    self.spoolDirectory = spoolDirectory
+    self.runner = runner
+
+  def claimNextJob(self):
+    pendingDirectory = os.path.join(self.spoolDirectory, SpoolDirectoryBackend.PENDING)
+    for fileName in sorted(os.listdir(pendingDirectory), key=lambda f: os.path.getmtime(os.path.join(pendingDirectory, f))):
+      claimedFile = os.path.join(self.spoolDirectory, SpoolDirectoryBackend.CLAIMED, fileName)
+      try:
+        os.rename(os.path.join(pendingDirectory, fileName), claimedFile)
+      except OSError:
+        continue  # claimed by another worker
+      return claimedFile
+    return None
+
+  def runPendingJobs(self):
+    """
+    Execute pending jobs until there is none left. Return the number of jobs executed.
+    """
+    numberOfJobs = 0
+    claimedFile = self.claimNextJob()
+    while claimedFile is not None:
+      with open(claimedFile) as infile:
+        jobDirectory = infile.read().strip()
+      runJob(jobDirectory, self.runner)
+      os.replace(claimedFile, os.path.join(self.spoolDirectory, SpoolDirectoryBackend.DONE, os.path.basename(claimedFile)))
+      numberOfJobs += 1
+      claimedFile = self.claimNextJob()
+    return numberOfJobs
+
+  def runForever(self, pollInterval=5.0):
+    while True:
+      if not self.runPendingJobs():
+        time.sleep(pollInterval)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Execute antsRegistrationCLI job manifests.')
+  subparsers = parser.add_subparsers(dest='mode')
+  runParser = subparsers.add_parser('run', help='execute the job of a job directory')
+  runParser.add_argument('jobDirectory')
+  spoolParser = subparsers.add_parser('spool', help='execute the jobs queued in a spool directory')
+  spoolParser.add_argument('spoolDirectory')
+  spoolParser.add_argument('--once', action='store_true', help='exit once there are no pending jobs')
+  spoolParser.add_argument('--poll-interval', type=float, default=5.0)
+  args = parser.parse_args(argv)
+
+  if args.mode == 'run':
+    return 0 if runJob(args.jobDirectory) else 1
+  elif args.mode == 'spool':
+    worker = SpoolWorker(args.spoolDirectory)
+    if args.once:
+      worker.runPendingJobs()
+    else:
+      worker.runForever(args.poll_interval)
+    return 0
+  parser.print_help()
+  return 1
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
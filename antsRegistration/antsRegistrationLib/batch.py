@@ -0,0 +1,294 @@
+import os
+import time
+import slicer
+
+from .staging import InputStager
+from .scheduling import CoreScheduler
+
+
+def copyParameters(value):
+  """
+  Copy nested dicts and lists of registration parameters. Other values (MRML nodes, strings, numbers)
+  are kept by reference, as MRML nodes can not be deep copied.
+  """
+  if isinstance(value, dict):
+    return {key: copyParameters(val) for key, val in value.items()}
+  if isinstance(value, list):
+    return [copyParameters(val) for val in value]
+  return value
+
+
+class BatchItem:
+  """
+  A moving volume registered as part of a batch, with its status, timing and outputs.
+  """
+
+  QUEUED = 'Queued'
+  RUNNING = 'Running'
+  COMPLETED = 'Completed'
+  FAILED = 'Failed'
+  CANCELLED = 'Cancelled'
+
+  def __init__(self, moving, index):
+    self.moving = moving
+    self.index = index
+    self.name = self.getNameFromMoving(moving, index)
+    self.status = self.QUEUED
+    self.cliNode = None
+    self.cliParams = {}
+    self.startTime = None
+    self.endTime = None
+    self.outputs = {}
+    self.errorText = ''
+    self.fromCache = False
+    self.numberOfThreads = 0
+    self.estimatedMemoryMB = None
+    self.telemetry = None
+    self._observerTag = None
+
+  @staticmethod
+  def getNameFromMoving(moving, index):
+    if isinstance(moving, str):
+      name = os.path.basename(moving)
+      for extension in ['.nii.gz', '.seg.nrrd', '.nrrd', '.nii', '.nhdr', '.mha', '.mhd']:
+        if name.endswith(extension):
+          return name[:-len(extension)]
+      return os.path.splitext(name)[0]
+    return moving.GetName() if moving else 'item%03i' % index
+
+  @property
+  def elapsedTime(self):
+    if self.startTime is None:
+      return 0.0
+    return (self.endTime if self.endTime is not None else time.time()) - self.startTime
+
+  def isFinished(self):
+    return self.status in [self.COMPLETED, self.FAILED, self.CANCELLED]
+
+  def toDict(self):
+    return {
+      'name': self.name,
+      'moving': self.moving if isinstance(self.moving, str) else self.moving.GetID(),
+      'status': self.status,
+      'elapsedTime': self.elapsedTime,
+      'outputs': {key: (val if isinstance(val, str) else val.GetID()) for key, val in self.outputs.items()},
+      'errorText': self.errorText,
+      'fromCache': self.fromCache,
+      'numberOfThreads': self.numberOfThreads,
+      'estimatedMemoryMB': self.estimatedMemoryMB,
+      }
+
+
+class BatchRegistration:
+  """
+  Runs one registration preset for a list of moving volumes against the same fixed volume.
+  Registrations are launched as antsRegistrationCLI nodes, at most maxConcurrentJobs at a time,
+  and the scheduler decides how many threads each of them gets. With memoryLimitMB set, an item is only
+  launched if the peak memory predicted by the cost model for it and the running items fits in the limit.
+  """
+
+  DEFAULT_OUTPUT_CLASSES = {'transform': 'vtkMRMLTransformNode', 'volume': 'vtkMRMLScalarVolumeNode',
+                            'inverseTransform': 'vtkMRMLTransformNode', 'inverseVolume': 'vtkMRMLScalarVolumeNode'}
+  OUTPUT_NAME_SUFFIXES = [('transform', 'Transform'), ('volume', 'Warped'),
+                          ('inverseTransform', 'InverseTransform'), ('inverseVolume', 'InverseWarped')]
+
+  def __init__(self, logic, stages, outputSettings, movingVolumes, initialTransformSettings=None, generalSettings=None,
+               maxConcurrentJobs=1, outputDirectory=None, onItemFinished=None, useCache=False, useStaging=None,
+               scheduler=None, earlyTermination=None, memoryLimitMB=None, costModel=None):
+    self.logic = logic
+    self.stages = stages
+    self.outputSettings = outputSettings
+    self.initialTransformSettings = initialTransformSettings if initialTransformSettings is not None else {}
+    self.generalSettings = generalSettings if generalSettings is not None else {}
+    self.maxConcurrentJobs = max(1, int(maxConcurrentJobs))
+    self.outputDirectory = outputDirectory
+    self.onItemFinished = onItemFinished
+    self.useCache = useCache
+    if useStaging is None:
+      # volumes are handed over in memory to an in process cli, staging them would only add disk writes
+      useStaging = not logic.isCLIInProcess()
+    self.inputStager = InputStager() if useStaging else None
+    self.scheduler = scheduler if scheduler is not None else CoreScheduler()
+    self.earlyTermination = earlyTermination
+    self.memoryLimitMB = memoryLimitMB
+    self.costModel = costModel
+    if memoryLimitMB and costModel is None:
+      from .costmodel import RegistrationCostModel
+      self.costModel = RegistrationCostModel.load()
+    self.items = [BatchItem(moving, index) for index, moving in enumerate(movingVolumes)]
+    self._templateMoving = stages[0]['metrics'][0]['moving']
+    self._cancelled = False
+    self._launching = False
+
+  def start(self):
+    if self.outputDirectory and not os.path.isdir(self.outputDirectory):
+      os.makedirs(self.outputDirectory)
+    self.launchQueuedItems()
+
+  def wait(self, pollInterval=0.1):
+    while not self.isFinished():
+      slicer.app.processEvents()
+      time.sleep(pollInterval)
+
+  def cancel(self):
+    self._cancelled = True
+    for item in self.items:
+      if item.status == BatchItem.QUEUED:
+        # reported and cleaned up like the items that ran, the last one finishes the batch if none is running
+        self.finishItem(item, BatchItem.CANCELLED)
+      elif item.status == BatchItem.RUNNING:
+        item.cliNode.Cancel()
+
+  def isFinished(self):
+    return all(item.isFinished() for item in self.items)
+
+  def getRunningItems(self):
+    return [item for item in self.items if item.status == BatchItem.RUNNING]
+
+  def getQueuedItems(self):
+    return [item for item in self.items if item.status == BatchItem.QUEUED]
+
+  def getSummary(self):
+    return [item.toDict() for item in self.items]
+
+  def launchQueuedItems(self):
+    if self._launching:
+      # an item finished while being launched, the running loop goes on with the next ones
+      return
+    self._launching = True
+    try:
+      self._launchQueuedItems()
+    finally:
+      self._launching = False
+
+  def _launchQueuedItems(self):
+    while not self._cancelled and self.getQueuedItems() and len(self.getRunningItems()) < self.maxConcurrentJobs:
+      if not self.logic.canStartCLI():
+        self.logic.callWhenCLICanStart(self.launchQueuedItems)
+        break
+      queuedItems = self.getQueuedItems()
+      numberOfStartableItems = min(len(queuedItems), self.maxConcurrentJobs - len(self.getRunningItems()))
+      item = queuedItems[0]
+      if not self.canAdmitItem(item):
+        break
+      item.numberOfThreads = self.scheduler.allocate(id(item), numberOfStartableItems)
+      if not item.numberOfThreads:
+        break
+      self.launchItem(item)
+
+  def canAdmitItem(self, item):
+    """
+    Return True if the predicted peak memory of item and of the running items fits in the memory limit.
+    The first item is always admitted, so that a batch whose items exceed the limit still runs one at a time.
+    """
+    if not self.memoryLimitMB:
+      return True
+    if item.estimatedMemoryMB is None:
+      try:
+        item.estimatedMemoryMB = self.estimateItemMemoryMB(item)
+      except Exception:
+        return True  # the item fails once launched
+    runningItems = self.getRunningItems()
+    if not runningItems:
+      return True
+    return sum(running.estimatedMemoryMB or 0 for running in runningItems) + item.estimatedMemoryMB <= self.memoryLimitMB
+
+  def estimateItemMemoryMB(self, item):
+    from .costmodel import getDimensions
+    movingNode = self.getMovingNode(item)
+    stages = self.getItemStages(movingNode)
+    return self.costModel.estimate(stages, getDimensions(stages[0]['metrics'][0]['fixed']), getDimensions(movingNode),
+                                   self.generalSettings)['peakMemoryMB']
+
+  def launchItem(self, item):
+    item.startTime = time.time()
+    try:
+      movingNode = self.getMovingNode(item)
+      outputSettings = self.createItemOutputSettings(item)
+      generalSettings = copyParameters(self.generalSettings)
+      generalSettings['numberOfThreads'] = item.numberOfThreads
+      item.cliParams = dict(self.logic.createCLIParameters(self.getItemStages(movingNode), outputSettings,
+                                                           copyParameters(self.initialTransformSettings),
+                                                           generalSettings, self.inputStager))
+      watchdog = self.logic.createPlateauWatchdog(item.cliParams, self.earlyTermination) if self.earlyTermination else None
+    except Exception as e:
+      item.errorText = str(e)
+      self.finishItem(item, BatchItem.FAILED)
+      return
+    item.status = BatchItem.RUNNING
+    item.cliNode = self.logic.runCLI(item.cliParams, useCache=self.useCache)
+    item.telemetry = self.logic.createTelemetry(item.cliNode, watchdog=watchdog)
+    if item.cliNode is None:
+      item.fromCache = True
+      self.saveItemOutputs(item)
+      self.finishItem(item, BatchItem.COMPLETED)
+      return
+    item._observerTag = item.cliNode.AddObserver('ModifiedEvent', lambda caller, event, item=item: self.onItemStatusUpdate(item))
+
+  def getMovingNode(self, item):
+    if isinstance(item.moving, str):
+      item.moving = slicer.util.loadVolume(item.moving, {'show': False})
+    return item.moving
+
+  def getItemStages(self, movingNode):
+    stages = copyParameters(self.stages)
+    for stage in stages:
+      for metric in stage['metrics']:
+        if not metric['moving'] or metric['moving'] == self._templateMoving:
+          metric['moving'] = movingNode
+    return stages
+
+  def createItemOutputSettings(self, item):
+    outputSettings = copyParameters(self.outputSettings)
+    for key, suffix in self.OUTPUT_NAME_SUFFIXES:
+      template = outputSettings.get(key)
+      if not template:
+        outputSettings[key] = None
+        continue
+      if isinstance(template, str):
+        className = template
+      elif hasattr(template, 'GetClassName'):
+        className = template.GetClassName()
+      else:
+        className = self.DEFAULT_OUTPUT_CLASSES[key]
+      outputSettings[key] = slicer.mrmlScene.AddNewNodeByClass(className, '%s_%s' % (item.name, suffix))
+      item.outputs[key] = outputSettings[key]
+    return outputSettings
+
+  def onItemStatusUpdate(self, item):
+    if item.isFinished():
+      return
+    status = item.cliNode.GetStatus()
+    if status & item.cliNode.Cancelled:
+      self.finishItem(item, BatchItem.CANCELLED)
+    elif status & item.cliNode.Completed:
+      if status & item.cliNode.ErrorsMask:
+        item.errorText = item.cliNode.GetErrorText()
+        self.finishItem(item, BatchItem.FAILED)
+      else:
+        self.saveItemOutputs(item)
+        self.finishItem(item, BatchItem.COMPLETED)
+
+  def saveItemOutputs(self, item):
+    if not self.outputDirectory:
+      return
+    extensions = {'transform': '.h5', 'volume': '.nrrd', 'inverseTransform': '.h5', 'inverseVolume': '.nrrd'}
+    for key, node in list(item.outputs.items()):
+      if isinstance(node, str):
+        continue
+      filePath = os.path.join(self.outputDirectory, node.GetName() + extensions[key])
+      if slicer.util.saveNode(node, filePath):
+        item.outputs[key + 'File'] = filePath
+
+  def finishItem(self, item, status):
+    item.status = status
+    item.endTime = time.time()
+    self.scheduler.release(id(item))
+    if item.cliNode is not None and item._observerTag is not None:
+      item.cliNode.RemoveObserver(item._observerTag)
+      item._observerTag = None
+    if self.onItemFinished:
+      self.onItemFinished(item)
+    self.launchQueuedItems()
+    if self.isFinished() and self.inputStager is not None:
+      self.inputStager.cleanup()
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import platform
+
+from .telemetry import AntsLogParser
+
+
+class PresetBenchmark:
+  """
+  Runs registration presets on a local fixed/moving pair and records wall time, peak memory of the
+  CLI process and final metric value for each preset and computation precision. The stages of each
+  preset and the input dimensions are recorded as well to calibrate the RegistrationCostModel.
+  """
+
+  DEFAULT_PRECISIONS = ['float', 'double']
+  RANDOM_SEED = 1234
+
+  def __init__(self, fixedFile, movingFile, presetNames=None, precisions=None, numberOfThreads=0):
+    self.fixedFile = fixedFile
+    self.movingFile = movingFile
+    self.presetNames = presetNames
+    self.precisions = precisions if precisions else self.DEFAULT_PRECISIONS
+    self.numberOfThreads = numberOfThreads
+
+  @staticmethod
+  def getEnvironment():
+    return {
+      'platform': platform.platform(),
+      'processor': platform.processor(),
+      'cpuCount': os.cpu_count(),
+      'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+      }
+
+  def run(self):
+    import slicer
+    from antsRegistration import antsRegistrationLogic, PresetManager
+    presetManager = PresetManager()
+    presetNames = self.presetNames if self.presetNames else sorted(presetManager.getPresetNames())
+    fixed = slicer.util.loadVolume(self.fixedFile, {'show': False})
+    moving = slicer.util.loadVolume(self.movingFile, {'show': False})
+    geometry = {'fixed': list(fixed.GetImageData().GetDimensions()), 'moving': list(moving.GetImageData().GetDimensions())}
+    results = []
+    for presetName in presetNames:
+      for precision in self.precisions:
+        parameters = presetManager.getPresetParametersByName(presetName)
+        results.append(self.runPreset(antsRegistrationLogic(), parameters, fixed, moving, presetName, precision))
+    for node in [fixed, moving]:
+      slicer.mrmlScene.RemoveNode(node)
+    return {'environment': self.getEnvironment(), 'geometry': geometry, 'numberOfThreads': self.numberOfThreads, 'results': results}
+
+  def runPreset(self, logic, parameters, fixed, moving, presetName, precision):
+    import slicer
+    stages = json.loads(json.dumps(parameters['stages']))  # before the inputs are set
+    for stage in parameters['stages']:
+      for metric in stage['metrics']:
+        metric['fixed'] = fixed
+        metric['moving'] = moving
+      stage['masks'] = {'fixed': None, 'moving': None}
+    outputVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+    parameters['outputSettings']['volume'] = outputVolume
+    parameters['outputSettings']['transform'] = None
+    parameters['generalSettings']['computationPrecision'] = precision
+    parameters['generalSettings']['numberOfThreads'] = self.numberOfThreads
+    parameters['generalSettings']['randomSeed'] = self.RANDOM_SEED
+
+    startTime = time.time()
+    cliNode = logic.process(**parameters, wait_for_completion=True).cliNode
+    wallTime = time.time() - startTime
+
+    parser = AntsLogParser()
+    parser.feed(cliNode.GetOutputText() or '')
+    parser.flush()
+    failed = bool(cliNode.GetStatus() & cliNode.ErrorsMask)
+    slicer.mrmlScene.RemoveNode(outputVolume)
+    slicer.mrmlScene.RemoveNode(cliNode)
+    return {
+      'preset': presetName,
+      'precision': precision,
+      'status': 'Failed' if failed else 'Completed',
+      'wallTime': wallTime,
+      'peakMemoryMB': parser.peakMemoryMB,
+      'finalMetricValue': parser.getFinalMetricValue(),
+      'levels': parser.getLevelSummaries(),
+      'stages': stages,
+      }
+
+
+class DisplacementFieldBenchmark:
+  """
+  Compares the direct displacement field output of antsRegistrationCLI with the previous antsApplyTransforms
+  pass: time spent computing the field, total wall time and largest difference between the two fields.
+  Both runs use the same random seed, a single thread makes them bitwise reproducible.
+  """
+
+  METHODS = ['applyTransforms', 'direct']
+
+  def __init__(self, fixedFile, movingFile, presetName='QuickSyN', numberOfThreads=0):
+    self.fixedFile = fixedFile
+    self.movingFile = movingFile
+    self.presetName = presetName
+    self.numberOfThreads = numberOfThreads
+
+  def run(self):
+    import numpy as np
+    import slicer
+    from antsRegistration import antsRegistrationLogic, PresetManager
+    fixed = slicer.util.loadVolume(self.fixedFile, {'show': False})
+    moving = slicer.util.loadVolume(self.movingFile, {'show': False})
+    results = []
+    fields = []
+    for method in self.METHODS:
+      parameters = PresetManager().getPresetParametersByName(self.presetName)
+      for stage in parameters['stages']:
+        for metric in stage['metrics']:
+          metric['fixed'] = fixed
+          metric['moving'] = moving
+        stage['masks'] = {'fixed': None, 'moving': None}
+      transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+      parameters['outputSettings'].update({'transform': transformNode, 'volume': None, 'useDisplacementField': True,
+                                           'displacementFieldMethod': method})
+      parameters['generalSettings']['numberOfThreads'] = self.numberOfThreads
+      parameters['generalSettings']['randomSeed'] = PresetBenchmark.RANDOM_SEED
+      logic = antsRegistrationLogic()
+      startTime = time.time()
+      cliNode = logic.process(**parameters, wait_for_completion=True).cliNode
+      wallTime = time.time() - startTime
+      parser = AntsLogParser()
+      parser.feed(cliNode.GetOutputText() or '')
+      parser.flush()
+      failed = bool(cliNode.GetStatus() & cliNode.ErrorsMask)
+      fields.append(None if failed else np.array(slicer.util.arrayFromGridTransform(transformNode)))
+      results.append({
+        'method': method,
+        'status': 'Failed' if failed else 'Completed',
+        'wallTime': wallTime,
+        'displacementFieldTime': parser.displacementFieldElapsedTime,
+        })
+      slicer.mrmlScene.RemoveNode(transformNode)
+      slicer.mrmlScene.RemoveNode(cliNode)
+    for node in [fixed, moving]:
+      slicer.mrmlScene.RemoveNode(node)
+    maximumDifference = None
+    if all(field is not None for field in fields) and fields[0].shape == fields[1].shape:
+      maximumDifference = float(np.abs(fields[0] - fields[1]).max())
+    return {'environment': PresetBenchmark.getEnvironment(), 'preset': self.presetName,
+            'fieldResults': results, 'maximumDifference': maximumDifference}
+
+
+class IOProfileBenchmark:
+  """
+  Measures write, read and total latency and file size of a volume for each I/O profile in a directory,
+  e.g. to compare a local NVMe disk with network storage.
+  """
+
+  def __init__(self, volumeFile, directory=None, profileNames=None, repeats=3):
+    self.volumeFile = volumeFile
+    self.directory = directory
+    self.profileNames = profileNames
+    self.repeats = max(1, int(repeats))
+
+  def run(self):
+    import shutil
+    import tempfile
+    import slicer
+    from .ioprofiles import IO_PROFILES
+    profileNames = self.profileNames if self.profileNames else list(IO_PROFILES.keys())
+    volumeNode = slicer.util.loadVolume(self.volumeFile, {'show': False})
+    readNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+    directory = tempfile.mkdtemp(prefix='antsIOBenchmark', dir=self.directory)
+    results = []
+    try:
+      for profileName in profileNames:
+        profile = IO_PROFILES[profileName]
+        filePath = os.path.join(directory, profile.getFileName('volume'))
+        writeTimes, readTimes = [], []
+        for repeat in range(self.repeats):
+          startTime = time.time()
+          profile.writeVolume(volumeNode, filePath)
+          writeTimes.append(time.time() - startTime)
+          startTime = time.time()
+          profile.readVolume(readNode, filePath)
+          readTimes.append(time.time() - startTime)
+        results.append({
+          'profile': profileName,
+          'writeTime': min(writeTimes),
+          'readTime': min(readTimes),
+          'totalTime': min(writeTimes) + min(readTimes),
+          'fileSizeMB': os.path.getsize(filePath) / (1024.0 * 1024.0),
+          })
+        os.remove(filePath)
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+      slicer.mrmlScene.RemoveNode(volumeNode)
+      slicer.mrmlScene.RemoveNode(readNode)
+    return {'environment': PresetBenchmark.getEnvironment(), 'directory': self.directory, 'ioResults': results}
+
+
+def getResultKey(result):
+  return (result['preset'], result['precision'])
+
+
+def compareToBaseline(current, baseline, timeTolerance=0.2, memoryTolerance=0.2, metricTolerance=0.05):
+  """
+  Compare benchmark results against a previous baseline. Tolerances are relative.
+  Metric values are minimized by ANTs, so a higher final metric value is a regression.
+  Return a list of regression descriptions, empty when there is none.
+  """
+  baselineResults = {getResultKey(result): result for result in baseline['results']}
+  regressions = []
+  for result in current['results']:
+    name = '%s (%s)' % getResultKey(result)
+    previous = baselineResults.get(getResultKey(result))
+    if previous is None:
+      continue
+    if result['status'] != 'Completed' and previous['status'] == 'Completed':
+      regressions.append('%s: registration failed' % name)
+      continue
+    if previous['wallTime'] and result['wallTime'] > previous['wallTime'] * (1 + timeTolerance):
+      regressions.append('%s: wall time %.1fs > baseline %.1fs' % (name, result['wallTime'], previous['wallTime']))
+    if previous['peakMemoryMB'] and result['peakMemoryMB'] and result['peakMemoryMB'] > previous['peakMemoryMB'] * (1 + memoryTolerance):
+      regressions.append('%s: peak memory %.0fMB > baseline %.0fMB' % (name, result['peakMemoryMB'], previous['peakMemoryMB']))
+    if previous['finalMetricValue'] is not None and result['finalMetricValue'] is not None and \
+        result['finalMetricValue'] > previous['finalMetricValue'] + metricTolerance * abs(previous['finalMetricValue']):
+      regressions.append('%s: final metric value %.4g > baseline %.4g' % (name, result['finalMetricValue'], previous['finalMetricValue']))
+  return regressions
+
+
+def readResults(filePath):
+  with open(filePath) as infile:
+    return json.load(infile)
+
+
+def writeResults(results, filePath):
+  with open(filePath, 'w') as outfile:
+    json.dump(results, outfile, indent=2)
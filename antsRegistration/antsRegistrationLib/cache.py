@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import slicer, vtk
+
+from .command import readInputVolumeList
+from .ioprofiles import getIOProfile
+from .staging import InputStager
+
+
+class RegistrationCache:
+  """
+  On-disk cache of registration results. Entries are keyed on a hash of the antsRegistration command
+  and the voxel data and geometry of every input, and evicted in least recently used order once the
+  cache grows beyond its size limit. Volumes are stored with the given IOProfile.
+  """
+
+  SIZE_LIMIT_SETTING = 'antsRegistration/CacheSizeLimitMB'
+  DEFAULT_SIZE_LIMIT_MB = 2048
+  ENTRY_FILE_NAMES = {
+    'outputCompositeTransform': 'transform.h5',
+    'outputDisplacementField': 'displacementField.nrrd',
+    'outputVolume': 'volume',  # extension of the I/O profile
+    'outputInverseCompositeTransform': 'inverseTransform.h5',
+    'outputInverseVolume': 'inverseVolume',  # extension of the I/O profile
+    }
+
+  _volumeHashes = {}  # nodeID: (modifiedTime, hash), shared across instances
+
+  def __init__(self, cacheDirectory=None, sizeLimitMB=None, ioProfile=None):
+    self.ioProfile = getIOProfile(ioProfile)
+    self.cacheDirectory = cacheDirectory if cacheDirectory else os.path.join(slicer.app.cachePath, 'antsRegistration')
+    if sizeLimitMB is None:
+      sizeLimitMB = slicer.util.settingsValue(self.SIZE_LIMIT_SETTING, self.DEFAULT_SIZE_LIMIT_MB, converter=int)
+    self.sizeLimitBytes = sizeLimitMB * 1024 * 1024
+
+  @staticmethod
+  def getNode(value):
+    if hasattr(value, 'GetID'):
+      return value
+    return slicer.mrmlScene.GetNodeByID(value) if value else None
+
+  def getKeyFromCLIParameters(self, cliParams):
+    """
+    Return the cache key of a antsRegistrationCLI parameters dictionary or None if the inputs can not be hashed.
+    """
+    if cliParams.get('controlFile'):
+      return None  # early terminated results depend on when the stop requests were handled
+    hasher = hashlib.sha256()
+    hasher.update(cliParams['antsCommand'].encode())
+    hasher.update(str(bool(cliParams.get('useFloat', True))).encode())
+    for name in sorted(self.ENTRY_FILE_NAMES.keys()):
+      hasher.update(('%s=%i' % (name, name in cliParams)).encode())
+    for name in sorted(cliParams.keys()):
+      if name == 'inputVolumeList':
+        for index, filePath in enumerate(readInputVolumeList(cliParams[name])):
+          node = self.getNode(InputStager.getStagedNodeID(filePath))
+          if node is None:
+            return None
+          hasher.update(('inputFile%i=%s' % (index + 1, self.getVolumeHash(node))).encode())
+      elif name.startswith('inputVolume') or name in ['nativeReferenceVolume', 'nativeMovingVolume']:
+        node = self.getNode(cliParams[name])
+        if node is None:
+          return None
+        hasher.update(('%s=%s' % (name, self.getVolumeHash(node))).encode())
+      elif name == 'inputTransform':
+        transformHash = self.getLinearTransformHash(self.getNode(cliParams[name]))
+        if transformHash is None:
+          return None
+        hasher.update(('%s=%s' % (name, transformHash)).encode())
+      elif name == 'initialTransformFile':
+        from .checkpoints import StageCheckpoints
+        hasher.update(('%s=%s' % (name, StageCheckpoints.getFileHash(cliParams[name]))).encode())
+    return hasher.hexdigest()
+
+  def getVolumeHash(self, volumeNode):
+    modifiedTime = (volumeNode.GetMTime(), volumeNode.GetImageData().GetMTime())
+    cached = self._volumeHashes.get(volumeNode.GetID())
+    if cached and cached[0] == modifiedTime:
+      return cached[1]
+    import numpy as np
+    hasher = hashlib.sha256()
+    voxels = np.ascontiguousarray(slicer.util.arrayFromVolume(volumeNode))
+    hasher.update(str((voxels.shape, voxels.dtype.str)).encode())
+    hasher.update(memoryview(voxels).cast('B'))
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    hasher.update(str([ijkToRAS.GetElement(i, j) for i in range(4) for j in range(4)]).encode())
+    volumeHash = hasher.hexdigest()
+    self._volumeHashes[volumeNode.GetID()] = (modifiedTime, volumeHash)
+    return volumeHash
+
+  def getLinearTransformHash(self, transformNode):
+    if transformNode is None or not transformNode.IsLinear():
+      return None
+    matrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToParent(matrix)
+    return hashlib.sha256(str([matrix.GetElement(i, j) for i in range(4) for j in range(4)]).encode()).hexdigest()
+
+  def getEntryDirectory(self, key):
+    return os.path.join(self.cacheDirectory, key)
+
+  def hasEntry(self, key):
+    return key is not None and os.path.isfile(os.path.join(self.getEntryDirectory(key), 'entry.json'))
+
+  def loadResult(self, key, cliParams):
+    """
+    Read a cached result into the output nodes of cliParams. Return True on a cache hit.
+    """
+    if not self.hasEntry(key):
+      return False
+    entryDirectory = self.getEntryDirectory(key)
+    with open(os.path.join(entryDirectory, 'entry.json')) as entryFile:
+      fileNames = json.load(entryFile).get('files', {})
+    for name in self.ENTRY_FILE_NAMES.keys():
+      node = self.getNode(cliParams.get(name))
+      if node is None:
+        continue
+      if name not in fileNames:
+        return False
+      storageNode = self.createStorageNode(node, self.ioProfile)
+      storageNode.SetFileName(os.path.join(entryDirectory, fileNames[name]))
+      if not storageNode.ReadData(node):
+        return False
+    os.utime(entryDirectory)  # mark as recently used
+    return True
+
+  def storeResult(self, key, cliParams):
+    """
+    Write the output nodes of a completed registration into the cache.
+    """
+    if key is None:
+      return
+    entryDirectory = self.getEntryDirectory(key)
+    os.makedirs(entryDirectory, exist_ok=True)
+    fileNames = {}
+    for name, fileName in self.ENTRY_FILE_NAMES.items():
+      node = self.getNode(cliParams.get(name))
+      if node is None:
+        continue
+      if name in ['outputVolume', 'outputInverseVolume']:
+        fileName = self.ioProfile.getFileName(fileName)
+      storageNode = self.createStorageNode(node, self.ioProfile)
+      storageNode.SetFileName(os.path.join(entryDirectory, fileName))
+      if not storageNode.WriteData(node):
+        shutil.rmtree(entryDirectory, ignore_errors=True)
+        return
+      fileNames[name] = fileName
+    with open(os.path.join(entryDirectory, 'entry.json'), 'w') as entryFile:
+      json.dump({'outputs': list(fileNames.keys()), 'files': fileNames, 'created': time.time(), 'command': cliParams['antsCommand']}, entryFile)
+    self.evict()
+
+  @staticmethod
+  def createStorageNode(node, ioProfile=None):
+    if node.IsA('vtkMRMLTransformNode'):
+      return slicer.vtkMRMLTransformStorageNode()
+    return getIOProfile(ioProfile if ioProfile else 'raw').createVolumeStorageNode()
+
+  def getEntries(self):
+    """
+    Return a list of (lastUsedTime, sizeInBytes, directory) sorted from least to most recently used.
+    """
+    if not os.path.isdir(self.cacheDirectory):
+      return []
+    entries = []
+    for name in os.listdir(self.cacheDirectory):
+      directory = os.path.join(self.cacheDirectory, name)
+      if not os.path.isdir(directory):
+        continue
+      size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+      entries.append((os.path.getmtime(directory), size, directory))
+    return sorted(entries)
+
+  def getSize(self):
+    return sum(entry[1] for entry in self.getEntries())
+
+  def evict(self):
+    entries = self.getEntries()
+    totalSize = sum(entry[1] for entry in entries)
+    for lastUsedTime, size, directory in entries:
+      if totalSize <= self.sizeLimitBytes:
+        break
+      shutil.rmtree(directory, ignore_errors=True)
+      totalSize -= size
+
+  def purge(self):
+    shutil.rmtree(self.cacheDirectory, ignore_errors=True)
@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import slicer
+
+from .cache import RegistrationCache
+from .command import AntsCommandBuilder
+
+
+LINEAR_TRANSFORMS = ['Rigid', 'Affine', 'CompositeAffine', 'Similarity', 'Translation']
+
+
+class StageCheckpoints:
+  """
+  On-disk checkpoints of the composite transform computed by the leading stages of a registration.
+  A checkpoint is keyed on the inputs and general settings of the run and the stages up to it, so that a
+  later run whose leading stages match starts from it through --initial-moving-transform and only
+  computes the remaining stages. The patched antsRegistration writes the checkpoints of a run to a run
+  directory, collected into the entries once the run finished, or by the next run if it never did.
+  Entries are evicted in least recently used order like the RegistrationCache.
+  """
+
+  SIZE_LIMIT_SETTING = 'antsRegistration/CheckpointSizeLimitMB'
+  DEFAULT_SIZE_LIMIT_MB = 4096
+  TRANSFORM_FILE_NAME = 'transform.h5'
+
+  _activeRunDirectories = set()  # run directories of this process, shared across instances
+
+  def __init__(self, checkpointDirectory=None, sizeLimitMB=None):
+    self.checkpointDirectory = checkpointDirectory if checkpointDirectory else os.path.join(slicer.app.cachePath, 'antsRegistrationCheckpoints')
+    if sizeLimitMB is None:
+      sizeLimitMB = slicer.util.settingsValue(self.SIZE_LIMIT_SETTING, self.DEFAULT_SIZE_LIMIT_MB, converter=int)
+    self.entries = RegistrationCache(os.path.join(self.checkpointDirectory, 'entries'), sizeLimitMB)
+    self.runsDirectory = os.path.join(self.checkpointDirectory, 'runs')
+
+  def getStageKeys(self, stages, initialTransformSettings=None, generalSettings=None):
+    """
+    Return the checkpoint key of every stage prefix (the key of stages[:k] at index k-1), or None if the inputs can not be hashed.
+    """
+    initialTransformSettings = initialTransformSettings if initialTransformSettings else {}
+    generalSettings = dict(generalSettings) if generalSettings else {}
+    generalSettings.pop('numberOfThreads', None)
+    hasher = hashlib.sha256()
+    hasher.update(AntsCommandBuilder().getGeneralSettingsCommand(**generalSettings).encode())
+    hasher.update(str(generalSettings.get('computationPrecision', 'float')).encode())
+    initialTransformHash = self.getInitialTransformHash(stages, initialTransformSettings)
+    if initialTransformHash is None:
+      return None
+    hasher.update(initialTransformHash.encode())
+    keys = []
+    for stage in stages:
+      try:
+        stageDescription = json.dumps(stage, sort_keys=True, default=self.getInputHash)
+      except ValueError:
+        return None
+      hasher.update(stageDescription.encode())
+      keys.append(hasher.copy().hexdigest())
+    return keys
+
+  def getInputHash(self, value):
+    node = self.entries.getNode(value)
+    if node is None or node.GetImageData() is None:
+      raise ValueError('Unable to hash %s' % value)
+    return self.entries.getVolumeHash(node)
+
+  def getInitialTransformHash(self, stages, initialTransformSettings):
+    if initialTransformSettings.get('initialTransformFile'):
+      return self.getFileHash(initialTransformSettings['initialTransformFile'])
+    if initialTransformSettings.get('initialTransformNode') is not None:
+      return self.entries.getLinearTransformHash(self.entries.getNode(initialTransformSettings['initialTransformNode']))
+    initializationFeature = initialTransformSettings.get('initializationFeature', -1)
+    if initializationFeature < 0:
+      return 'identity'
+    # computed from the inputs of the first metric
+    metric = stages[0]['metrics'][0]
+    return '%i,%s,%s' % (initializationFeature, self.getInputHash(metric['fixed']), self.getInputHash(metric['moving']))
+
+  @staticmethod
+  def getFileHash(filePath):
+    hasher = hashlib.sha256()
+    with open(filePath, 'rb') as transformFile:
+      for chunk in iter(lambda: transformFile.read(1024 * 1024), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+  def getCheckpointFile(self, key):
+    return os.path.join(self.entries.getEntryDirectory(key), self.TRANSFORM_FILE_NAME)
+
+  def getResumeStageCount(self, keys, stages, linearOnly=False):
+    """
+    Return the number of leading stages with a checkpoint. The last stage is always computed.
+    :param linearOnly: only resume across linear stages, as deformable ones are read back without their inverse
+    """
+    if keys is None:
+      return 0
+    self.collectRuns()
+    for numberOfStages in range(len(stages) - 1, 0, -1):
+      if linearOnly and any(stage['transformParameters']['transform'] not in LINEAR_TRANSFORMS for stage in stages[:numberOfStages]):
+        continue
+      if self.entries.hasEntry(keys[numberOfStages - 1]):
+        os.utime(self.entries.getEntryDirectory(keys[numberOfStages - 1]))  # mark as recently used
+        return numberOfStages
+    return 0
+
+  def resume(self, stages, initialTransformSettings=None, generalSettings=None, linearOnly=False):
+    """
+    Return the stages left to compute, the initial transform settings starting from the longest matching checkpoint,
+    and the checkpoint keys of the stages left to compute (None if the inputs can not be hashed).
+    """
+    keys = self.getStageKeys(stages, initialTransformSettings, generalSettings)
+    numberOfStages = self.getResumeStageCount(keys, stages, linearOnly)
+    if numberOfStages:
+      # the checkpoint includes the initial transform
+      initialTransformSettings = {'initialTransformFile': self.getCheckpointFile(keys[numberOfStages - 1])}
+    return stages[numberOfStages:], initialTransformSettings, keys[numberOfStages:] if keys else None
+
+  def createRunDirectory(self, keys):
+    """
+    Return a new directory where the checkpoints of a run computing the stages of the given keys are written.
+    """
+    os.makedirs(self.runsDirectory, exist_ok=True)
+    runDirectory = tempfile.mkdtemp(dir=self.runsDirectory)
+    self._activeRunDirectories.add(runDirectory)
+    with open(os.path.join(runDirectory, 'keys.json'), 'w') as keysFile:
+      json.dump(keys, keysFile)
+    return runDirectory
+
+  def collectRun(self, runDirectory):
+    """
+    Store the checkpoints written to the directory of a finished run and remove it.
+    """
+    self._activeRunDirectories.discard(runDirectory)
+    self.storeRunCheckpoints(runDirectory)
+    shutil.rmtree(runDirectory, ignore_errors=True)
+    self.entries.evict()
+
+  def storeRunCheckpoints(self, runDirectory):
+    """
+    Move the checkpoints written to a run directory to the entries. Completed checkpoint files are not modified
+    anymore by antsRegistration, they can be moved while the run goes on.
+    """
+    try:
+      with open(os.path.join(runDirectory, 'keys.json')) as keysFile:
+        keys = json.load(keysFile)
+    except (OSError, ValueError):
+      keys = []
+    for numberOfStages, key in enumerate(keys, 1):
+      checkpointFile = os.path.join(runDirectory, 'stage%i.h5' % numberOfStages)
+      if not os.path.isfile(checkpointFile) or self.entries.hasEntry(key):
+        continue
+      entryDirectory = self.entries.getEntryDirectory(key)
+      os.makedirs(entryDirectory, exist_ok=True)
+      shutil.move(checkpointFile, os.path.join(entryDirectory, self.TRANSFORM_FILE_NAME))
+      with open(os.path.join(entryDirectory, 'entry.json'), 'w') as entryFile:
+        json.dump({'files': {'checkpoint': self.TRANSFORM_FILE_NAME}, 'created': time.time()}, entryFile)
+
+  def collectRuns(self, minimumAge=24 * 3600):
+    """
+    Store the checkpoints of the runs of other processes, including runs that did not finish (e.g. Slicer was closed).
+    Their directories are removed once older than minimumAge (s), younger ones may belong to a running registration.
+    """
+    if not os.path.isdir(self.runsDirectory):
+      return
+    for name in os.listdir(self.runsDirectory):
+      runDirectory = os.path.join(self.runsDirectory, name)
+      if not os.path.isdir(runDirectory) or runDirectory in self._activeRunDirectories:
+        continue
+      self.storeRunCheckpoints(runDirectory)
+      if time.time() - os.path.getmtime(runDirectory) > minimumAge:
+        shutil.rmtree(runDirectory, ignore_errors=True)
+    self.entries.evict()
+
+  def purge(self):
+    shutil.rmtree(self.checkpointDirectory, ignore_errors=True)
@@ -0,0 +1,232 @@
+import hashlib
+import os
+
+
+def writeInputVolumeList(inputFiles, directory):
+  """
+  Write the inputVolumeList file of antsRegistrationCLI, one input volume file per line, and return its path.
+  The file name is derived from the list, so that registrations prepared at the same time do not overwrite each other's.
+  """
+  text = ''.join(filePath + '\n' for filePath in inputFiles)
+  filePath = os.path.join(directory, 'inputVolumes_%s.txt' % hashlib.sha256(text.encode()).hexdigest()[:16])
+  if not os.path.isfile(filePath):
+    with open(filePath, 'w', encoding='utf-8') as outfile:
+      outfile.write(text)
+  return filePath
+
+
+def readInputVolumeList(filePath):
+  """
+  Return the input volume files listed in an inputVolumeList file.
+  """
+  with open(filePath, encoding='utf-8') as infile:
+    return [line.rstrip('\r\n') for line in infile if line.strip()]
+
+
+class AntsCommandBuilder:
+  """
+  Builds the antsRegistration command used by antsRegistrationCLI from preset dictionaries.
+  Does not depend on Slicer: images, masks and transforms are replaced by placeholders through
+  getPlaceholder. By default they are file paths registered in self.parameters as the
+  antsRegistrationCLI parameters ($inputVolumeNN, $inputTransform, $outputVolume) they are passed with.
+  A different placeholder function (e.g. one handling MRML nodes) can be given instead.
+  """
+
+  MAX_INPUT_VOLUMES = 20
+
+  def __init__(self, getPlaceholder=None):
+    self.parameters = {}
+    self.inputFiles = []  # input volume files referenced as $inputFileN
+    self._inputPlaceholders = {}  # file path: placeholder
+    if getPlaceholder is not None:
+      self.getPlaceholder = getPlaceholder
+
+  def getPlaceholder(self, value, parameterName='inputVolume'):
+    """
+    Return the placeholder of a file path in the command, adding it to the parameters if needed.
+    Input volumes beyond MAX_INPUT_VOLUMES are passed in the inputVolumeList parameter, kept as a list of
+    files that AntsRegistrationRunner writes with writeInputVolumeList.
+    """
+    if parameterName != 'inputVolume':
+      self.parameters[parameterName] = value
+      return '$' + parameterName
+    placeholder = self._inputPlaceholders.get(value)
+    if placeholder is not None:
+      return placeholder
+    if len(self._inputPlaceholders) < self.MAX_INPUT_VOLUMES:
+      parameterName = 'inputVolume%02i' % (len(self._inputPlaceholders) + 1)
+      self.parameters[parameterName] = value
+      placeholder = '$' + parameterName
+    else:
+      placeholder = self.getInputFilePlaceholder(value)
+      self.parameters['inputVolumeList'] = self.inputFiles
+    self._inputPlaceholders[value] = placeholder
+    return placeholder
+
+  def getInputFilePlaceholder(self, filePath):
+    """
+    Return the $inputFileN placeholder of an input volume file, adding it to self.inputFiles if needed.
+    """
+    if filePath not in self.inputFiles:
+      self.inputFiles.append(filePath)
+    return '$inputFile%i' % (self.inputFiles.index(filePath) + 1)
+
+  def getAntsRegistrationCommand(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None):
+    if generalSettings is None:
+      generalSettings = {}
+    if initialTransformSettings is None:
+      initialTransformSettings = {}
+    antsCommand = self.getGeneralSettingsCommand(**generalSettings)
+    volume = outputSettings['volume']
+    for name in ['nativeReferenceVolume', 'nativeMovingVolume']:
+      if outputSettings.get(name) is not None:
+        self.getPlaceholder(outputSettings[name], name)
+    if outputSettings.get('nativeMovingVolume') is not None and volume is not None:
+      # resampled by the cli from the native moving volume, not by antsRegistration
+      self.getPlaceholder(volume, "outputVolume")
+      volume = None
+    antsCommand = antsCommand + self.getOutputCommand(interpolation=outputSettings['interpolation'], volume=volume,
+                                                      inverseVolume=outputSettings.get('inverseVolume'))
+    antsCommand = antsCommand + self.getInitialMovingTransformCommand(**initialTransformSettings)
+    for stage in stages:
+      antsCommand = antsCommand + self.getStageCommand(**stage)
+    return antsCommand
+
+  def getGeneralSettingsCommand(self, dimensionality=3, histogramMatching=False, winsorizeImageIntensities=None, computationPrecision="float",
+                                numberOfThreads=0, randomSeed=None):
+    # numberOfThreads is not an antsRegistration option, it is applied by antsRegistrationCLI
+    if winsorizeImageIntensities is None:
+      winsorizeImageIntensities = [0, 1]
+    command = "--dimensionality %i" % dimensionality
+    command = command + " --use-histogram-matching %i" % histogramMatching
+    command = command + " --winsorize-image-intensities [%.3f,%.3f]" % tuple(winsorizeImageIntensities)
+    command = command + " --float $useFloat"
+    command = command + " --verbose 1"
+    if randomSeed is not None:
+      command = command + " --random-seed %i" % randomSeed
+    return command
+
+  def getOutputCommand(self, interpolation='Linear', volume=None, inverseVolume=None):
+    command = " --interpolation %s" % interpolation
+    if inverseVolume is not None:
+      # antsRegistration takes the inverse warped volume after the warped one, the cli removes $unusedVolume
+      warped = self.getPlaceholder(volume, "outputVolume") if volume is not None else "$unusedVolume"
+      command = command + " --output [%s,%s,%s]" % ("$outputBase", warped, self.getPlaceholder(inverseVolume, "outputInverseVolume"))
+    elif volume is not None:
+      command = command + " --output [%s,%s]" % ("$outputBase", self.getPlaceholder(volume, "outputVolume"))
+    else:
+      command = command + " --output $outputBase"
+    command = command + " --write-composite-transform 1"
+    command = command + " --collapse-output-transforms 1"
+    return command
+
+  def getInitialMovingTransformCommand(self, initialTransformNode=None, initializationFeature=-1, fixedImageNode=None, movingImageNode=None,
+                                       initialTransformFile=None):
+    if initialTransformFile:
+      return " --initial-moving-transform %s" % self.getPlaceholder(initialTransformFile, "initialTransformFile")
+    elif initialTransformNode is not None:
+      return " --initial-moving-transform %s" % self.getPlaceholder(initialTransformNode, "inputTransform")
+    elif initializationFeature >= 0:
+      return " --initial-moving-transform [%s,%s,%i]" % (self.getPlaceholder(fixedImageNode), self.getPlaceholder(movingImageNode), initializationFeature)
+    else:
+      return ""
+
+  def getStageCommand(self, transformParameters, metrics, levels, masks):
+    command = self.getTransformCommand(**transformParameters)
+    for metric in metrics:
+      command = command + self.getMetricCommand(**metric)
+    command = command + self.getLevelsCommand(**levels)
+    command = command + self.getMasksCommand(**masks)
+    return command
+
+  def getTransformCommand(self, transform, settings):
+    return " --transform %s[%s]" % (transform, settings)
+
+  def getMetricCommand(self, type, fixed, moving, settings):
+    return " --metric %s[%s,%s,%s]" % (type, self.getPlaceholder(fixed), self.getPlaceholder(moving), settings)
+
+  def getMasksCommand(self, fixed=None, moving=None):
+    fixedMask = self.getPlaceholder(fixed) if fixed else ''
+    movingMask = self.getPlaceholder(moving) if moving else ''
+    if fixedMask and movingMask:
+      return " --masks [%s,%s]" % (fixedMask, movingMask)
+    return ""
+
+  def getLevelsCommand(self, steps, convergenceThreshold, convergenceWindowSize, smoothingSigmasUnit):
+    convergence = self.joinStepsInfoForKey(steps, 'convergence')
+    smoothingSigmas = self.joinStepsInfoForKey(steps, 'smoothingSigmas')
+    shrinkFactors = self.joinStepsInfoForKey(steps, 'shrinkFactors')
+    command = " --convergence [%s,1e-%i,%i]" % (convergence, convergenceThreshold, convergenceWindowSize)
+    command = command + " --smoothing-sigmas %s%s" % (smoothingSigmas, smoothingSigmasUnit)
+    command = command + " --shrink-factors %s" % shrinkFactors
+    return command
+
+  def joinStepsInfoForKey(self, steps, key):
+    out = [str(step[key]) for step in steps]
+    return "x".join(out)
+
+
+def setPresetInputs(parameters, fixed, moving, fixedMask=None, movingMask=None):
+  """
+  Set the fixed and moving inputs (file paths or nodes) of all the metrics and masks of preset parameters.
+  """
+  for stage in parameters['stages']:
+    for metric in stage['metrics']:
+      metric['fixed'] = fixed
+      metric['moving'] = moving
+    stage['masks'] = {'fixed': fixedMask, 'moving': movingMask}
+  return parameters
+
+
+class NodeCommandBuilder(AntsCommandBuilder):
+  """
+  Builds the antsRegistrationCLI parameters of one registration from stages holding MRML nodes.
+  Nodes are passed by ID in the inputVolumeNN parameters, or as files written by inputStager if given.
+  Input volumes beyond MAX_INPUT_VOLUMES are written by the stager returned by getOverflowStager.
+  Files are listed in an inputVolumeList file written next to them once the command is built.
+  Each registration uses its own builder, so that several can be prepared at the same time.
+  """
+
+  def __init__(self, inputStager=None, getOverflowStager=None):
+    AntsCommandBuilder.__init__(self)
+    self.inputStager = inputStager
+    self.getOverflowStager = getOverflowStager
+    self._parameterNames = {}  # (parameterName, nodeID): cli parameter name
+    self._numberOfInputVolumes = 0
+    self._inputFileDirectory = None
+
+  def getPlaceholder(self, mrmlNode, parameterName='inputVolume'):
+    if parameterName == 'inputVolume' and self.inputStager is not None:
+      return self.getStagedInputFilePlaceholder(mrmlNode, self.inputStager)
+    if parameterName in ['nativeReferenceVolume', 'nativeMovingVolume'] and self.inputStager is not None:
+      self.parameters[parameterName] = self.inputStager.stageNode(mrmlNode)
+      return '$' + parameterName
+    if parameterName == 'initialTransformFile':
+      self.parameters[parameterName] = mrmlNode
+      return '$' + parameterName
+    nodeID = mrmlNode.GetID()
+    key = self._parameterNames.get((parameterName, nodeID))
+    if key is not None:
+      return '$' + key
+    if parameterName == 'inputVolume':
+      if self._numberOfInputVolumes == self.MAX_INPUT_VOLUMES:
+        # the cli declares a fixed number of input volumes, others are passed as files
+        return self.getStagedInputFilePlaceholder(mrmlNode, self.getOverflowStager())
+      self._numberOfInputVolumes += 1
+      key = 'inputVolume%02i' % self._numberOfInputVolumes
+    else:
+      key = parameterName
+    self._parameterNames[(parameterName, nodeID)] = key
+    self.parameters[key] = nodeID
+    return '$' + key
+
+  def getStagedInputFilePlaceholder(self, mrmlNode, inputStager):
+    filePath = inputStager.stageNode(mrmlNode)
+    self._inputFileDirectory = inputStager.stagingDirectory
+    return self.getInputFilePlaceholder(filePath)
+
+  def getAntsRegistrationCommand(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None):
+    antsCommand = AntsCommandBuilder.getAntsRegistrationCommand(self, stages, outputSettings, initialTransformSettings, generalSettings)
+    if self.inputFiles:
+      self.parameters['inputVolumeList'] = writeInputVolumeList(self.inputFiles, self._inputFileDirectory)
+    return antsCommand
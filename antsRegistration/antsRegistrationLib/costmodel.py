@@ -0,0 +1,264 @@
+import os
+import json
+import math
+
+
+COST_MODEL_SETTING = 'antsRegistration/CostModelCalibration'
+
+# relative cost of evaluating the metric and its gradient at one sampled point, CC is scaled by its neighborhood
+METRIC_POINT_COSTS = {'CC': 1.0, 'MI': 1.0, 'Mattes': 1.0, 'MeanSquares': 0.5, 'Demons': 0.5, 'GC': 1.0,
+                      'ICP': 2.0, 'PSE': 4.0, 'JHCT': 4.0}
+POINT_SET_METRICS = ['ICP', 'PSE', 'JHCT']
+
+# per transform: (metric evaluations per iteration, field operations per virtual voxel and iteration, vector fields in memory)
+TRANSFORM_COSTS = {
+  'GaussianDisplacementField': (1, 2.0, 3),
+  'BSplineDisplacementField': (1, 1.0, 3),
+  'SyN': (2, 4.0, 6),
+  'BSplineSyN': (2, 2.0, 6),
+  'Exponential': (1, 6.0, 4),
+  'BSplineExponential': (1, 3.0, 4),
+  'TimeVaryingBSplineVelocityField': (1, 1.0, 2),
+  }
+LINEAR_TRANSFORM_COSTS = (1, 0.0, 0)
+
+# smoothing and shrinking the inputs at the start of a level, per input voxel
+LEVEL_SETUP_COST = 0.1
+# threads do not divide the runtime linearly
+PARALLEL_EXPONENT = 0.8
+
+
+def getSettingValues(settings):
+  return [value.strip() for value in str(settings).split(',')]
+
+
+def getVoxelCount(dimensions):
+  count = 1
+  for size in dimensions:
+    count *= size
+  return count
+
+
+def getShrunkDimensions(dimensions, shrinkFactor):
+  return [max(1, int(size / shrinkFactor)) for size in dimensions]
+
+
+def getDimensions(volume):
+  """
+  Return the dimensions of a volume node or of a dimensions sequence, None if unknown.
+  """
+  if volume is None:
+    return None
+  if hasattr(volume, 'GetImageData'):
+    return list(volume.GetImageData().GetDimensions()) if volume.GetImageData() else None
+  return [int(size) for size in volume]
+
+
+def getPhysicalMemoryMB():
+  """
+  Return the physical memory of the machine, None if it can not be queried.
+  """
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024.0 * 1024.0)
+  except (AttributeError, ValueError, OSError):
+    return None
+
+
+class RegistrationCostModel:
+  """
+  Predicts the runtime and peak memory of each stage of a registration from the input dimensions, without running it.
+  The work of a level is its number of iterations times the sampled points of the shrunk fixed volume weighted by the
+  metric cost, plus the dense field operations of deformable transforms. Memory holds the inputs and the vector fields
+  of the current level, stored in the computation precision, plus the fields of the previous stages.
+  Work units and bytes are converted to seconds and MB by a calibration fitted on PresetBenchmark results.
+  """
+
+  DEFAULT_CALIBRATION = {
+    'secondsPerUnit': {'float': 3e-7, 'double': 4.5e-7},
+    'overheadSeconds': 2.0,
+    'memoryScale': 1.0,
+    'memoryOverheadMB': 150.0,
+    'numberOfThreads': None,  # threads of the calibration runs, all cores if None
+    'calibrated': False,
+    }
+
+  def __init__(self, calibration=None):
+    self.calibration = json.loads(json.dumps(self.DEFAULT_CALIBRATION))
+    if calibration:
+      self.calibration.update(calibration)
+
+  def estimate(self, stages, fixedDimensions, movingDimensions, generalSettings=None):
+    """
+    :param stages: list defining registration stages, as given to antsRegistrationLogic.process
+    :param fixedDimensions: dimensions of the fixed volume, the virtual domain of the registration
+    :param movingDimensions: dimensions of the moving volume
+    :param generalSettings: 'computationPrecision' and 'numberOfThreads' are used
+    :return: dictionary of 'runtime' (s), 'peakMemoryMB', per stage estimates in 'stages' and 'calibrated'
+    """
+    generalSettings = generalSettings if generalSettings else {}
+    precision = generalSettings.get('computationPrecision', 'float')
+    units = self.getWorkUnits(stages, fixedDimensions, movingDimensions)
+    memoryBytes = self.getMemoryBytes(stages, fixedDimensions, movingDimensions, 8 if precision == 'double' else 4)
+    threadScale = self.getThreadScale(int(generalSettings.get('numberOfThreads', 0)))
+    secondsPerUnit = self.calibration['secondsPerUnit'].get(precision, self.DEFAULT_CALIBRATION['secondsPerUnit']['float'])
+    stageEstimates = []
+    for stage, stageUnits, stageBytes in zip(stages, units, memoryBytes):
+      stageEstimates.append({
+        'transform': stage['transformParameters']['transform'],
+        'runtime': stageUnits * secondsPerUnit * threadScale,
+        'peakMemoryMB': self.calibration['memoryOverheadMB'] + self.calibration['memoryScale'] * stageBytes / (1024.0 * 1024.0),
+        })
+    return {
+      'runtime': self.calibration['overheadSeconds'] + sum(stage['runtime'] for stage in stageEstimates),
+      'peakMemoryMB': max([stage['peakMemoryMB'] for stage in stageEstimates] + [self.calibration['memoryOverheadMB']]),
+      'stages': stageEstimates,
+      'calibrated': self.calibration['calibrated'],
+      }
+
+  def getThreadScale(self, numberOfThreads):
+    cpuCount = os.cpu_count() or 1
+    calibrationThreads = self.calibration['numberOfThreads'] or cpuCount
+    numberOfThreads = numberOfThreads if numberOfThreads > 0 else cpuCount
+    return (calibrationThreads / numberOfThreads) ** PARALLEL_EXPONENT
+
+  def getWorkUnits(self, stages, fixedDimensions, movingDimensions):
+    """
+    Return the uncalibrated work of each stage.
+    """
+    inputVoxels = getVoxelCount(fixedDimensions) + getVoxelCount(movingDimensions)
+    stageUnits = []
+    for stage in stages:
+      evaluations, fieldCost, _ = self.getTransformCosts(stage['transformParameters'])
+      units = 0.0
+      for step in stage['levels']['steps']:
+        levelVoxels = getVoxelCount(getShrunkDimensions(fixedDimensions, float(step['shrinkFactors'])))
+        points = sum(levelVoxels * self.getSamplingFraction(metric) * self.getMetricPointCost(metric, len(fixedDimensions))
+                     for metric in stage['metrics'])
+        units += LEVEL_SETUP_COST * inputVoxels
+        units += int(step['convergence']) * (evaluations * points + fieldCost * levelVoxels)
+      stageUnits.append(units)
+    return stageUnits
+
+  def getMemoryBytes(self, stages, fixedDimensions, movingDimensions, bytesPerValue):
+    """
+    Return the uncalibrated peak memory of each stage.
+    """
+    dimensionality = len(fixedDimensions)
+    fixedVoxels = getVoxelCount(fixedDimensions)
+    # original and smoothed copy of each input
+    inputBytes = 2 * (fixedVoxels + getVoxelCount(movingDimensions)) * bytesPerValue
+    previousFieldsBytes = 0
+    stageBytes = []
+    for stage in stages:
+      fields = self.getTransformCosts(stage['transformParameters'])[2]
+      peak = 0
+      for step in stage['levels']['steps']:
+        levelVoxels = getVoxelCount(getShrunkDimensions(fixedDimensions, float(step['shrinkFactors'])))
+        # point coordinates and values of the sampled metric points
+        pointBytes = sum(levelVoxels * self.getSamplingFraction(metric) for metric in stage['metrics']) * (dimensionality + 1) * 8
+        peak = max(peak, levelVoxels * fields * dimensionality * bytesPerValue + pointBytes)
+      stageBytes.append(inputBytes + previousFieldsBytes + peak)
+      # the composite transform keeps the forward and inverse fields of the stage at the virtual domain resolution
+      if fields:
+        previousFieldsBytes += 2 * fixedVoxels * dimensionality * bytesPerValue
+    return stageBytes
+
+  @staticmethod
+  def getTransformCosts(transformParameters):
+    name = transformParameters['transform']
+    values = getSettingValues(transformParameters.get('settings', ''))
+    # the metric is evaluated and the velocity field updated at every time point
+    if name == 'TimeVaryingVelocityField':
+      timeIndices = int(values[1]) if len(values) > 1 and values[1] else 4
+      return (timeIndices, 4.0 * timeIndices, timeIndices + 2)
+    if name == 'TimeVaryingBSplineVelocityField':
+      timePoints = int(values[2]) if len(values) > 2 and values[2] else 4
+      evaluations, fieldCost, fields = TRANSFORM_COSTS[name]
+      return (timePoints * evaluations, timePoints * fieldCost, fields)
+    return TRANSFORM_COSTS.get(name, LINEAR_TRANSFORM_COSTS)
+
+  @staticmethod
+  def getMetricPointCost(metric, dimensionality):
+    cost = METRIC_POINT_COSTS.get(metric['type'], 1.0)
+    if metric['type'] == 'CC':
+      values = getSettingValues(metric.get('settings', ''))
+      radius = int(values[1]) if len(values) > 1 and values[1] else 4
+      cost *= (2 * radius + 1) ** dimensionality / 27.0
+    return cost
+
+  @staticmethod
+  def getSamplingFraction(metric):
+    values = getSettingValues(metric.get('settings', ''))
+    if metric['type'] in POINT_SET_METRICS:
+      return float(values[1]) if len(values) > 1 and values[1] else 1.0
+    if len(values) < 3 or values[2] in ['', 'None']:
+      return 1.0
+    return float(values[3]) if len(values) > 3 and values[3] else 1.0
+
+  def calibrate(self, benchmarkResults):
+    """
+    Fit the calibration to the completed results of a PresetBenchmark run, which record their stages and the input dimensions.
+    """
+    geometry = benchmarkResults['geometry']
+    results = [result for result in benchmarkResults['results'] if result['status'] == 'Completed' and result.get('stages')]
+    if not results:
+      raise ValueError('No completed benchmark result with stages to calibrate from')
+    environment = benchmarkResults.get('environment', {})
+    self.calibration['numberOfThreads'] = benchmarkResults.get('numberOfThreads') or environment.get('cpuCount')
+    self.calibration['overheadSeconds'] = 0.0
+    # runtime: least squares through the origin, per precision
+    for precision in ['float', 'double']:
+      pairs = [(sum(self.getWorkUnits(result['stages'], geometry['fixed'], geometry['moving'])), result['wallTime'])
+               for result in results if result['precision'] == precision]
+      if pairs and sum(units * units for units, _ in pairs):
+        self.calibration['secondsPerUnit'][precision] = sum(units * time for units, time in pairs) / sum(units * units for units, _ in pairs)
+    # runtime of a precision without results follows the default ratio
+    for precision, other in [('float', 'double'), ('double', 'float')]:
+      if not any(result['precision'] == precision for result in results) and any(result['precision'] == other for result in results):
+        ratio = self.DEFAULT_CALIBRATION['secondsPerUnit'][precision] / self.DEFAULT_CALIBRATION['secondsPerUnit'][other]
+        self.calibration['secondsPerUnit'][precision] = self.calibration['secondsPerUnit'][other] * ratio
+    # memory: linear least squares, scale only when the predictions do not differ
+    pairs = [(max(self.getMemoryBytes(result['stages'], geometry['fixed'], geometry['moving'], 8 if result['precision'] == 'double' else 4)) / (1024.0 * 1024.0),
+              result['peakMemoryMB']) for result in results if result.get('peakMemoryMB')]
+    if len(set(predicted for predicted, _ in pairs)) > 1:
+      meanPredicted = sum(predicted for predicted, _ in pairs) / len(pairs)
+      meanMeasured = sum(measured for _, measured in pairs) / len(pairs)
+      scale = sum((predicted - meanPredicted) * (measured - meanMeasured) for predicted, measured in pairs) / \
+              sum((predicted - meanPredicted) ** 2 for predicted, _ in pairs)
+      if scale > 0:
+        self.calibration['memoryScale'] = scale
+        self.calibration['memoryOverheadMB'] = max(0.0, meanMeasured - scale * meanPredicted)
+    elif pairs:
+      predicted, measured = pairs[0]
+      self.calibration['memoryScale'] = max(0.0, measured - self.calibration['memoryOverheadMB']) / predicted
+    self.calibration['calibrated'] = True
+    return self.calibration
+
+  @classmethod
+  def load(cls):
+    """
+    Return a cost model using the calibration of the antsRegistration/CostModelCalibration setting, or the default one.
+    """
+    import slicer
+    text = slicer.util.settingsValue(COST_MODEL_SETTING, '')
+    return cls(json.loads(text) if text else None)
+
+  def save(self):
+    import slicer
+    slicer.app.settings().setValue(COST_MODEL_SETTING, json.dumps(self.calibration))
+
+
+def formatEstimate(estimate):
+  """
+  Return a one line description of a RegistrationCostModel estimate.
+  """
+  runtime = estimate['runtime']
+  if runtime < 60:
+    runtimeText = '%i s' % math.ceil(runtime)
+  elif runtime < 3600:
+    runtimeText = '%i min' % round(runtime / 60.0)
+  else:
+    runtimeText = '%.1f h' % (runtime / 3600.0)
+  memory = estimate['peakMemoryMB']
+  memoryText = '%i MB' % round(memory) if memory < 1024 else '%.1f GB' % (memory / 1024.0)
+  return 'Estimated: about %s, %s peak memory%s' % (runtimeText, memoryText, '' if estimate['calibrated'] else ' (uncalibrated)')
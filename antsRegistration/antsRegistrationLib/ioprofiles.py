@@ -0,0 +1,55 @@
+import slicer
+
+
+class IOProfile:
+  """
+  File format and compression of the intermediate volume files exchanged with antsRegistrationCLI
+  (staged inputs, cached results and job directories). Uncompressed files are the fastest to write and
+  read on local disks, compressed ones reduce disk usage and transfer size on network storage.
+  """
+
+  def __init__(self, name, extension, useCompression):
+    self.name = name
+    self.extension = extension
+    self.useCompression = useCompression
+
+  def getFileName(self, baseName):
+    return baseName + self.extension
+
+  def createVolumeStorageNode(self, filePath=None):
+    storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+    storageNode.SetUseCompression(self.useCompression)
+    if filePath:
+      storageNode.SetFileName(filePath)
+    return storageNode
+
+  def writeVolume(self, volumeNode, filePath):
+    if not self.createVolumeStorageNode(filePath).WriteData(volumeNode):
+      raise RuntimeError('Unable to write %s to %s' % (volumeNode.GetName(), filePath))
+
+  def readVolume(self, volumeNode, filePath):
+    return bool(self.createVolumeStorageNode(filePath).ReadData(volumeNode))
+
+
+IO_PROFILES = {
+  'raw': IOProfile('raw', '.nrrd', False),
+  'compressed': IOProfile('compressed', '.nrrd', True),
+  'nifti': IOProfile('nifti', '.nii', False),
+  'niftiCompressed': IOProfile('niftiCompressed', '.nii.gz', True),
+  }
+
+IO_PROFILE_SETTING = 'antsRegistration/IOProfile'
+DEFAULT_IO_PROFILE = 'raw'
+
+
+def getIOProfile(name=None):
+  """
+  Return the IOProfile of the given name, or of the antsRegistration/IOProfile setting if None.
+  """
+  if isinstance(name, IOProfile):
+    return name
+  if name is None:
+    name = slicer.util.settingsValue(IO_PROFILE_SETTING, DEFAULT_IO_PROFILE)
+  if name not in IO_PROFILES:
+    raise ValueError('Unknown I/O profile: %s. Use one of %s' % (name, ', '.join(IO_PROFILES.keys())))
+  return IO_PROFILES[name]
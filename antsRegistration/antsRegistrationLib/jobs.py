@@ -0,0 +1,228 @@
+import time
+
+from .batch import copyParameters
+from .scheduling import CoreScheduler
+from .validation import validateStages
+
+
+class RegistrationJob:
+  """
+  One registration with its own CLI parameters, CLI node, telemetry and status, so that several can run
+  or wait at the same time. parameters are the keyword arguments of antsRegistrationLogic.process.
+  """
+
+  QUEUED = 'Queued'
+  RUNNING = 'Running'
+  COMPLETED = 'Completed'
+  FAILED = 'Failed'
+  CANCELLED = 'Cancelled'
+
+  def __init__(self, parameters, name='', priority=0, onFinished=None):
+    self.parameters = parameters
+    self.name = name if name else self.getNameFromParameters(parameters)
+    self.priority = priority
+    self.onFinished = onFinished
+    self.index = 0
+    self.status = self.QUEUED
+    self.cliParams = {}
+    self.cliNode = None
+    self.telemetry = None
+    self.resumedStageCount = 0
+    self.transformApplication = None
+    self.startTime = None
+    self.endTime = None
+    self.errorText = ''
+    self.fromCache = False
+    self._finishedCallbacks = []
+    self._observerTag = None
+
+  @staticmethod
+  def getNameFromParameters(parameters):
+    try:
+      moving = parameters['stages'][0]['metrics'][0]['moving']
+    except (KeyError, IndexError):
+      return 'Registration'
+    return moving.GetName() if hasattr(moving, 'GetName') else str(moving)
+
+  @property
+  def elapsedTime(self):
+    if self.startTime is None:
+      return 0.0
+    return (self.endTime if self.endTime is not None else time.time()) - self.startTime
+
+  def isFinished(self):
+    return self.status in [self.COMPLETED, self.FAILED, self.CANCELLED]
+
+  def setRunning(self):
+    """
+    Follow the status of the CLI node once launched. A job whose result was loaded from cache has no CLI node.
+    """
+    if self.cliNode is None:
+      self.fromCache = True
+      self.finish(self.COMPLETED)
+      return
+    self.status = self.RUNNING
+    self._observerTag = self.cliNode.AddObserver('ModifiedEvent', lambda caller, event: self.onStatusUpdate())
+    self.onStatusUpdate()
+
+  def onStatusUpdate(self):
+    if self.isFinished():
+      return
+    status = self.cliNode.GetStatus()
+    if status & self.cliNode.Cancelled:
+      self.finish(self.CANCELLED)
+    elif status & self.cliNode.Completed:
+      if status & self.cliNode.ErrorsMask:
+        self.errorText = self.cliNode.GetErrorText()
+        self.finish(self.FAILED)
+      else:
+        self.finish(self.COMPLETED)
+
+  def addFinishedCallback(self, callback):
+    """
+    Call callback with the job once it finished, now if it already did.
+    """
+    if self.isFinished():
+      callback(self)
+    else:
+      self._finishedCallbacks.append(callback)
+
+  def cancel(self):
+    if self.status == self.QUEUED:
+      self.finish(self.CANCELLED)
+    elif self.status == self.RUNNING:
+      self.cliNode.Cancel()
+
+  def finish(self, status, errorText=''):
+    self.status = status
+    self.endTime = time.time()
+    if errorText:
+      self.errorText = errorText
+    if self.cliNode is not None and self._observerTag is not None:
+      self.cliNode.RemoveObserver(self._observerTag)
+      self._observerTag = None
+    for callback in self._finishedCallbacks:
+      callback(self)
+    self._finishedCallbacks = []
+    if self.onFinished:
+      self.onFinished(self)
+
+  def toDict(self):
+    return {
+      'name': self.name,
+      'status': self.status,
+      'priority': self.priority,
+      'elapsedTime': self.elapsedTime,
+      'errorText': self.errorText,
+      'fromCache': self.fromCache,
+      'resumedStageCount': self.resumedStageCount,
+      }
+
+
+class JobQueue:
+  """
+  Queue of registration jobs launched with antsRegistrationLogic.runJob, at most maxConcurrentJobs at a time.
+  Queued jobs start in decreasing priority order, then in submission order. Jobs that do not set a number of
+  threads get the share of the cores given by the scheduler.
+  """
+
+  def __init__(self, logic, maxConcurrentJobs=1, scheduler=None, onJobStarted=None, onJobFinished=None):
+    self.logic = logic
+    self.maxConcurrentJobs = max(1, int(maxConcurrentJobs))
+    self.scheduler = scheduler if scheduler is not None else CoreScheduler()
+    self.onJobStarted = onJobStarted
+    self.onJobFinished = onJobFinished
+    self.jobs = []
+    self._numberOfSubmittedJobs = 0
+    self._launching = False
+
+  def submit(self, parameters, name='', priority=0):
+    """
+    Queue a registration. Raises ValueError if the stages are not valid.
+    :param parameters: keyword arguments of antsRegistrationLogic.process
+    :return: the RegistrationJob
+    """
+    errors = validateStages(parameters['stages'])
+    if errors:
+      raise ValueError('Invalid registration stages:\n' + '\n'.join(errors))
+    job = RegistrationJob(parameters, name, priority, onFinished=self.onJobFinishedCallback)
+    self._numberOfSubmittedJobs += 1
+    job.index = self._numberOfSubmittedJobs
+    self.jobs.append(job)
+    self.launchQueuedJobs()
+    return job
+
+  def setPriority(self, job, priority):
+    job.priority = priority
+
+  def cancel(self, job):
+    job.cancel()
+
+  def cancelAll(self):
+    for job in self.getQueuedJobs():
+      job.cancel()
+    for job in self.getRunningJobs():
+      job.cancel()
+
+  def clearFinished(self):
+    self.jobs = [job for job in self.jobs if not job.isFinished()]
+
+  def getQueuedJobs(self):
+    """
+    Return the queued jobs in the order they will start.
+    """
+    queuedJobs = [job for job in self.jobs if job.status == RegistrationJob.QUEUED]
+    return sorted(queuedJobs, key=lambda job: (-job.priority, job.index))
+
+  def getRunningJobs(self):
+    return [job for job in self.jobs if job.status == RegistrationJob.RUNNING]
+
+  def getFinishedJobs(self):
+    return [job for job in self.jobs if job.isFinished()]
+
+  def getSummary(self):
+    return [job.toDict() for job in self.jobs]
+
+  def launchQueuedJobs(self):
+    if self._launching:
+      # a job finished while being launched (cached result or failure), the running loop goes on with the next ones
+      return
+    self._launching = True
+    try:
+      self._launchQueuedJobs()
+    finally:
+      self._launching = False
+
+  def _launchQueuedJobs(self):
+    while self.getQueuedJobs() and len(self.getRunningJobs()) < self.maxConcurrentJobs:
+      if not self.logic.canStartCLI():
+        self.logic.callWhenCLICanStart(self.launchQueuedJobs)
+        break
+      queuedJobs = self.getQueuedJobs()
+      numberOfStartableJobs = min(len(queuedJobs), self.maxConcurrentJobs - len(self.getRunningJobs()))
+      job = queuedJobs[0]
+      generalSettings = job.parameters.get('generalSettings') or {}
+      if not generalSettings.get('numberOfThreads'):
+        numberOfThreads = self.scheduler.allocate(id(job), numberOfStartableJobs)
+        if not numberOfThreads:
+          break
+        job.parameters = dict(job.parameters)
+        job.parameters['generalSettings'] = copyParameters(generalSettings)
+        job.parameters['generalSettings']['numberOfThreads'] = numberOfThreads
+      self.launchJob(job)
+
+  def launchJob(self, job):
+    try:
+      self.logic.runJob(job)
+    except Exception as e:
+      if not job.isFinished():
+        job.finish(RegistrationJob.FAILED, str(e))
+      return
+    if self.onJobStarted and not job.fromCache:
+      self.onJobStarted(job)
+
+  def onJobFinishedCallback(self, job):
+    self.scheduler.release(id(job))
+    if self.onJobFinished:
+      self.onJobFinished(job)
+    self.launchQueuedJobs()
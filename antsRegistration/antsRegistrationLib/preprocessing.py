@@ -0,0 +1,200 @@
+import itertools
+import math
+import slicer, vtk
+
+from .batch import copyParameters
+
+
+class InputPreprocessor:
+  """
+  Crops the fixed and moving volumes of the stages to a region and resamples them to an isotropic working
+  spacing before registration, so that the levels only sample and smooth the voxels that are needed.
+  ANTs works in physical space: the transform computed on the preprocessed volumes applies to the original
+  volumes, and the output volume and displacement field are computed by antsRegistrationCLI from them.
+  The crop region is a markups ROI, a mask volume, or 'masks' to use the masks of the stages. It is enlarged
+  by cropMargin (mm) on every side. Volumes are only resampled if their finest spacing is below workingSpacing (mm).
+  """
+
+  NATIVE_VOLUME_KEYS = ['nativeReferenceVolume', 'nativeMovingVolume']
+
+  def __init__(self, cropRegion=None, cropMargin=10.0, workingSpacing=None):
+    self.cropRegion = cropRegion
+    self.cropMargin = float(cropMargin)
+    self.workingSpacing = float(workingSpacing) if workingSpacing else None
+    self.preprocessedNodes = {}  # original node ID: preprocessed node
+
+  def apply(self, stages, outputSettings):
+    """
+    Return copies of stages and outputSettings using the preprocessed volumes.
+    """
+    stages = copyParameters(stages)
+    outputSettings = copyParameters(outputSettings)
+    fixedBounds, movingBounds = self.getCropBounds(stages)
+    originalFixed = stages[0]['metrics'][0]['fixed']
+    originalMoving = stages[0]['metrics'][0]['moving']
+    for stage in stages:
+      for metric in stage['metrics']:
+        metric['fixed'] = self.getPreprocessedVolume(metric['fixed'], fixedBounds)
+        metric['moving'] = self.getPreprocessedVolume(metric['moving'], movingBounds)
+    if self.preprocessedNodes:
+      # outputs are sampled from the original volumes
+      if outputSettings.get('volume') is not None or outputSettings.get('applyVolumes') or \
+         (outputSettings.get('transform') is not None and outputSettings.get('useDisplacementField')):
+        outputSettings['nativeReferenceVolume'] = originalFixed
+      if outputSettings.get('volume') is not None:
+        outputSettings['nativeMovingVolume'] = originalMoving
+    return stages, outputSettings
+
+  def getCropBounds(self, stages):
+    """
+    Return the RAS bounds of the fixed and moving crop boxes, None where the volumes are not cropped.
+    """
+    if self.cropRegion is None:
+      return None, None
+    if self.cropRegion == 'masks':
+      fixedBounds = self.getUnionBounds([self.getRegionBounds(stage['masks'].get('fixed')) for stage in stages])
+      movingBounds = self.getUnionBounds([self.getRegionBounds(stage['masks'].get('moving')) for stage in stages])
+      # fixed and moving are roughly aligned, use the mask given for the other one
+      return (fixedBounds or movingBounds), (movingBounds or fixedBounds)
+    bounds = self.getRegionBounds(self.cropRegion)
+    return bounds, bounds
+
+  def getRegionBounds(self, region):
+    """
+    Return the RAS bounds [xmin, xmax, ymin, ymax, zmin, zmax] of a markups ROI or of the non zero voxels of a mask volume,
+    None if no region is given (unset masks are '').
+    """
+    if not region:
+      return None
+    if isinstance(region, str):
+      region = slicer.mrmlScene.GetNodeByID(region)
+      if region is None:
+        return None
+    if region.IsA('vtkMRMLMarkupsROINode'):
+      bounds = [0.0] * 6
+      region.GetRASBounds(bounds)
+      return bounds
+    import numpy as np
+    kji = np.nonzero(slicer.util.arrayFromVolume(region))
+    if not len(kji[0]):
+      return None
+    # voxel centers to voxel corners
+    ijkMin = [float(kji[axis].min()) - 0.5 for axis in [2, 1, 0]]
+    ijkMax = [float(kji[axis].max()) + 0.5 for axis in [2, 1, 0]]
+    return self.getIJKBoxBounds(region, ijkMin, ijkMax)
+
+  @staticmethod
+  def getIJKBoxBounds(volumeNode, ijkMin, ijkMax):
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    bounds = [float('inf'), float('-inf')] * 3
+    for corner in itertools.product(*zip(ijkMin, ijkMax)):
+      ras = ijkToRAS.MultiplyPoint(list(corner) + [1.0])
+      for axis in range(3):
+        bounds[2 * axis] = min(bounds[2 * axis], ras[axis])
+        bounds[2 * axis + 1] = max(bounds[2 * axis + 1], ras[axis])
+    return bounds
+
+  @staticmethod
+  def getUnionBounds(boundsList):
+    boundsList = [bounds for bounds in boundsList if bounds is not None]
+    if not boundsList:
+      return None
+    return [(min if axis % 2 == 0 else max)(bounds[axis] for bounds in boundsList) for axis in range(6)]
+
+  def getPreprocessedVolume(self, volumeNode, bounds):
+    """
+    Return the cropped and resampled volume, or volumeNode itself if it is neither cropped nor resampled.
+    """
+    if not volumeNode:
+      return volumeNode
+    if volumeNode.GetID() in self.preprocessedNodes:
+      return self.preprocessedNodes[volumeNode.GetID()]
+    volumeBounds = self.getVolumeBounds(volumeNode)
+    if bounds is not None:
+      bounds = [bounds[axis] + (self.cropMargin if axis % 2 else -self.cropMargin) for axis in range(6)]
+      if all(bounds[2 * axis] <= volumeBounds[2 * axis] and bounds[2 * axis + 1] >= volumeBounds[2 * axis + 1] for axis in range(3)):
+        bounds = None  # holds all the voxels
+    resample = self.isResampled(volumeNode)
+    if bounds is None and not resample:
+      return volumeNode
+    if bounds is None:
+      bounds = volumeBounds
+    roiNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsROINode', slicer.mrmlScene.GenerateUniqueName('antsCropRegion'))
+    roiNode.SetHideFromEditors(True)
+    roiNode.SetCenter([(bounds[2 * axis] + bounds[2 * axis + 1]) / 2.0 for axis in range(3)])
+    roiNode.SetSize([bounds[2 * axis + 1] - bounds[2 * axis] for axis in range(3)])
+    preprocessedNode = self.createPreprocessedNode(volumeNode)
+    try:
+      if resample:
+        interpolationMode = slicer.vtkMRMLCropVolumeParametersNode.InterpolationLinear
+        if volumeNode.IsA('vtkMRMLLabelMapVolumeNode'):
+          interpolationMode = slicer.vtkMRMLCropVolumeParametersNode.InterpolationNearestNeighbor
+        slicer.modules.cropvolume.logic().CropInterpolated(roiNode, volumeNode, preprocessedNode, True,
+                                                           self.getSpacingScale(volumeNode), interpolationMode, 0.0)
+      else:
+        slicer.modules.cropvolume.logic().CropVoxelBased(roiNode, volumeNode, preprocessedNode)
+    finally:
+      slicer.mrmlScene.RemoveNode(roiNode)
+    self.preprocessedNodes[volumeNode.GetID()] = preprocessedNode
+    return preprocessedNode
+
+  def getVolumeBounds(self, volumeNode):
+    extent = volumeNode.GetImageData().GetExtent()
+    return self.getIJKBoxBounds(volumeNode, [extent[0] - 0.5, extent[2] - 0.5, extent[4] - 0.5],
+                                [extent[1] + 0.5, extent[3] + 0.5, extent[5] + 0.5])
+
+  def isResampled(self, volumeNode):
+    return self.workingSpacing is not None and min(volumeNode.GetSpacing()) < self.workingSpacing
+
+  def getSpacingScale(self, volumeNode):
+    """
+    Return the scale of the finest spacing of volumeNode giving the working spacing, as used by the Crop Volume module.
+    """
+    return self.workingSpacing / min(volumeNode.GetSpacing())
+
+  def estimateDimensions(self, volumeNode):
+    """
+    Return the dimensions of volumeNode once resampled to the working spacing, without resampling it.
+    """
+    dimensions = volumeNode.GetImageData().GetDimensions()
+    if not self.isResampled(volumeNode):
+      return list(dimensions)
+    spacing = volumeNode.GetSpacing()
+    return [max(1, math.ceil(dimensions[axis] * spacing[axis] / self.workingSpacing)) for axis in range(3)]
+
+  def estimateVoxelCount(self, volumeNode):
+    """
+    Return the number of voxels of volumeNode once resampled to the working spacing, without resampling it.
+    """
+    if not self.isResampled(volumeNode):
+      return self.getVoxelCount(volumeNode)
+    dimensions = self.estimateDimensions(volumeNode)
+    return dimensions[0] * dimensions[1] * dimensions[2]
+
+  @staticmethod
+  def createPreprocessedNode(volumeNode):
+    node = slicer.mrmlScene.AddNewNodeByClass(volumeNode.GetClassName(), volumeNode.GetName() + '_preprocessed')
+    node.SetHideFromEditors(True)
+    node.SetSaveWithScene(False)
+    return node
+
+  def getVoxelCounts(self):
+    """
+    Return the number of voxels of the original and preprocessed volumes.
+    """
+    original = preprocessed = 0
+    for nodeID, node in self.preprocessedNodes.items():
+      original += self.getVoxelCount(slicer.mrmlScene.GetNodeByID(nodeID))
+      preprocessed += self.getVoxelCount(node)
+    return original, preprocessed
+
+  @staticmethod
+  def getVoxelCount(volumeNode):
+    dimensions = volumeNode.GetImageData().GetDimensions() if volumeNode and volumeNode.GetImageData() else (0, 0, 0)
+    return dimensions[0] * dimensions[1] * dimensions[2]
+
+  def cleanup(self):
+    for node in self.preprocessedNodes.values():
+      slicer.mrmlScene.RemoveNode(node)
+    self.preprocessedNodes = {}
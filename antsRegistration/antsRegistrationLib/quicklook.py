@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import slicer
+
+from .batch import copyParameters
+from .checkpoints import LINEAR_TRANSFORMS
+from .jobs import RegistrationJob
+
+
+def getQuickLookStages(stages, numberOfLevels=1, iterationFactor=0.2, minimumIterations=10):
+  """
+  Return a copy of the stages keeping only their numberOfLevels coarsest levels, with the iterations scaled by iterationFactor.
+  """
+  quickStages = copyParameters(stages)
+  for stage in quickStages:
+    steps = stage['levels']['steps'][:max(1, numberOfLevels)]
+    for step in steps:
+      step['convergence'] = min(int(step['convergence']), max(minimumIterations, int(int(step['convergence']) * iterationFactor)))
+    stage['levels']['steps'] = steps
+  return quickStages
+
+
+def getNumberOfLeadingLinearStages(stages):
+  numberOfStages = 0
+  for stage in stages:
+    if stage['transformParameters']['transform'] not in LINEAR_TRANSFORMS:
+      break
+    numberOfStages += 1
+  return numberOfStages
+
+
+class QuickLookRegistration:
+  """
+  Progressive refinement: runs the stages truncated to their coarsest levels with fewer iterations, writing to the
+  outputs so that the result is shown within seconds, then continues with the full schedule, which overwrites them.
+  The full run starts from the transform the quick look computed for the leading linear stages. Deformable
+  stages are computed from scratch, as a coarse displacement field would be composed with the full one.
+  :param parameters: keyword arguments of antsRegistrationLogic.process
+  :param jobQueue: optional JobQueue the two runs are submitted to, they are launched directly otherwise
+  :param onQuickLookFinished: optional callable receiving the quick look RegistrationJob once finished
+  :param onFinished: optional callable receiving the full RegistrationJob once finished
+  """
+
+  def __init__(self, logic, parameters, numberOfLevels=1, iterationFactor=0.2, jobQueue=None, onQuickLookFinished=None, onFinished=None):
+    self.logic = logic
+    self.parameters = parameters
+    self.numberOfLevels = numberOfLevels
+    self.iterationFactor = iterationFactor
+    self.jobQueue = jobQueue
+    self.onQuickLookFinished = onQuickLookFinished
+    self.onFinished = onFinished
+    self.quickLookJob = None
+    self.fullJob = None
+    self.checkpointDirectory = None
+    self._cancelled = False
+
+  def getQuickLookParameters(self):
+    parameters = dict(self.parameters)
+    parameters['stages'] = getQuickLookStages(self.parameters['stages'], self.numberOfLevels, self.iterationFactor)
+    outputSettings = dict(self.parameters['outputSettings'])
+    for key in ['inverseTransform', 'inverseVolume', 'applyVolumes', 'telemetryTable', 'telemetryFile']:
+      outputSettings[key] = None
+    parameters['outputSettings'] = outputSettings
+    parameters['useCheckpoints'] = False
+    parameters['earlyTermination'] = None
+    parameters['checkpointDirectory'] = self.checkpointDirectory
+    return parameters
+
+  def getFullParameters(self):
+    parameters = dict(self.parameters)
+    numberOfStages = getNumberOfLeadingLinearStages(self.parameters['stages'])
+    warmStartFile = os.path.join(self.checkpointDirectory, 'stage%i.h5' % numberOfStages)
+    if numberOfStages and os.path.isfile(warmStartFile):
+      # the checkpoint includes the initial transform
+      parameters['initialTransformSettings'] = {'initialTransformFile': warmStartFile}
+    return parameters
+
+  def start(self):
+    self.checkpointDirectory = tempfile.mkdtemp(prefix='antsQuickLook', dir=slicer.app.temporaryPath)
+    self.quickLookJob = self.launch(self.getQuickLookParameters(), 'quick look')
+    self.quickLookJob.addFinishedCallback(self.onQuickLookJobFinished)
+
+  def launch(self, parameters, suffix):
+    name = '%s (%s)' % (RegistrationJob.getNameFromParameters(parameters), suffix)
+    if self.jobQueue is not None:
+      return self.jobQueue.submit(parameters, name)
+    job = RegistrationJob(parameters, name)
+    self.logic.runJob(job)
+    return job
+
+  def onQuickLookJobFinished(self, job):
+    if self.onQuickLookFinished:
+      self.onQuickLookFinished(job)
+    if self._cancelled or job.status != RegistrationJob.COMPLETED:
+      self.cleanup()
+      return
+    try:
+      self.fullJob = self.launch(self.getFullParameters(), 'full')
+    except Exception:
+      self.cleanup()
+      raise
+    self.fullJob.addFinishedCallback(self.onFullJobFinished)
+
+  def onFullJobFinished(self, job):
+    # the warm start transform is read by the cli until it finishes
+    self.cleanup()
+    if self.onFinished:
+      self.onFinished(job)
+
+  def cancel(self):
+    self._cancelled = True
+    for job in [self.quickLookJob, self.fullJob]:
+      if job is not None and not job.isFinished():
+        job.cancel()
+
+  def isFinished(self):
+    if self.fullJob is not None:
+      return self.fullJob.isFinished()
+    return self.quickLookJob is not None and self.quickLookJob.isFinished() and (self._cancelled or self.quickLookJob.status != RegistrationJob.COMPLETED)
+
+  def cleanup(self):
+    if self.checkpointDirectory is not None:
+      shutil.rmtree(self.checkpointDirectory, ignore_errors=True)
+      self.checkpointDirectory = None
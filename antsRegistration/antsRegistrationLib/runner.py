@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import subprocess
+
+from .command import AntsCommandBuilder, writeInputVolumeList
+from .validation import validateStages
+
+
+class AntsRegistrationRunner:
+  """
+  Runs the antsRegistrationCLI executable on files, without starting Slicer or creating a scene.
+  Takes the same preset dictionaries as antsRegistrationLogic.process with file paths in place of nodes:
+  outputSettings 'transform' (composite .h5, or displacement field .nrrd with 'useDisplacementField'),
+  'volume', 'inverseTransform' and 'inverseVolume' are the output file paths.
+  """
+
+  EXECUTABLE_NAME = 'antsRegistrationCLI'
+  EXECUTABLE_ENVIRONMENT_VARIABLE = 'ANTS_REGISTRATION_CLI'
+
+  def __init__(self, executable=None):
+    self.executable = executable if executable else self.findExecutable()
+
+  @classmethod
+  def findExecutable(cls):
+    """
+    Return the antsRegistrationCLI path from the environment, the cli-modules directory next to this
+    module in a Slicer installation or the PATH.
+    """
+    executable = os.environ.get(cls.EXECUTABLE_ENVIRONMENT_VARIABLE)
+    if executable:
+      return executable
+    executableName = cls.EXECUTABLE_NAME + ('.exe' if os.name == 'nt' else '')
+    modulesDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    candidate = os.path.join(os.path.dirname(modulesDirectory), 'cli-modules', executableName)
+    if os.path.isfile(candidate):
+      return candidate
+    executable = shutil.which(cls.EXECUTABLE_NAME)
+    if executable is None:
+      raise RuntimeError('%s not found. Set %s to its path.' % (cls.EXECUTABLE_NAME, cls.EXECUTABLE_ENVIRONMENT_VARIABLE))
+    return executable
+
+  def getCLIParameters(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None):
+    """
+    Return the antsRegistrationCLI parameters dictionary, mirroring antsRegistrationLogic.createCLIParameters.
+    """
+    errors = validateStages(stages)
+    if errors:
+      raise ValueError('Invalid registration stages:\n' + '\n'.join(errors))
+    if generalSettings is None:
+      generalSettings = {}
+    initialTransformSettings = dict(initialTransformSettings) if initialTransformSettings else {}
+    initialTransformSettings['fixedImageNode'] = stages[0]['metrics'][0]['fixed']
+    initialTransformSettings['movingImageNode'] = stages[0]['metrics'][0]['moving']
+
+    commandBuilder = AntsCommandBuilder()
+    commandBuilder.getPlaceholder(stages[0]['metrics'][0]['fixed']) # put in first position. will be used as reference in cli
+    parameters = commandBuilder.parameters
+    parameters['antsCommand'] = commandBuilder.getAntsRegistrationCommand(stages, outputSettings, initialTransformSettings, generalSettings)
+
+    if outputSettings.get('transform') is not None:
+      if outputSettings.get('useDisplacementField'):
+        parameters['outputDisplacementField'] = outputSettings['transform']
+      else:
+        parameters['outputCompositeTransform'] = outputSettings['transform']
+    if outputSettings.get('inverseTransform') is not None:
+      parameters['outputInverseCompositeTransform'] = outputSettings['inverseTransform']
+    if 'nativeMovingVolume' in parameters:
+      parameters['outputInterpolation'] = outputSettings['interpolation']
+
+    parameters['useFloat'] = (generalSettings.get('computationPrecision', 'float') == 'float')
+    parameters['numberOfThreads'] = int(generalSettings.get('numberOfThreads', 0))
+    return parameters
+
+  def getCommandLine(self, parameters):
+    commandLine = [self.executable]
+    for name, value in parameters.items():
+      if isinstance(value, bool):
+        if value:
+          commandLine.append('--' + name)
+      elif isinstance(value, (list, tuple)):
+        commandLine += ['--' + name, ','.join(value)]
+      else:
+        commandLine += ['--' + name, str(value)]
+    return commandLine
+
+  def run(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None, onOutput=None):
+    """
+    Run the registration and wait for it to finish.
+    :param onOutput: optional callable receiving each line of the CLI output (e.g. AntsLogParser.feed)
+    :return: the CLI output
+    """
+    parameters = self.getCLIParameters(stages, outputSettings, initialTransformSettings, generalSettings)
+    return self.runParameters(parameters, onOutput)
+
+  def runParameters(self, parameters, onOutput=None):
+    """
+    Run antsRegistrationCLI with a parameters dictionary holding file paths and wait for it to finish. Return the CLI output.
+    """
+    parameters = dict(parameters)
+    outputTransform = parameters.get('outputCompositeTransform')
+    temporaryDirectory = None
+    if outputTransform and not outputTransform.endswith('Composite.h5'):
+      # the cli derives the output base of antsRegistration from the composite transform file name
+      temporaryDirectory = tempfile.mkdtemp(prefix='antsRegistration')
+      parameters['outputCompositeTransform'] = os.path.join(temporaryDirectory, 'Composite.h5')
+    if isinstance(parameters.get('inputVolumeList'), (list, tuple)):
+      if temporaryDirectory is None:
+        temporaryDirectory = tempfile.mkdtemp(prefix='antsRegistration')
+      parameters['inputVolumeList'] = writeInputVolumeList(parameters['inputVolumeList'], temporaryDirectory)
+    try:
+      output = self.runCommandLine(self.getCommandLine(parameters), onOutput)
+      if outputTransform and parameters['outputCompositeTransform'] != outputTransform:
+        shutil.move(parameters['outputCompositeTransform'], outputTransform)
+    finally:
+      if temporaryDirectory:
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    return output
+
+  @staticmethod
+  def runCommandLine(commandLine, onOutput=None):
+    process = subprocess.Popen(commandLine, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    output = []
+    for line in process.stdout:
+      output.append(line)
+      if onOutput:
+        onOutput(line)
+    process.wait()
+    if process.returncode != 0:
+      raise RuntimeError('%s failed with exit code %i:\n%s' % (os.path.basename(commandLine[0]), process.returncode, ''.join(output[-20:])))
+    return ''.join(output)
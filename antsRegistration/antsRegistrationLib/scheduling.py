@@ -0,0 +1,53 @@
+import os
+
+
+class CoreScheduler:
+  """
+  Splits the cores of the machine across concurrent registrations so that they do not oversubscribe it.
+  With threadsPerJob set, every job gets that many threads (e.g. 8 jobs x 8 threads on 64 cores).
+  Otherwise the free cores are shared equally by the jobs that can be started, using at least
+  minThreadsPerJob threads each (e.g. a single queued job gets all 64 cores).
+  """
+
+  def __init__(self, totalCores=None, threadsPerJob=None, minThreadsPerJob=1):
+    self.totalCores = totalCores if totalCores else self.getAvailableCores()
+    self.threadsPerJob = min(threadsPerJob, self.totalCores) if threadsPerJob else None
+    self.minThreadsPerJob = max(1, min(minThreadsPerJob, self.totalCores))
+    self._allocated = {}  # jobID: threads
+
+  @staticmethod
+  def getAvailableCores():
+    if hasattr(os, 'sched_getaffinity'):
+      return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+  @property
+  def allocatedCores(self):
+    return sum(self._allocated.values())
+
+  @property
+  def freeCores(self):
+    return self.totalCores - self.allocatedCores
+
+  def canStartJob(self):
+    return self.freeCores >= (self.threadsPerJob or self.minThreadsPerJob)
+
+  def getThreadsForNextJob(self, numberOfStartableJobs=1):
+    """
+    Return the number of threads the next job should use given how many jobs can be started now, or 0 if none.
+    """
+    if not self.canStartJob():
+      return 0
+    if self.threadsPerJob:
+      return self.threadsPerJob
+    numberOfStartableJobs = max(1, min(numberOfStartableJobs, self.freeCores // self.minThreadsPerJob))
+    return max(self.minThreadsPerJob, self.freeCores // numberOfStartableJobs)
+
+  def allocate(self, jobID, numberOfStartableJobs=1):
+    threads = self.getThreadsForNextJob(numberOfStartableJobs)
+    if threads:
+      self._allocated[jobID] = threads
+    return threads
+
+  def release(self, jobID):
+    self._allocated.pop(jobID, None)
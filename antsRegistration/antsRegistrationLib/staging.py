@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import slicer
+
+from .ioprofiles import getIOProfile
+
+
+class InputStager:
+  """
+  Writes input volumes to files that are shared across antsRegistrationCLI invocations,
+  so that an unmodified node (e.g. the fixed image of a batch) is exported only once.
+  A staged file is re-written when the node or its image data is modified.
+  Files are written with the given IOProfile, by default the one of the antsRegistration/IOProfile setting.
+  """
+
+  _stagedNodeIDs = {}  # filePath: nodeID, for all live stagers
+
+  def __init__(self, stagingDirectory=None, ioProfile=None):
+    self._stagingDirectory = stagingDirectory
+    self.ioProfile = getIOProfile(ioProfile)
+    self._ownsDirectory = stagingDirectory is None
+    self._stagedFiles = {}  # nodeID: (modifiedTime, filePath)
+
+  @property
+  def stagingDirectory(self):
+    if self._stagingDirectory is None:
+      self._stagingDirectory = tempfile.mkdtemp(prefix='antsStaging', dir=slicer.app.temporaryPath)
+    return self._stagingDirectory
+
+  @staticmethod
+  def getModifiedTime(node):
+    imageData = node.GetImageData()
+    return (node.GetMTime(), imageData.GetMTime() if imageData else 0)
+
+  def stageNode(self, node):
+    """
+    Return the path of a file holding the node data, writing it only if needed.
+    """
+    modifiedTime = self.getModifiedTime(node)
+    staged = self._stagedFiles.get(node.GetID())
+    if staged and staged[0] == modifiedTime and os.path.isfile(staged[1]):
+      return staged[1]
+    filePath = os.path.join(self.stagingDirectory, self.ioProfile.getFileName(node.GetID()))
+    self.ioProfile.writeVolume(node, filePath)
+    # writing must not count as a modification of the node
+    self._stagedFiles[node.GetID()] = (self.getModifiedTime(node), filePath)
+    self._stagedNodeIDs[filePath] = node.GetID()
+    return filePath
+
+  @classmethod
+  def getStagedNodeID(cls, filePath):
+    return cls._stagedNodeIDs.get(filePath)
+
+  def cleanup(self):
+    for modifiedTime, filePath in self._stagedFiles.values():
+      self._stagedNodeIDs.pop(filePath, None)
+      if os.path.isfile(filePath):
+        os.remove(filePath)
+    self._stagedFiles = {}
+    if self._ownsDirectory and self._stagingDirectory is not None:
+      shutil.rmtree(self._stagingDirectory, ignore_errors=True)
+      self._stagingDirectory = None
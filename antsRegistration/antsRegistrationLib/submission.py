@@ -0,0 +1,97 @@
+import os
+import qt, slicer
+
+from .backends import JobManifest
+from .cache import RegistrationCache
+from .ioprofiles import getIOProfile
+from .staging import InputStager
+
+
+class SubmittedRegistration:
+  """
+  A registration of scene nodes executed by an ExecutionBackend. Inputs are written to the job directory,
+  the job manifest refers to them by file path, and once the job completed its output files are read back
+  into the output nodes. Volume files are written with the given IOProfile.
+  """
+
+  OUTPUT_FILE_NAMES = {
+    'outputCompositeTransform': 'transformComposite.h5',
+    'outputDisplacementField': 'displacementField.nrrd',
+    'outputVolume': 'volume',  # extension of the I/O profile
+    'outputInverseCompositeTransform': 'inverseTransform.h5',
+    'outputInverseVolume': 'inverseVolume',  # extension of the I/O profile
+    }
+
+  def __init__(self, logic, backend, jobDirectory, onFinished=None, pollInterval=2000, ioProfile=None):
+    self.logic = logic
+    self.ioProfile = getIOProfile(ioProfile)
+    self.backend = backend
+    self.jobDirectory = jobDirectory
+    self.onFinished = onFinished
+    self.manifest = None
+    self.outputNodeIDs = {}  # cli parameter name: node ID
+    self.errorText = ''
+    self._timer = qt.QTimer()
+    self._timer.setInterval(pollInterval)
+    self._timer.connect('timeout()', self.poll)
+
+  def createManifest(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None):
+    inputDirectory = os.path.join(self.jobDirectory, 'inputs')
+    outputDirectory = os.path.join(self.jobDirectory, 'outputs')
+    os.makedirs(inputDirectory, exist_ok=True)
+    os.makedirs(outputDirectory, exist_ok=True)
+    cliParams = dict(self.logic.createCLIParameters(stages, outputSettings, initialTransformSettings, generalSettings,
+                                                    InputStager(inputDirectory, self.ioProfile)))
+    cliParams.pop('controlFile', None)
+    if 'inputTransform' in cliParams:
+      transformNode = slicer.mrmlScene.GetNodeByID(cliParams['inputTransform'])
+      cliParams['inputTransform'] = os.path.join(inputDirectory, 'initialTransform.h5')
+      self.writeNode(transformNode, cliParams['inputTransform'])
+    for name, fileName in self.OUTPUT_FILE_NAMES.items():
+      if name in cliParams:
+        self.outputNodeIDs[name] = cliParams[name]
+        if name in ['outputVolume', 'outputInverseVolume']:
+          fileName = self.ioProfile.getFileName(fileName)
+        cliParams[name] = os.path.join(outputDirectory, fileName)
+    self.manifest = JobManifest(self.jobDirectory, cliParams)
+    return self.manifest
+
+  def writeNode(self, node, filePath):
+    storageNode = RegistrationCache.createStorageNode(node, self.ioProfile)
+    storageNode.SetFileName(filePath)
+    if not storageNode.WriteData(node):
+      raise RuntimeError('Unable to write %s to %s' % (node.GetName(), filePath))
+
+  def submit(self, stages, outputSettings, initialTransformSettings=None, generalSettings=None):
+    self.createManifest(stages, outputSettings, initialTransformSettings, generalSettings)
+    self.backend.submit(self.manifest)
+    self._timer.start()
+    return self.manifest.jobID
+
+  def getStatus(self):
+    return self.manifest.getStatus()['status'] if self.manifest else JobManifest.SUBMITTED
+
+  def cancel(self):
+    self.backend.cancel(self.manifest)
+    self.poll()
+
+  def poll(self):
+    status = self.manifest.getStatus()
+    if status['status'] not in [JobManifest.COMPLETED, JobManifest.FAILED, JobManifest.CANCELLED]:
+      return
+    self._timer.stop()
+    self.errorText = status.get('errorText', '')
+    if status['status'] == JobManifest.COMPLETED:
+      self.loadOutputs()
+    if self.onFinished:
+      self.onFinished(self)
+
+  def loadOutputs(self):
+    for name, nodeID in self.outputNodeIDs.items():
+      node = slicer.mrmlScene.GetNodeByID(nodeID)
+      if node is None:
+        continue
+      storageNode = RegistrationCache.createStorageNode(node, self.ioProfile)
+      storageNode.SetFileName(self.manifest.parameters[name])
+      if not storageNode.ReadData(node):
+        self.errorText = 'Unable to read %s' % self.manifest.parameters[name]
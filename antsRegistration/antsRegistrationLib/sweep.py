@@ -0,0 +1,335 @@
+import time
+import itertools
+import slicer
+
+from .batch import copyParameters
+from .scheduling import CoreScheduler
+from .telemetry import AntsLogParser
+from .util import antsBase
+
+
+LEVEL_STEP_KEYS = {'convergence': int, 'smoothingSigmas': float, 'shrinkFactors': int}
+LEVEL_KEYS = ['convergenceThreshold', 'convergenceWindowSize', 'smoothingSigmasUnit']
+RANK_KEYS = ['finalMetricValue', 'wallTime', 'peakMemoryMB']
+
+
+def toNumber(text):
+  number = float(text)
+  return int(number) if number == int(number) else number
+
+
+def setStageParameter(stages, path, value):
+  """
+  Set the parameter of the stages given by a path:
+  '<stage>.transform.<setting>' e.g. '2.transform.gradientStep',
+  '<stage>.metrics.<metric>.<setting>' e.g. '0.metrics.0.numberOfBins' or
+  '<stage>.levels.<key>' e.g. '0.levels.shrinkFactors' with one value per level ('8x4x2x1') or '0.levels.convergenceThreshold'.
+  Stage is an index or * for all the stages. Settings are named as in the settings format of the transform or metric.
+  """
+  parts = path.split('.')
+  try:
+    stageIndices = range(len(stages)) if parts[0] == '*' else [int(parts[0])]
+    for stageIndex in stageIndices:
+      stage = stages[stageIndex]
+      if len(parts) == 3 and parts[1] == 'transform':
+        setSetting(stage['transformParameters'], stage['transformParameters']['transform'], parts[2], value)
+      elif len(parts) == 4 and parts[1] == 'metrics':
+        metric = stage['metrics'][int(parts[2])]
+        setSetting(metric, metric['type'], parts[3], value)
+      elif len(parts) == 3 and parts[1] == 'levels':
+        setLevelsParameter(stage['levels'], parts[2], value)
+      else:
+        raise ValueError('Invalid sweep parameter %s' % path)
+  except IndexError:
+    raise ValueError('Sweep parameter %s is out of the stages' % path)
+
+
+def setSetting(parameters, name, settingName, value):
+  """
+  Set a setting of the comma separated settings of a transform or metric, filling the missing ones with their defaults.
+  """
+  subClass = antsBase.getSubClassByName(name)
+  settingNames = [setting.name for setting in subClass.settingsSchema] if subClass else []
+  if settingName not in settingNames:
+    raise ValueError('%s has no setting %s' % (name, settingName))
+  index = settingNames.index(settingName)
+  values = [val.strip() for val in str(parameters['settings']).split(',')] if str(parameters['settings']).strip() else []
+  defaults = subClass.settingsDefault.split(',') if subClass.settingsDefault else []
+  while len(values) <= index:
+    values.append(defaults[len(values)] if len(values) < len(defaults) else '')
+  values[index] = str(value)
+  parameters['settings'] = ','.join(values)
+
+
+def setLevelsParameter(levels, key, value):
+  if key in LEVEL_STEP_KEYS:
+    values = [LEVEL_STEP_KEYS[key](toNumber(val)) for val in str(value).split('x')]
+    steps = levels['steps']
+    # a schedule with another number of levels repeats the settings of the last level
+    steps[:] = [dict(steps[min(index, len(steps) - 1)]) for index in range(len(values))]
+    for step, val in zip(steps, values):
+      step[key] = int(val) if val == int(val) else val
+  elif key in LEVEL_KEYS:
+    levels[key] = value if key == 'smoothingSigmasUnit' else toNumber(value)
+  else:
+    raise ValueError('Unknown levels parameter %s' % key)
+
+
+def expandGrid(stages, grid):
+  """
+  Return the (combination, stages) of every combination of the grid, a dictionary of parameter path: list of values.
+  """
+  paths = list(grid.keys())
+  combinations = []
+  for values in itertools.product(*[grid[path] for path in paths]):
+    combination = dict(zip(paths, values))
+    combinationStages = copyParameters(stages)
+    for path, value in combination.items():
+      setStageParameter(combinationStages, path, value)
+    combinations.append((combination, combinationStages))
+  return combinations
+
+
+def formatCombination(combination):
+  return ', '.join('%s=%s' % (path, value) for path, value in combination.items())
+
+
+class SweepItem:
+  """
+  A combination of the sweep registered on one fixed/moving pair.
+  """
+
+  QUEUED = 'Queued'
+  RUNNING = 'Running'
+  COMPLETED = 'Completed'
+  FAILED = 'Failed'
+  CANCELLED = 'Cancelled'
+
+  def __init__(self, combinationIndex, pairIndex, stages):
+    self.combinationIndex = combinationIndex
+    self.pairIndex = pairIndex
+    self.stages = stages
+    self.status = self.QUEUED
+    self.cliNode = None
+    self.startTime = None
+    self.endTime = None
+    self.numberOfThreads = 0
+    self.finalMetricValue = None
+    self.peakMemoryMB = None
+    self.errorText = ''
+    self._observerTag = None
+
+  @property
+  def wallTime(self):
+    if self.startTime is None:
+      return 0.0
+    return (self.endTime if self.endTime is not None else time.time()) - self.startTime
+
+  def isFinished(self):
+    return self.status in [self.COMPLETED, self.FAILED, self.CANCELLED]
+
+
+class ParameterSweep:
+  """
+  Registers every combination of a parameter grid over base stages on a few representative fixed/moving pairs.
+  Registrations run concurrently, at most maxConcurrentJobs at a time within the cores of the scheduler, without
+  outputs: the final metric value, wall time and peak memory of each are parsed from the ANTs output and the
+  combinations are ranked on them. Final metric values are only comparable between combinations using the same metrics.
+  """
+
+  def __init__(self, logic, stages, grid, pairs=None, initialTransformSettings=None, generalSettings=None,
+               maxConcurrentJobs=2, scheduler=None, onItemFinished=None, onFinished=None):
+    self.logic = logic
+    self.stages = stages
+    self.grid = grid
+    self.combinations = expandGrid(stages, grid)
+    templateFixed = stages[0]['metrics'][0]['fixed']
+    templateMoving = stages[0]['metrics'][0]['moving']
+    self.pairs = pairs if pairs else [(templateFixed, templateMoving)]
+    self._pairNodes = {}  # pairIndex: [fixed node, moving node]
+    self.initialTransformSettings = initialTransformSettings if initialTransformSettings is not None else {}
+    self.generalSettings = generalSettings if generalSettings is not None else {}
+    self.maxConcurrentJobs = max(1, int(maxConcurrentJobs))
+    self.scheduler = scheduler if scheduler is not None else CoreScheduler()
+    self.onItemFinished = onItemFinished
+    self.onFinished = onFinished
+    self.items = []
+    for combinationIndex, (combination, combinationStages) in enumerate(self.combinations):
+      for pairIndex, (fixed, moving) in enumerate(self.pairs):
+        itemStages = copyParameters(combinationStages)
+        for stage in itemStages:
+          for metric in stage['metrics']:
+            if not metric['fixed'] or metric['fixed'] == templateFixed:
+              metric['fixed'] = fixed
+            if not metric['moving'] or metric['moving'] == templateMoving:
+              metric['moving'] = moving
+        self.items.append(SweepItem(combinationIndex, pairIndex, itemStages))
+    self._cancelled = False
+    self._launching = False
+
+  def start(self):
+    self.launchQueuedItems()
+
+  def wait(self, pollInterval=0.1):
+    while not self.isFinished():
+      slicer.app.processEvents()
+      time.sleep(pollInterval)
+
+  def cancel(self):
+    self._cancelled = True
+    for item in self.items:
+      if item.status == SweepItem.QUEUED:
+        item.status = SweepItem.CANCELLED
+        item.endTime = time.time()
+      elif item.status == SweepItem.RUNNING:
+        item.cliNode.Cancel()
+    if self.isFinished() and self.onFinished:
+      self.onFinished(self)
+
+  def isFinished(self):
+    return all(item.isFinished() for item in self.items)
+
+  def getRunningItems(self):
+    return [item for item in self.items if item.status == SweepItem.RUNNING]
+
+  def getQueuedItems(self):
+    return [item for item in self.items if item.status == SweepItem.QUEUED]
+
+  def launchQueuedItems(self):
+    if self._launching:
+      # an item finished while being launched, the running loop goes on with the next ones
+      return
+    self._launching = True
+    try:
+      self._launchQueuedItems()
+    finally:
+      self._launching = False
+
+  def _launchQueuedItems(self):
+    while not self._cancelled and self.getQueuedItems() and len(self.getRunningItems()) < self.maxConcurrentJobs:
+      if not self.logic.canStartCLI():
+        self.logic.callWhenCLICanStart(self.launchQueuedItems)
+        break
+      queuedItems = self.getQueuedItems()
+      numberOfStartableItems = min(len(queuedItems), self.maxConcurrentJobs - len(self.getRunningItems()))
+      item = queuedItems[0]
+      item.numberOfThreads = self.scheduler.allocate(id(item), numberOfStartableItems)
+      if not item.numberOfThreads:
+        break
+      self.launchItem(item)
+
+  def launchItem(self, item):
+    item.startTime = time.time()
+    outputSettings = {'transform': None, 'volume': None, 'interpolation': 'Linear'}
+    generalSettings = copyParameters(self.generalSettings)
+    generalSettings['numberOfThreads'] = item.numberOfThreads
+    try:
+      self.loadPairNodes(item)
+      cliParams = self.logic.createCLIParameters(item.stages, outputSettings, copyParameters(self.initialTransformSettings), generalSettings)
+    except Exception as e:
+      item.errorText = str(e)
+      self.finishItem(item, SweepItem.FAILED)
+      return
+    item.status = SweepItem.RUNNING
+    item.cliNode = self.logic.runCLI(dict(cliParams))
+    item._observerTag = item.cliNode.AddObserver('ModifiedEvent', lambda caller, event, item=item: self.onItemStatusUpdate(item))
+
+  def loadPairNodes(self, item):
+    """
+    Replace the file paths of the pair of an item in its stages by nodes, loaded once for all the combinations.
+    """
+    pair = self.pairs[item.pairIndex]
+    if item.pairIndex not in self._pairNodes:
+      self._pairNodes[item.pairIndex] = [slicer.util.loadVolume(value, {'show': False}) if isinstance(value, str) else value
+                                         for value in pair]
+    for stage in item.stages:
+      for metric in stage['metrics']:
+        for role, value, node in zip(['fixed', 'moving'], pair, self._pairNodes[item.pairIndex]):
+          if isinstance(value, str) and metric[role] == value:
+            metric[role] = node
+
+  def onItemStatusUpdate(self, item):
+    if item.isFinished():
+      return
+    status = item.cliNode.GetStatus()
+    if status & item.cliNode.Cancelled:
+      self.finishItem(item, SweepItem.CANCELLED)
+    elif status & item.cliNode.Completed:
+      parser = AntsLogParser()
+      parser.feed(item.cliNode.GetOutputText() or '')
+      parser.flush()
+      item.finalMetricValue = parser.finiteOrNone(parser.getFinalMetricValue())
+      item.peakMemoryMB = parser.peakMemoryMB
+      if status & item.cliNode.ErrorsMask:
+        item.errorText = item.cliNode.GetErrorText()
+        self.finishItem(item, SweepItem.FAILED)
+      else:
+        self.finishItem(item, SweepItem.COMPLETED)
+
+  def finishItem(self, item, status):
+    item.status = status
+    item.endTime = time.time()
+    self.scheduler.release(id(item))
+    if item.cliNode is not None and item._observerTag is not None:
+      item.cliNode.RemoveObserver(item._observerTag)
+      item._observerTag = None
+    if self.onItemFinished:
+      self.onItemFinished(item)
+    self.launchQueuedItems()
+    if self.isFinished() and self.onFinished:
+      self.onFinished(self)
+
+  def getResults(self):
+    """
+    Return one result per combination: mean final metric value and total wall time over the pairs, largest peak memory.
+    A combination failing on any pair has status Failed.
+    """
+    results = []
+    for combinationIndex, (combination, stages) in enumerate(self.combinations):
+      items = [item for item in self.items if item.combinationIndex == combinationIndex]
+      statuses = [item.status for item in items]
+      status = SweepItem.COMPLETED
+      for candidate in [SweepItem.FAILED, SweepItem.CANCELLED, SweepItem.RUNNING, SweepItem.QUEUED]:
+        if candidate in statuses:
+          status = candidate
+          break
+      metricValues = [item.finalMetricValue for item in items if item.finalMetricValue is not None]
+      peakMemories = [item.peakMemoryMB for item in items if item.peakMemoryMB is not None]
+      results.append({
+        'combination': combination,
+        'parameters': formatCombination(combination),
+        'stages': stages,
+        'status': status,
+        'finalMetricValue': sum(metricValues) / len(metricValues) if len(metricValues) == len(items) else None,
+        'wallTime': sum(item.wallTime for item in items),
+        'peakMemoryMB': max(peakMemories) if peakMemories else None,
+        'errorText': '\n'.join(item.errorText for item in items if item.errorText),
+        })
+    return results
+
+  def getRanking(self, rankBy='finalMetricValue'):
+    """
+    Return the results sorted from best to worst on rankBy (lower is better: ANTs minimizes the metric value),
+    then on wall time. Combinations that did not complete come last.
+    """
+    if rankBy not in RANK_KEYS:
+      raise ValueError('Unknown rank key %s. Use one of %s' % (rankBy, ', '.join(RANK_KEYS)))
+    def rankKey(result):
+      completed = result['status'] == SweepItem.COMPLETED and result[rankBy] is not None
+      return (not completed, result[rankBy] if completed else 0.0, result['wallTime'])
+    return sorted(self.getResults(), key=rankKey)
+
+  def getWinnerStages(self, rankBy='finalMetricValue'):
+    """
+    Return the stages of the best completed combination without their inputs, as saved by PresetManager.saveStagesAsPreset.
+    """
+    ranking = self.getRanking(rankBy)
+    if not ranking or ranking[0]['status'] != SweepItem.COMPLETED:
+      return None
+    stages = copyParameters(ranking[0]['stages'])
+    for stage in stages:
+      for metric in stage['metrics']:
+        metric['fixed'] = None
+        metric['moving'] = None
+      stage['masks'] = {'fixed': None, 'moving': None}
+    return stages
@@ -0,0 +1,219 @@
+import re
+import json
+
+
+class AntsLogParser:
+  """
+  Parses the verbose output of antsRegistration into per-iteration records with the stage, level,
+  iteration, metric value, convergence value and timing. Text can be fed incrementally while the
+  registration runs. Does not depend on Slicer so it can also be used on plain log files.
+  """
+
+  STAGE_PATTERN = re.compile(r'^\s*Stage (\d+)\s*$')
+  TRANSFORM_PATTERN = re.compile(r'\*\*\* Running (.+) registration \*\*\*')
+  LEVEL_PATTERN = re.compile(r'^\s*Current level = (\d+)')
+  DIAGNOSTIC_PATTERN = re.compile(r'^\s*\d?DIAGNOSTIC,\s*(\d+),\s*([^,]+),\s*([^,]+),\s*([^,]+),\s*([^,]+)')
+  STAGE_ELAPSED_PATTERN = re.compile(r'Elapsed time \(stage (\d+)\):\s*(\S+)')
+  TOTAL_ELAPSED_PATTERN = re.compile(r'Total elapsed time:\s*(\S+)')
+  PEAK_MEMORY_PATTERN = re.compile(r'Peak resident memory \(MB\):\s*(\S+)')
+  DISPLACEMENT_FIELD_ELAPSED_PATTERN = re.compile(r'Elapsed time \(displacement field\):\s*(\S+)')
+
+  RECORD_KEYS = ['stage', 'transform', 'level', 'iteration', 'metricValue', 'convergenceValue', 'elapsedTime', 'iterationTime']
+
+  def __init__(self):
+    self.records = []
+    self.stageElapsedTimes = {}
+    self.totalElapsedTime = None
+    self.peakMemoryMB = None
+    self.displacementFieldElapsedTime = None
+    self._stage = 0
+    self._transform = ''
+    self._level = 0
+    self._partialLine = ''
+
+  @staticmethod
+  def toFloat(text):
+    try:
+      return float(text)
+    except ValueError:
+      return float('nan')
+
+  def feed(self, text):
+    """
+    Parse a chunk of output. Return the list of new iteration records.
+    """
+    lines = (self._partialLine + text).split('\n')
+    self._partialLine = lines.pop()
+    numberOfRecords = len(self.records)
+    for line in lines:
+      self.parseLine(line)
+    return self.records[numberOfRecords:]
+
+  def flush(self):
+    newRecords = self.feed('\n') if self._partialLine else []
+    return newRecords
+
+  def parseLine(self, line):
+    match = self.DIAGNOSTIC_PATTERN.match(line)
+    if match:
+      self.records.append({
+        'stage': self._stage,
+        'transform': self._transform,
+        'level': self._level,
+        'iteration': int(match.group(1)),
+        'metricValue': self.toFloat(match.group(2)),
+        'convergenceValue': self.toFloat(match.group(3)),
+        'elapsedTime': self.toFloat(match.group(4)),
+        'iterationTime': self.toFloat(match.group(5)),
+        })
+      return
+    match = self.LEVEL_PATTERN.match(line)
+    if match:
+      self._level = int(match.group(1))
+      return
+    match = self.STAGE_PATTERN.match(line)
+    if match:
+      self._stage = int(match.group(1))
+      self._transform = ''
+      self._level = 0
+      return
+    match = self.TRANSFORM_PATTERN.search(line)
+    if match:
+      self._transform = match.group(1).strip()
+      return
+    match = self.STAGE_ELAPSED_PATTERN.search(line)
+    if match:
+      self.stageElapsedTimes[int(match.group(1))] = self.toFloat(match.group(2))
+      return
+    match = self.TOTAL_ELAPSED_PATTERN.search(line)
+    if match:
+      self.totalElapsedTime = self.toFloat(match.group(1))
+      return
+    match = self.PEAK_MEMORY_PATTERN.search(line)
+    if match:
+      self.peakMemoryMB = self.toFloat(match.group(1))
+      return
+    match = self.DISPLACEMENT_FIELD_ELAPSED_PATTERN.search(line)
+    if match:
+      self.displacementFieldElapsedTime = self.toFloat(match.group(1))
+
+  def getLevelSummaries(self):
+    """
+    Return one entry per stage and level with the number of iterations, the time spent and the last metric value.
+    """
+    summaries = {}
+    for record in self.records:
+      key = (record['stage'], record['level'])
+      if key not in summaries:
+        summaries[key] = {'stage': record['stage'], 'transform': record['transform'], 'level': record['level'],
+                          'iterations': 0, 'time': 0.0, 'finalMetricValue': None}
+      summary = summaries[key]
+      summary['iterations'] += 1
+      summary['time'] += record['iterationTime'] if record['iterationTime'] == record['iterationTime'] else 0.0
+      summary['finalMetricValue'] = record['metricValue']
+    return [summaries[key] for key in sorted(summaries.keys())]
+
+  def getFinalMetricValue(self):
+    return self.records[-1]['metricValue'] if self.records else None
+
+  @staticmethod
+  def finiteOrNone(value):
+    return value if isinstance(value, float) and value == value and abs(value) != float('inf') else None
+
+  def toDict(self):
+    """
+    Return records and summaries with non finite values (e.g. the first convergence value) set to None.
+    """
+    records = [{key: (self.finiteOrNone(val) if isinstance(val, float) else val) for key, val in record.items()}
+               for record in self.records]
+    return {
+      'records': records,
+      'levels': self.getLevelSummaries(),
+      'stageElapsedTimes': {str(stage): elapsed for stage, elapsed in self.stageElapsedTimes.items()},
+      'totalElapsedTime': self.totalElapsedTime,
+      'peakMemoryMB': self.peakMemoryMB,
+      'displacementFieldElapsedTime': self.displacementFieldElapsedTime,
+      }
+
+  def writeJSON(self, filePath):
+    with open(filePath, 'w') as outfile:
+      json.dump(self.toDict(), outfile, indent=2)
+
+
+class RegistrationTelemetry:
+  """
+  Follows the output of a running antsRegistrationCLI node, fills an optional vtkMRMLTableNode with
+  the iteration records while it runs and writes them to an optional JSON file once it is done.
+  onRecords is called with every batch of new records and onFinished once the CLI is done.
+  """
+
+  COLUMN_TYPES = {'transform': 'string', 'metricValue': 'double', 'convergenceValue': 'double',
+                  'elapsedTime': 'double', 'iterationTime': 'double'}
+
+  def __init__(self, cliNode, tableNode=None, filePath=None, onRecords=None, onFinished=None):
+    self.cliNode = cliNode
+    self.tableNode = tableNode
+    self.filePath = filePath
+    self.onRecords = onRecords
+    self.onFinished = onFinished
+    self.parser = AntsLogParser()
+    self._parsedText = ''
+    self._observerTag = None
+    if self.tableNode is not None:
+      self.initializeTable()
+    self.onStatusUpdate()
+    if not self.isDone():
+      self._observerTag = self.cliNode.AddObserver('ModifiedEvent', self.onStatusUpdate)
+
+  def isDone(self):
+    return (self.cliNode.GetStatus() & self.cliNode.Completed) or (self.cliNode.GetStatus() & self.cliNode.Cancelled)
+
+  def initializeTable(self):
+    self.tableNode.RemoveAllColumns()
+    for key in AntsLogParser.RECORD_KEYS:
+      column = self.tableNode.AddColumn()
+      column.SetName(key)
+      self.tableNode.SetColumnType(key, self.getColumnType(key))
+
+  def getColumnType(self, key):
+    import vtk
+    columnType = self.COLUMN_TYPES.get(key, 'int')
+    return {'string': vtk.VTK_STRING, 'double': vtk.VTK_DOUBLE, 'int': vtk.VTK_INT}[columnType]
+
+  def onStatusUpdate(self, caller=None, event=None):
+    outputText = self.cliNode.GetOutputText() or ''
+    if not outputText.startswith(self._parsedText):
+      # output was reset, parse it again
+      self.parser = AntsLogParser()
+      self._parsedText = ''
+      if self.tableNode is not None:
+        self.initializeTable()
+    newRecords = self.parser.feed(outputText[len(self._parsedText):])
+    self._parsedText = outputText
+    if self.isDone():
+      newRecords += self.parser.flush()
+    if newRecords:
+      self.appendToTable(newRecords)
+      if self.onRecords:
+        self.onRecords(newRecords)
+    if self.isDone():
+      self.finish()
+
+  def appendToTable(self, records):
+    if self.tableNode is None:
+      return
+    table = self.tableNode.GetTable()
+    for record in records:
+      row = table.InsertNextBlankRow()
+      for column, key in enumerate(AntsLogParser.RECORD_KEYS):
+        self.tableNode.SetCellText(row, column, str(record[key]))
+    self.tableNode.Modified()
+
+  def finish(self):
+    if self._observerTag is not None:
+      self.cliNode.RemoveObserver(self._observerTag)
+      self._observerTag = None
+    if self.filePath:
+      self.parser.writeJSON(self.filePath)
+    if self.onFinished:
+      self.onFinished()
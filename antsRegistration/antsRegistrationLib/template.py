@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import slicer
+
+from .batch import BatchItem, BatchRegistration, copyParameters
+from .scheduling import CoreScheduler
+
+
+def trilinearSample(array, coordinates):
+  """
+  Sample a 3D array at fractional (k, j, i) voxel coordinates of shape (3, ...), clamping to the array bounds.
+  """
+  import numpy as np
+  shape = np.array(array.shape).reshape((3,) + (1,) * (coordinates.ndim - 1))
+  coordinates = np.clip(coordinates, 0, shape - 1)
+  lower = np.minimum(np.floor(coordinates).astype(int), shape - 2).clip(0)
+  weights = coordinates - lower
+  result = np.zeros(coordinates.shape[1:], dtype=float)
+  for corner in np.ndindex(2, 2, 2):
+    cornerWeights = np.ones(coordinates.shape[1:], dtype=float)
+    indices = []
+    for axis, offset in enumerate(corner):
+      cornerWeights *= weights[axis] if offset else 1 - weights[axis]
+      indices.append(np.minimum(lower[axis] + offset, array.shape[axis] - 1))
+    result += cornerWeights * array[tuple(indices)]
+  return result
+
+
+def updateTemplateShape(averageImage, averageDisplacement, ijkToRAS, gradientStep=0.25):
+  """
+  Return the average image warped by the inverse of the average displacement, approximated by its opposite
+  scaled by gradientStep, so that the template moves towards the average shape of the subjects.
+  :param averageImage: (k, j, i) array on the template grid
+  :param averageDisplacement: (k, j, i, 3) array of RAS displacements (mm) from the template to the subjects on the template grid
+  :param ijkToRAS: 4x4 array of the template grid
+  """
+  import numpy as np
+  rasToIJK = np.linalg.inv(np.asarray(ijkToRAS)[:3, :3])
+  # displacements in voxels, in (i, j, k) order
+  voxelDisplacement = averageDisplacement @ rasToIJK.T
+  kji = np.indices(averageImage.shape, dtype=float)
+  coordinates = kji - gradientStep * np.moveaxis(voxelDisplacement[..., ::-1], -1, 0)
+  return trilinearSample(averageImage, coordinates).astype(averageImage.dtype, copy=False)
+
+
+class TemplateBuilder:
+  """
+  Unbiased population template construction: every iteration registers all the subjects to the current template
+  with a BatchRegistration, averages the warped subjects and their displacement fields, and moves the average
+  image along the inverse of the average displacement to get the next template.
+  Averages are accumulated as each registration finishes, so only the running sums are kept in memory.
+  The template of each iteration is saved to outputDirectory with a template.json state file, and building
+  resumes after the last completed iteration when started again with the same outputDirectory.
+  """
+
+  STATE_FILE_NAME = 'template.json'
+
+  def __init__(self, logic, subjects, initialTemplate, stages, outputDirectory, numberOfIterations=4, gradientStep=0.25,
+               initialTransformSettings=None, generalSettings=None, maxConcurrentJobs=2, scheduler=None,
+               onIterationFinished=None, onFinished=None):
+    self.logic = logic
+    self.subjects = list(subjects)
+    self.initialTemplate = initialTemplate
+    self.stages = stages
+    self.outputDirectory = outputDirectory
+    self.numberOfIterations = numberOfIterations
+    self.gradientStep = gradientStep
+    self.initialTransformSettings = initialTransformSettings if initialTransformSettings is not None else {}
+    self.generalSettings = generalSettings if generalSettings is not None else {}
+    self.maxConcurrentJobs = maxConcurrentJobs
+    self.scheduler = scheduler if scheduler is not None else CoreScheduler()
+    self.onIterationFinished = onIterationFinished
+    self.onFinished = onFinished
+    self.templateNode = None
+    self.batch = None
+    self.state = None
+    self.errorText = ''
+    self._imageSum = None
+    self._displacementSum = None
+    self._numberOfAveragedSubjects = 0
+    self._finished = False
+    self._cancelled = False
+
+  @property
+  def stateFile(self):
+    return os.path.join(self.outputDirectory, self.STATE_FILE_NAME)
+
+  @staticmethod
+  def getSubjectName(subject):
+    return subject if isinstance(subject, str) else subject.GetName()
+
+  def loadState(self):
+    """
+    Return the state of a previous build of the same subjects in outputDirectory, or a new state.
+    """
+    subjectNames = [self.getSubjectName(subject) for subject in self.subjects]
+    if os.path.isfile(self.stateFile):
+      with open(self.stateFile) as stateFile:
+        state = json.load(stateFile)
+      if state['subjects'] != subjectNames:
+        raise ValueError('%s belongs to a template of other subjects' % self.stateFile)
+      return state
+    return {'subjects': subjectNames, 'templateFiles': [], 'failedSubjects': [], 'iterationTimes': []}
+
+  def saveState(self):
+    temporaryFile = self.stateFile + '.partial'
+    with open(temporaryFile, 'w') as stateFile:
+      json.dump(self.state, stateFile, indent=2)
+    os.replace(temporaryFile, self.stateFile)
+
+  @property
+  def numberOfCompletedIterations(self):
+    return len(self.state['templateFiles']) if self.state else 0
+
+  def start(self):
+    os.makedirs(self.outputDirectory, exist_ok=True)
+    self.state = self.loadState()
+    if self.state['templateFiles']:
+      self.templateNode = slicer.util.loadVolume(os.path.join(self.outputDirectory, self.state['templateFiles'][-1]), {'show': False})
+    elif isinstance(self.initialTemplate, str):
+      self.templateNode = slicer.util.loadVolume(self.initialTemplate, {'show': False})
+    else:
+      self.templateNode = self.initialTemplate
+    self.runIteration()
+
+  def wait(self, pollInterval=0.1):
+    while not self.isFinished():
+      slicer.app.processEvents()
+      time.sleep(pollInterval)
+
+  def isFinished(self):
+    return self._finished
+
+  def cancel(self):
+    self._cancelled = True
+    if self.batch is not None:
+      self.batch.cancel()
+
+  def runIteration(self):
+    if self._cancelled or self.numberOfCompletedIterations >= self.numberOfIterations:
+      self.finish()
+      return
+    self._imageSum = None
+    self._displacementSum = None
+    self._numberOfAveragedSubjects = 0
+    self._iterationStartTime = time.time()
+    stages = copyParameters(self.stages)
+    for stage in stages:
+      for metric in stage['metrics']:
+        metric['fixed'] = self.templateNode
+        metric['moving'] = ''  # replaced by each subject
+    outputSettings = {'transform': 'vtkMRMLGridTransformNode', 'volume': 'vtkMRMLScalarVolumeNode',
+                      'useDisplacementField': True, 'interpolation': 'Linear'}
+    self.batch = BatchRegistration(self.logic, stages, outputSettings, self.subjects, copyParameters(self.initialTransformSettings),
+                                   copyParameters(self.generalSettings), maxConcurrentJobs=self.maxConcurrentJobs,
+                                   onItemFinished=self.onItemFinished, scheduler=self.scheduler)
+    self.batch.start()
+
+  def onItemFinished(self, item):
+    if not isinstance(item.moving, str):
+      # subjects loaded from files are kept for the next iterations
+      self.subjects[item.index] = item.moving
+    if item.status == BatchItem.COMPLETED:
+      try:
+        self.accumulate(item.outputs['volume'], item.outputs['transform'])
+      except Exception as e:
+        item.errorText = str(e)
+        item.status = BatchItem.FAILED
+    if item.status != BatchItem.COMPLETED:
+      self.state['failedSubjects'].append({'iteration': self.numberOfCompletedIterations + 1, 'subject': item.name,
+                                           'status': item.status, 'errorText': item.errorText})
+    for node in item.outputs.values():
+      if not isinstance(node, str):
+        slicer.mrmlScene.RemoveNode(node)
+    item.outputs = {}
+    if self.batch.isFinished():
+      self.finishIteration()
+
+  def accumulate(self, warpedNode, displacementNode):
+    import numpy as np
+    image = slicer.util.arrayFromVolume(warpedNode)
+    displacement = slicer.util.arrayFromGridTransform(displacementNode)
+    if displacement.shape[:3] != image.shape:
+      raise ValueError('Displacement field grid %s differs from the template grid %s' % (displacement.shape[:3], image.shape))
+    if self._imageSum is None:
+      self._imageSum = np.zeros(image.shape, dtype=np.float64)
+      self._displacementSum = np.zeros(displacement.shape, dtype=np.float64)
+    self._imageSum += image
+    self._displacementSum += displacement
+    self._numberOfAveragedSubjects += 1
+
+  def finishIteration(self):
+    if self._cancelled or not self._numberOfAveragedSubjects:
+      if not self._cancelled:
+        self.errorText = 'All the registrations of iteration %i failed' % (self.numberOfCompletedIterations + 1)
+      self.saveState()
+      self.finish()
+      return
+    import numpy as np
+    ijkToRAS = getIJKToRASArray(self.templateNode)
+    averageImage = (self._imageSum / self._numberOfAveragedSubjects).astype(np.float32)
+    averageDisplacement = self._displacementSum / self._numberOfAveragedSubjects
+    self._imageSum = None
+    self._displacementSum = None
+    templateArray = updateTemplateShape(averageImage, averageDisplacement, ijkToRAS, self.gradientStep)
+
+    iteration = self.numberOfCompletedIterations + 1
+    templateNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'template_iteration%02i' % iteration)
+    templateNode.CopyOrientation(self.templateNode)
+    slicer.util.updateVolumeFromArray(templateNode, templateArray)
+    templateFile = 'template_iteration%02i.nrrd' % iteration
+    if not slicer.util.saveNode(templateNode, os.path.join(self.outputDirectory, templateFile)):
+      self.errorText = 'Unable to write %s' % templateFile
+      self.finish()
+      return
+    if self.templateNode is not self.initialTemplate:
+      slicer.mrmlScene.RemoveNode(self.templateNode)
+    self.templateNode = templateNode
+    self.state['templateFiles'].append(templateFile)
+    self.state['iterationTimes'].append(time.time() - self._iterationStartTime)
+    self.saveState()
+    if self.onIterationFinished:
+      self.onIterationFinished(self)
+    self.runIteration()
+
+  def finish(self):
+    self._finished = True
+    self.batch = None
+    if self.onFinished:
+      self.onFinished(self)
+
+
+def getIJKToRASArray(volumeNode):
+  import numpy as np
+  import vtk
+  ijkToRAS = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(ijkToRAS)
+  return np.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
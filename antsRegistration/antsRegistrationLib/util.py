@@ -1,10 +1,48 @@
 
 
+def meshSize(value):
+  """
+  Convert a mesh size, a single number or one number per dimension (e.g. 8x8x4).
+  """
+  return [float(size) for size in value.split('x')]
+
+
+class antsSetting:
+  """
+  One value of the comma separated settings of a transform or metric.
+  :param type: callable converting the string value, raising ValueError if it is invalid
+  """
+  def __init__(self, name, type=float, optional=False, choices=None, minimum=None, maximum=None):
+    self.name = name
+    self.type = type
+    self.optional = optional
+    self.choices = choices
+    self.minimum = minimum
+    self.maximum = maximum
+
+  def validate(self, value):
+    """
+    Return an error message, or None if the value is valid.
+    """
+    if self.choices is not None:
+      return None if value in self.choices else '%s must be one of %s, not %s' % (self.name, ', '.join(self.choices), value)
+    try:
+      converted = self.type(value)
+    except ValueError:
+      return '%s is not a valid %s: %s' % (self.name, self.type.__name__, value)
+    if self.minimum is not None and converted < self.minimum or self.maximum is not None and converted > self.maximum:
+      return '%s must be in [%s,%s], not %s' % (self.name, self.minimum, self.maximum, value)
+    return None
+
+
 class antsBase:
+  _registry = None  # name: instance of every subclass, built on first use
+
   def __init__(self):
     self.details = ''
     self.settingsFormat = ''
     self.settingsDefault = ''
+    self.settingsSchema = []
     self.nodeTypes = []
 
   @classmethod
@@ -19,9 +57,31 @@ class antsBase:
 
   @classmethod
   def getSubClassByName(cls, name):
-    for subcls in cls.getSubClasses():
-      if subcls.__name__ == name:
-        return subcls()
+    """
+    Return the shared instance of the subclass of the given name, or None.
+    """
+    if antsBase._registry is None:
+      antsBase._registry = {subcls.__name__: subcls() for subcls in antsBase.getSubClasses()}
+    instance = antsBase._registry.get(name)
+    return instance if isinstance(instance, cls) else None
+
+  def validateSettings(self, settings):
+    """
+    Return the error messages of a comma separated settings string.
+    """
+    values = [value.strip() for value in str(settings).split(',')] if str(settings).strip() else []
+    if len(values) > len(self.settingsSchema):
+      return ['%i settings given, at most %i expected' % (len(values), len(self.settingsSchema))]
+    errors = []
+    for index, setting in enumerate(self.settingsSchema):
+      if index >= len(values) or values[index] == '':
+        if not setting.optional:
+          errors.append('%s is required' % setting.name)
+        continue
+      error = setting.validate(values[index])
+      if error:
+        errors.append(error)
+    return errors
 
 #
 # Metric
@@ -36,39 +96,63 @@ class CC(antsMetric):
   def __init__(self):
     super().__init__()
     self.details = 'ANTS neighborhood cross correlation'
-    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;'
+    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>useGradientFilter</b>=false&gt;'
     self.settingsDefault = '1,4,Random,0.25'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('radius', int, minimum=0),
+                           antsSetting('samplingStrategy', optional=True, choices=['None', 'Regular', 'Random']),
+                           antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('useGradientFilter', optional=True, choices=['0', '1', 'false', 'true'])]
 
 class MI(antsMetric):
   def __init__(self):
     super().__init__()
     self.details = 'Mutual Information'
-    self.settingsFormat = '<b>metricWeight</b>, <b>numberOfBins</b>, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;'
+    self.settingsFormat = '<b>metricWeight</b>, <b>numberOfBins</b>, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>useGradientFilter</b>=false&gt;'
     self.settingsDefault = '1,32,Random,0.25'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('numberOfBins', int, minimum=1),
+                           antsSetting('samplingStrategy', optional=True, choices=['None', 'Regular', 'Random']),
+                           antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('useGradientFilter', optional=True, choices=['0', '1', 'false', 'true'])]
 
 class Mattes(antsMetric):
   def __init__(self):
     super().__init__()
-    self.settingsFormat = '<b>metricWeight</b>, <b>numberOfBins</b>, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;'
+    self.settingsFormat = '<b>metricWeight</b>, <b>numberOfBins</b>, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>useGradientFilter</b>=false&gt;'
     self.settingsDefault = '1,32,Random,0.25'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('numberOfBins', int, minimum=1),
+                           antsSetting('samplingStrategy', optional=True, choices=['None', 'Regular', 'Random']),
+                           antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('useGradientFilter', optional=True, choices=['0', '1', 'false', 'true'])]
 
 class MeanSquares(antsMetric):
   def __init__(self):
     super().__init__()
-    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>=NA, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;'
+    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>=NA, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>useGradientFilter</b>=false&gt;'
     self.settingsDefault = '1,NA,Random,0.25'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('radius', str, optional=True),
+                           antsSetting('samplingStrategy', optional=True, choices=['None', 'Regular', 'Random']),
+                           antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('useGradientFilter', optional=True, choices=['0', '1', 'false', 'true'])]
 
 class Demons(antsMetric):
   def __init__(self):
     super().__init__()
-    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>=NA, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;'
+    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>=NA, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>useGradientFilter</b>=false&gt;'
     self.settingsDefault = '1,NA,Random,0.25'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('radius', str, optional=True),
+                           antsSetting('samplingStrategy', optional=True, choices=['None', 'Regular', 'Random']),
+                           antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('useGradientFilter', optional=True, choices=['0', '1', 'false', 'true'])]
 
 class GC(antsMetric):
   def __init__(self):
     super().__init__()
-    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>=NA, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;'
+    self.settingsFormat = '<b>metricWeight</b>, <b>radius</b>=NA, &lt;<b>samplingStrategy</b>={None,Regular,Random}&gt;, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>useGradientFilter</b>=false&gt;'
     self.settingsDefault = '1,NA,Random,0.25'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('radius', str, optional=True),
+                           antsSetting('samplingStrategy', optional=True, choices=['None', 'Regular', 'Random']),
+                           antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('useGradientFilter', optional=True, choices=['0', '1', 'false', 'true'])]
 
 class ICP(antsMetric):
   def __init__(self):
@@ -76,6 +160,8 @@ class ICP(antsMetric):
     self.details = 'Euclidean'
     self.settingsFormat = '<b>metricWeight</b>, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>boundaryPointsOnly</b>=0&gt;'
     self.settingsDefault = '1,0.25,0'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('boundaryPointsOnly', int, optional=True, minimum=0, maximum=1)]
     self.nodeTypes = ["vtkMRMLLabelMapVolumeNode"]
 
 class PSE(antsMetric):
@@ -84,6 +170,9 @@ class PSE(antsMetric):
     self.details = 'Point-set expectation'
     self.settingsFormat = '<b>metricWeight</b>, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>boundaryPointsOnly</b>=0&gt;,&lt;<b>pointSetSigma</b>=1&gt;, &lt;<b>kNeighborhood</b>=50&gt;'
     self.settingsDefault = '1,0.25,0,1,50'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('boundaryPointsOnly', int, optional=True, minimum=0, maximum=1),
+                           antsSetting('pointSetSigma', optional=True), antsSetting('kNeighborhood', int, optional=True, minimum=1)]
     self.nodeTypes = ["vtkMRMLLabelMapVolumeNode"]
 
 class JHCT(antsMetric):
@@ -92,6 +181,10 @@ class JHCT(antsMetric):
     self.details = 'Jensen-Havrda-Charvet-Tsallis'
     self.settingsFormat = '<b>metricWeight</b>, &lt;<b>samplingPercentage</b>=[0,1]&gt;, &lt;<b>boundaryPointsOnly</b>=0&gt;, &lt;<b>pointSetSigma</b>=1&gt;, &lt;<b>kNeighborhood</b>=50&gt;, &lt;<b>alpha</b>=1.1&gt;, &lt;<b>useAnisotropicCovariances</b>=1&gt;'
     self.settingsDefault = '1,0.25,0,1,50,1.1,1'
+    self.settingsSchema = [antsSetting('metricWeight'), antsSetting('samplingPercentage', optional=True, minimum=0, maximum=1),
+                           antsSetting('boundaryPointsOnly', int, optional=True, minimum=0, maximum=1),
+                           antsSetting('pointSetSigma', optional=True), antsSetting('kNeighborhood', int, optional=True, minimum=1),
+                           antsSetting('alpha', optional=True), antsSetting('useAnisotropicCovariances', int, optional=True, minimum=0, maximum=1)]
     self.nodeTypes = ["vtkMRMLLabelMapVolumeNode"]
 
 #
@@ -104,6 +197,7 @@ class antsTransform(antsBase):
     self.details = ''
     self.settingsFormat = '<b>gradientStep</b>'
     self.settingsDefault = '0.1'
+    self.settingsSchema = [antsSetting('gradientStep')]
 
 class Rigid(antsTransform):
   def __init__(self):
@@ -130,51 +224,70 @@ class BSpline(antsTransform):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>meshSizeAtBaseLevel</b>'
     self.settingsDefault = '0.1,8'
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('meshSizeAtBaseLevel', meshSize)]
 
 class GaussianDisplacementField(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>updateFieldVarianceInVoxelSpace</b>, <b>totalFieldVarianceInVoxelSpace</b>'
     self.settingsDefault = '0.1,3,0'
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('updateFieldVarianceInVoxelSpace'),
+                           antsSetting('totalFieldVarianceInVoxelSpace')]
 
 class BSplineDisplacementField(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>updateFieldMeshSizeAtBaseLevel</b>, &lt;<b>totalFieldMeshSizeAtBaseLevel</b>=0&gt;, &lt;<b>splineOrder</b>=3&gt;'
     self.settingsDefault = '0.1,26,0,3'
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('updateFieldMeshSizeAtBaseLevel', meshSize),
+                           antsSetting('totalFieldMeshSizeAtBaseLevel', meshSize, optional=True), antsSetting('splineOrder', int, optional=True, minimum=0)]
 
 class TimeVaryingVelocityField(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>numberOfTimeIndices</b>, <b>updateFieldVarianceInVoxelSpace</b>, <b>updateFieldTimeVariance</b>, <b>totalFieldVarianceInVoxelSpace</b>, <b>totalFieldTimeVariance</b>'
     self.settingsDefault = ''
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('numberOfTimeIndices', int, minimum=1),
+                           antsSetting('updateFieldVarianceInVoxelSpace'), antsSetting('updateFieldTimeVariance'),
+                           antsSetting('totalFieldVarianceInVoxelSpace'), antsSetting('totalFieldTimeVariance')]
 
 class TimeVaryingBSplineVelocityField(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>velocityFieldMeshSize</b>, &lt;<b>numberOfTimePointSamples</b>=4&gt;, &lt;<b>splineOrder</b>=3&gt;'
     self.settingsDefault = ''
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('velocityFieldMeshSize', meshSize),
+                           antsSetting('numberOfTimePointSamples', int, optional=True, minimum=1), antsSetting('splineOrder', int, optional=True, minimum=0)]
 
 class SyN(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, &lt;<b>updateFieldVarianceInVoxelSpace</b>= 3&gt;, &lt;<b>totalFieldVarianceInVoxelSpace</b>=0&gt;'
     self.settingsDefault = '0.1,3,0'
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('updateFieldVarianceInVoxelSpace', optional=True),
+                           antsSetting('totalFieldVarianceInVoxelSpace', optional=True)]
 
 class BSplineSyN(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>updateFieldMeshSizeAtBaseLevel</b>, &lt;<b>totalFieldMeshSizeAtBaseLevel</b>=0&gt;, &lt;<b>splineOrder</b>=3&gt;'
     self.settingsDefault = '0.1,26,0,3'
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('updateFieldMeshSizeAtBaseLevel', meshSize),
+                           antsSetting('totalFieldMeshSizeAtBaseLevel', meshSize, optional=True), antsSetting('splineOrder', int, optional=True, minimum=0)]
 
 class Exponential(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>updateFieldVarianceInVoxelSpace</b>, <b>velocityFieldVarianceInVoxelSpace</b>, &lt;<b>numberOfIntegrationSteps</b>&gt;'
     self.settingsDefault = ''
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('updateFieldVarianceInVoxelSpace'),
+                           antsSetting('velocityFieldVarianceInVoxelSpace'), antsSetting('numberOfIntegrationSteps', int, optional=True, minimum=1)]
 
-class Exponential(antsTransform):
+class BSplineExponential(antsTransform):
   def __init__(self):
     super().__init__()
     self.settingsFormat = '<b>gradientStep</b>, <b>updateFieldMeshSizeAtBaseLevel</b>, &lt;<b>velocityFieldMeshSizeAtBaseLevel</b>=0&gt;, &lt;<b>numberOfIntegrationSteps</b>&gt;, &lt;<b>splineOrder</b>=3&gt;'
     self.settingsDefault = ''
+    self.settingsSchema = [antsSetting('gradientStep'), antsSetting('updateFieldMeshSizeAtBaseLevel', meshSize),
+                           antsSetting('velocityFieldMeshSizeAtBaseLevel', meshSize, optional=True),
+                           antsSetting('numberOfIntegrationSteps', int, optional=True, minimum=1), antsSetting('splineOrder', int, optional=True, minimum=0)]
@@ -0,0 +1,74 @@
+from .util import antsMetric, antsTransform
+
+
+SMOOTHING_SIGMAS_UNITS = ['vox', 'mm']
+
+
+def validateStages(stages):
+  """
+  Check the stages before launching a registration: transform and metric names and settings, inputs and levels.
+  Does not depend on Slicer, inputs may be nodes, node IDs or file paths.
+  :return: list of error messages, empty if the stages are valid
+  """
+  if not stages:
+    return ['No registration stage']
+  errors = []
+  for stageNumber, stage in enumerate(stages, 1):
+    prefix = 'Stage %i: ' % stageNumber
+    errors += [prefix + error for error in validateTransform(stage.get('transformParameters', {}))]
+    metrics = stage.get('metrics', [])
+    if not metrics:
+      errors.append(prefix + 'no metric')
+    for metricNumber, metric in enumerate(metrics, 1):
+      errors += [prefix + 'metric %i: %s' % (metricNumber, error) for error in validateMetric(metric)]
+    errors += [prefix + error for error in validateLevels(stage.get('levels', {}))]
+  return errors
+
+
+def validateTransform(transformParameters):
+  transform = antsTransform.getSubClassByName(transformParameters.get('transform'))
+  if transform is None:
+    return ['unknown transform %s' % transformParameters.get('transform')]
+  return ['%s %s' % (transformParameters['transform'], error) for error in transform.validateSettings(transformParameters.get('settings', ''))]
+
+
+def validateMetric(metricParameters):
+  metric = antsMetric.getSubClassByName(metricParameters.get('type'))
+  if metric is None:
+    return ['unknown metric %s' % metricParameters.get('type')]
+  errors = ['%s %s' % (metricParameters['type'], error) for error in metric.validateSettings(metricParameters.get('settings', ''))]
+  for role in ['fixed', 'moving']:
+    if not metricParameters.get(role):
+      errors.append('no %s image' % role)
+  return errors
+
+
+def validateLevels(levels):
+  steps = levels.get('steps', [])
+  if not steps:
+    return ['no level']
+  errors = []
+  # one value per level of each option, a missing value would shift the other levels
+  for key, minimum, integer in [('convergence', 0, True), ('smoothingSigmas', 0, False), ('shrinkFactors', 1, True)]:
+    for levelNumber, step in enumerate(steps, 1):
+      if not isNumber(step.get(key), minimum, integer):
+        errors.append('level %i: %s must be %s >= %i, not %r' % (levelNumber, key, 'an integer' if integer else 'a number', minimum, step.get(key)))
+  if levels.get('smoothingSigmasUnit') not in SMOOTHING_SIGMAS_UNITS:
+    errors.append('smoothing sigmas unit must be one of %s' % ', '.join(SMOOTHING_SIGMAS_UNITS))
+  for key, minimum in [('convergenceThreshold', 0), ('convergenceWindowSize', 1)]:
+    if not isNumber(levels.get(key), minimum, integer=True):
+      errors.append('%s must be an integer >= %i, not %r' % (key, minimum, levels.get(key)))
+  return errors
+
+
+def isNumber(value, minimum, integer=False):
+  """
+  Return True if value, a number or a string holding one, is at least minimum.
+  """
+  if isinstance(value, bool):
+    return False
+  try:
+    number = float(value)
+  except (TypeError, ValueError):
+    return False
+  return number >= minimum and (not integer or number == int(number))
@@ -0,0 +1,72 @@
+import os
+import tempfile
+
+
+class PlateauWatchdog:
+  """
+  Requests early termination of a running antsRegistrationCLI when the metric value stops improving.
+  Fed with the iteration records of RegistrationTelemetry, it writes a request to the control file
+  polled by the CLI once the relative improvement over the last windowSize iterations of a level is
+  below threshold. With action 'level' the rest of the level is skipped, with action 'run' all the
+  remaining levels and stages are. Outputs are written with the transforms computed so far.
+  """
+
+  ACTIONS = ['level', 'run']
+
+  def __init__(self, windowSize=10, threshold=1e-4, action='level', minimumIterations=0, controlDirectory=None):
+    if action not in self.ACTIONS:
+      raise ValueError('Unknown early termination action: %s. Use one of %s' % (action, ', '.join(self.ACTIONS)))
+    self.windowSize = max(1, int(windowSize))
+    self.threshold = float(threshold)
+    self.action = action
+    self.minimumIterations = int(minimumIterations)
+    fileDescriptor, self.controlFile = tempfile.mkstemp(prefix='antsControl', suffix='.txt', dir=controlDirectory)
+    os.close(fileDescriptor)
+    self.stoppedLevels = []  # (stage, level) for which a stop was requested
+    self._currentLevel = None
+    self._metricValues = []
+    self._runStopped = False
+
+  @staticmethod
+  def isFinite(value):
+    return value == value and abs(value) != float('inf')
+
+  def getRelativeImprovement(self, metricValues):
+    """
+    Return the relative decrease of the metric over the last windowSize iterations, None if there are not enough values.
+    """
+    if len(metricValues) <= self.windowSize:
+      return None
+    reference = metricValues[-self.windowSize - 1]
+    return (reference - metricValues[-1]) / max(abs(reference), 1e-12)
+
+  def onRecords(self, records):
+    for record in records:
+      level = (record['stage'], record['level'])
+      if level != self._currentLevel:
+        self.onLevelChanged(level)
+      if not self.isFinite(record['metricValue']):
+        continue
+      self._metricValues.append(record['metricValue'])
+      if self._runStopped or level in self.stoppedLevels or len(self._metricValues) < self.minimumIterations:
+        continue
+      improvement = self.getRelativeImprovement(self._metricValues)
+      if improvement is not None and improvement < self.threshold:
+        self.stoppedLevels.append(level)
+        self._runStopped = self.action == 'run'
+        self.writeRequest(self.action)
+
+  def onLevelChanged(self, level):
+    # a level request not consumed before the level ended must not stop the next one
+    if self._currentLevel in self.stoppedLevels and self.action == 'level':
+      self.writeRequest('')
+    self._currentLevel = level
+    self._metricValues = []
+
+  def writeRequest(self, request):
+    with open(self.controlFile, 'w') as controlFile:
+      controlFile.write(request)
+
+  def cleanup(self):
+    if os.path.isfile(self.controlFile):
+      os.remove(self.controlFile)
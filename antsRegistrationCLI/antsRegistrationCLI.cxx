@@ -3,12 +3,372 @@
 #include "antsRegistration.h"
 #include "antsApplyTransforms.h"
 
+#include "itkBSplineInterpolateImageFunction.h"
+#include "itkCastImageFilter.h"
+#include "itkCompositeTransform.h"
+#include "itkImageFileReader.h"
+#include "itkImageFileWriter.h"
+#include "itkImageIOFactory.h"
+#include "itkLabelImageGenericInterpolateImageFunction.h"
+#include "itkLinearInterpolateImageFunction.h"
+#include "itkMultiThreaderBase.h"
+#include "itkNearestNeighborInterpolateImageFunction.h"
+#include "itkResampleImageFilter.h"
+#include "itkTransformFileReader.h"
+
+#include <algorithm>
+#include <cctype>
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <filesystem>
+#include <fstream>
+#include <functional>
 #include <iostream>
+#include <thread>
+#include <type_traits>
+#include <map>
 #include <vector>
 #include <string>
 
+#if defined(_WIN32)
+#  ifndef NOMINMAX
+#    define NOMINMAX
+#  endif
+#  include <windows.h>
+#  include <psapi.h>
+#else
+#  include <sys/resource.h>
+#endif
+
 namespace
 {
+  double getPeakResidentMemoryMB() {
+#if defined(_WIN32)
+    PROCESS_MEMORY_COUNTERS counters;
+    if (GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters))){
+      return counters.PeakWorkingSetSize / (1024.0 * 1024.0);
+    }
+    return 0.0;
+#else
+    struct rusage usage;
+    if (getrusage(RUSAGE_SELF, &usage) != 0){
+      return 0.0;
+    }
+#  if defined(__APPLE__)
+    return usage.ru_maxrss / (1024.0 * 1024.0); // bytes
+#  else
+    return usage.ru_maxrss / 1024.0; // kilobytes
+#  endif
+#endif
+  }
+
+  // Settings read by the patched ANTs through environment variables
+  void setEnvironmentVariable(const char* name, const std::string& value) {
+#if defined(_WIN32)
+    _putenv_s(name, value.c_str());
+#else
+    setenv(name, value.c_str(), 1);
+#endif
+  }
+
+  void setControlFile(const std::string& controlFile) {
+    setEnvironmentVariable("ANTS_REGISTRATION_CONTROL_FILE", controlFile);
+  }
+
+  void setCheckpointDirectory(const std::string& checkpointDirectory) {
+    setEnvironmentVariable("ANTS_STAGE_CHECKPOINT_DIRECTORY", checkpointDirectory);
+  }
+
+  void setWriteCompression(const std::string& compression) {
+    setEnvironmentVariable("ANTS_WRITE_COMPRESSION", compression);
+  }
+
+  // displacement field written by antsRegistration from the composite transform in memory, on the grid of referenceVolume
+  void setDisplacementFieldOutput(const std::string& outputFile, const std::string& referenceVolume) {
+    setEnvironmentVariable("ANTS_DISPLACEMENT_FIELD_FILE", outputFile);
+    setEnvironmentVariable("ANTS_DISPLACEMENT_FIELD_REFERENCE", referenceVolume);
+  }
+
+  // transform files antsRegistration does not write, separated by "|"
+  void setSkippedOutputFiles(const std::vector<std::string>& files) {
+    std::string value;
+    for (const std::string& file : files){
+      value += (value.empty() ? "" : "|") + file;
+    }
+    setEnvironmentVariable("ANTS_SKIP_OUTPUT_FILES", value);
+  }
+
+  // When built as a shared library the module runs inside the Slicer process:
+  // process wide settings changed for a run are restored when it ends. They are shared by
+  // all the runs of the process, the antsRegistration module runs one at a time in process.
+  class ProcessStateGuard {
+  public:
+    ProcessStateGuard()
+      : m_MaximumNumberOfThreads(itk::MultiThreaderBase::GetGlobalMaximumNumberOfThreads())
+      , m_DefaultNumberOfThreads(itk::MultiThreaderBase::GetGlobalDefaultNumberOfThreads()) {}
+    ~ProcessStateGuard() {
+      itk::MultiThreaderBase::SetGlobalMaximumNumberOfThreads(m_MaximumNumberOfThreads);
+      itk::MultiThreaderBase::SetGlobalDefaultNumberOfThreads(m_DefaultNumberOfThreads);
+      setControlFile("");
+      setCheckpointDirectory("");
+      setWriteCompression("");
+      setDisplacementFieldOutput("", "");
+      setSkippedOutputFiles(std::vector<std::string>());
+    }
+  private:
+    unsigned int m_MaximumNumberOfThreads;
+    unsigned int m_DefaultNumberOfThreads;
+  };
+
+  // Output base of the intermediate transform files when no composite transform output was requested.
+  // Output volumes can not be used to derive it as they are not files when running in process (slicer: URIs).
+  std::string getTemporaryOutputBase() {
+    std::size_t unique = std::hash<std::thread::id>()(std::this_thread::get_id()) ^
+      (std::size_t)std::chrono::steady_clock::now().time_since_epoch().count();
+    return (std::filesystem::temp_directory_path() / ("antsRegistration" + std::to_string(unique))).string();
+  }
+
+  bool moveFile(const std::string& source, const std::string& destination) {
+    std::error_code error;
+    std::filesystem::rename(source, destination, error);
+    if (error){
+      // e.g. across file systems
+      error.clear();
+      std::filesystem::copy_file(source, destination, std::filesystem::copy_options::overwrite_existing, error);
+      std::filesystem::remove(source);
+    }
+    if (error){
+      std::cerr << "ERROR: unable to write " << destination << ": " << error.message() << std::endl;
+      return false;
+    }
+    return true;
+  }
+
+  // Read a composite transform file, or the transforms of a file holding several, as one flattened composite transform.
+  template <typename TReal>
+  typename itk::CompositeTransform<TReal, 3>::Pointer readCompositeTransform(const std::string& transformFile) {
+    constexpr unsigned int Dimension = 3;
+    using TransformType = itk::Transform<TReal, Dimension, Dimension>;
+    using CompositeTransformType = itk::CompositeTransform<TReal, Dimension>;
+
+    auto reader = itk::TransformFileReaderTemplate<TReal>::New();
+    reader->SetFileName(transformFile);
+    reader->Update();
+    const auto& transforms = *reader->GetTransformList();
+    if (transforms.empty()){
+      std::cerr << "ERROR: no transform in " << transformFile << std::endl;
+      return nullptr;
+    }
+    // a composite file is read as a single composite transform holding the others
+    typename CompositeTransformType::Pointer compositeTransform = dynamic_cast<CompositeTransformType*>(transforms.front().GetPointer());
+    if (!compositeTransform){
+      compositeTransform = CompositeTransformType::New();
+      for (const auto& transform : transforms){
+        TransformType* readTransform = dynamic_cast<TransformType*>(transform.GetPointer());
+        if (!readTransform){
+          std::cerr << "ERROR: unsupported transform in " << transformFile << std::endl;
+          return nullptr;
+        }
+        compositeTransform->AddTransform(readTransform);
+      }
+    }
+    compositeTransform->FlattenTransformQueue();
+    return compositeTransform;
+  }
+
+  // Set the grid of a volume file to grid. Only the header is read, no pixel buffer is allocated.
+  template <typename TImage>
+  bool readGrid(const std::string& volumeFile, TImage* grid) {
+    constexpr unsigned int Dimension = TImage::ImageDimension;
+    itk::ImageIOBase::Pointer imageIO = itk::ImageIOFactory::CreateImageIO(volumeFile.c_str(), itk::IOFileModeEnum::ReadMode);
+    if (!imageIO){
+      std::cerr << "ERROR: unable to read " << volumeFile << std::endl;
+      return false;
+    }
+    imageIO->SetFileName(volumeFile);
+    imageIO->ReadImageInformation();
+    typename TImage::SizeType size;
+    typename TImage::SpacingType spacing;
+    typename TImage::PointType origin;
+    typename TImage::DirectionType direction;
+    direction.SetIdentity();
+    size.Fill(1);
+    spacing.Fill(1.0);
+    origin.Fill(0.0);
+    for (unsigned int i = 0; i < std::min(Dimension, imageIO->GetNumberOfDimensions()); ++i){
+      size[i] = imageIO->GetDimensions(i);
+      spacing[i] = imageIO->GetSpacing(i);
+      origin[i] = imageIO->GetOrigin(i);
+      std::vector<double> axis = imageIO->GetDirection(i);
+      for (unsigned int j = 0; j < std::min(Dimension, (unsigned int)axis.size()); ++j){
+        direction[j][i] = axis[j];
+      }
+    }
+    grid->SetRegions(size);
+    grid->SetSpacing(spacing);
+    grid->SetOrigin(origin);
+    grid->SetDirection(direction);
+    return true;
+  }
+
+  // Interpolators of the antsApplyTransforms --interpolation option resampled with the transform in memory.
+  // Others return nullptr and are resampled by antsApplyTransforms.
+  template <typename TImage, typename TReal>
+  typename itk::InterpolateImageFunction<TImage, TReal>::Pointer createInterpolator(const std::string& interpolation) {
+    if (interpolation == "Linear"){
+      return itk::LinearInterpolateImageFunction<TImage, TReal>::New().GetPointer();
+    } else if (interpolation == "NearestNeighbor"){
+      return itk::NearestNeighborInterpolateImageFunction<TImage, TReal>::New().GetPointer();
+    } else if (interpolation == "BSpline"){
+      auto interpolator = itk::BSplineInterpolateImageFunction<TImage, TReal, TReal>::New();
+      interpolator->SetSplineOrder(3);
+      return interpolator.GetPointer();
+    } else if (interpolation == "GenericLabel"){
+      return itk::LabelImageGenericInterpolateImageFunction<TImage, itk::LinearInterpolateImageFunction, TReal>::New().GetPointer();
+    }
+    return nullptr;
+  }
+
+  // Resample volumes on the reference grid with a transform read once for all of them.
+  // Label volumes (GenericLabel) are written with integer pixels.
+  template <typename TReal>
+  bool applyTransformToVolumes(const std::string& transformFile, const std::string& referenceVolume,
+                               const std::vector<std::string>& inputVolumes, const std::vector<std::string>& outputVolumes,
+                               const std::vector<std::string>& interpolations, bool useCompression) {
+    constexpr unsigned int Dimension = 3;
+    using ImageType = itk::Image<TReal, Dimension>;
+    using LabelImageType = itk::Image<int, Dimension>;
+
+    if (inputVolumes.size() != outputVolumes.size()){
+      std::cerr << "ERROR: " << inputVolumes.size() << " volumes to resample and " << outputVolumes.size() << " output volumes" << std::endl;
+      return false;
+    }
+    auto compositeTransform = readCompositeTransform<TReal>(transformFile);
+    auto grid = ImageType::New();
+    if (!compositeTransform || !readGrid(referenceVolume, grid.GetPointer())){
+      return false;
+    }
+    for (size_t i = 0; i < inputVolumes.size(); ++i){
+      std::cout << "<filter-progress>" << (double)i / inputVolumes.size() << "</filter-progress>" << std::endl << std::flush;
+      const std::string interpolation = (i < interpolations.size() && !interpolations[i].empty()) ? interpolations[i] : "Linear";
+      auto interpolator = createInterpolator<ImageType, TReal>(interpolation);
+      if (!interpolator){
+        std::vector<std::string> commandArguments = {
+          "--dimensionality", "3", "--input", inputVolumes[i], "--reference-image", referenceVolume,
+          "--output", outputVolumes[i], "--interpolation", interpolation, "--transform", transformFile,
+          "--float", std::to_string((int)std::is_same<TReal, float>::value)};
+        if (ants::antsApplyTransforms(commandArguments, &std::cout) != 0){
+          return false;
+        }
+        continue;
+      }
+      auto reader = itk::ImageFileReader<ImageType>::New();
+      reader->SetFileName(inputVolumes[i]);
+      auto resampler = itk::ResampleImageFilter<ImageType, ImageType, TReal>::New();
+      resampler->SetInput(reader->GetOutput());
+      resampler->SetTransform(compositeTransform);
+      resampler->SetInterpolator(interpolator);
+      resampler->SetOutputParametersFromImage(grid);
+      resampler->SetDefaultPixelValue(0);
+      if (interpolation == "GenericLabel"){
+        auto caster = itk::CastImageFilter<ImageType, LabelImageType>::New();
+        caster->SetInput(resampler->GetOutput());
+        auto writer = itk::ImageFileWriter<LabelImageType>::New();
+        writer->SetInput(caster->GetOutput());
+        writer->SetFileName(outputVolumes[i]);
+        writer->SetUseCompression(useCompression);
+        writer->Update();
+      } else {
+        auto writer = itk::ImageFileWriter<ImageType>::New();
+        writer->SetInput(resampler->GetOutput());
+        writer->SetFileName(outputVolumes[i]);
+        writer->SetUseCompression(useCompression);
+        writer->Update();
+      }
+    }
+    return true;
+  }
+
+  // Read the apply volumes listed one per line as tab separated input file, output file and interpolation.
+  bool readApplyVolumeList(const std::string& applyVolumeList, std::vector<std::string>& inputVolumes,
+                           std::vector<std::string>& outputVolumes, std::vector<std::string>& interpolations) {
+    std::ifstream applyVolumeListStream(applyVolumeList);
+    if (!applyVolumeListStream){
+      std::cout << "ERROR: unable to read " << applyVolumeList << std::endl;
+      return false;
+    }
+    std::string line;
+    while (std::getline(applyVolumeListStream, line)){
+      if (!line.empty() && line.back() == '\r'){
+        line.pop_back();
+      }
+      if (line.empty()){
+        continue;
+      }
+      size_t outputStart = line.find('\t');
+      if (outputStart == std::string::npos){
+        std::cout << "ERROR: no output volume for " << line << " in " << applyVolumeList << std::endl;
+        return false;
+      }
+      size_t interpolationStart = line.find('\t', outputStart + 1);
+      inputVolumes.push_back(line.substr(0, outputStart));
+      if (interpolationStart == std::string::npos){
+        outputVolumes.push_back(line.substr(outputStart + 1));
+        interpolations.push_back("");
+      } else {
+        outputVolumes.push_back(line.substr(outputStart + 1, interpolationStart - outputStart - 1));
+        interpolations.push_back(line.substr(interpolationStart + 1));
+      }
+    }
+    return true;
+  }
+
+  // Resample the apply volumes, reporting the elapsed time. Returns 0 on success as the ANTs commands do.
+  int runApplyTransforms(const std::string& transformFile, const std::string& referenceVolume,
+                         const std::vector<std::string>& inputVolumes, const std::vector<std::string>& outputVolumes,
+                         const std::vector<std::string>& interpolations, bool useFloat, bool useCompression) {
+    std::chrono::steady_clock::time_point startTime = std::chrono::steady_clock::now();
+    std::cout << "<filter-comment>" << "Apply Transforms " << "</filter-comment>" << std::endl << std::flush;
+    bool applied = false;
+    try {
+      applied = useFloat ? applyTransformToVolumes<float>(transformFile, referenceVolume, inputVolumes, outputVolumes, interpolations, useCompression)
+                         : applyTransformToVolumes<double>(transformFile, referenceVolume, inputVolumes, outputVolumes, interpolations, useCompression);
+    } catch (itk::ExceptionObject& e) {
+      std::cerr << "ERROR: " << e << std::endl;
+    }
+    std::cout << "Elapsed time (apply transforms): "
+              << std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime).count() << std::endl;
+    return applied ? 0 : 1;
+  }
+
+  // Replace every $name of the command in one pass. Unknown names are left untouched.
+  std::string replacePlaceholders(const std::string& command, const std::map<std::string, std::string>& placeholders) {
+    std::string result;
+    result.reserve(command.size());
+    size_t position = 0;
+    while (position < command.size()){
+      size_t dollar = command.find('$', position);
+      if (dollar == std::string::npos){
+        result.append(command, position, std::string::npos);
+        break;
+      }
+      result.append(command, position, dollar - position);
+      size_t end = dollar + 1;
+      while (end < command.size() && (std::isalnum((unsigned char)command[end]) || command[end] == '_')){
+        ++end;
+      }
+      std::map<std::string, std::string>::const_iterator placeholder = placeholders.find(command.substr(dollar + 1, end - dollar - 1));
+      if (placeholder != placeholders.end()){
+        result.append(placeholder->second);
+      } else {
+        result.append(command, dollar, end - dollar);
+      }
+      position = end;
+    }
+    return result;
+  }
+
   void replaceAll(std::string& str, const std::string& from, const std::string& to) {
     if(from.empty())
         return;
@@ -24,49 +384,123 @@ int main( int argc, char * argv[] )
 {
   PARSE_ARGS;
 
+  ProcessStateGuard processStateGuard;
+
+  if (numberOfThreads > 0){
+    itk::MultiThreaderBase::SetGlobalMaximumNumberOfThreads(numberOfThreads);
+    itk::MultiThreaderBase::SetGlobalDefaultNumberOfThreads(numberOfThreads);
+  }
+
+  // polled by the iteration observers of the patched ANTs
+  setControlFile(controlFile);
+  // written by the patched ANTs at the start of every stage
+  setCheckpointDirectory(checkpointDirectory);
+  setWriteCompression(compressOutputs ? "1" : "0");
+
+  std::vector<std::string> applyInputVolumes, applyOutputVolumes, applyInterpolations;
+  if (!applyVolumeList.empty() && !readApplyVolumeList(applyVolumeList, applyInputVolumes, applyOutputVolumes, applyInterpolations)){
+    return EXIT_FAILURE;
+  }
+  bool useApplyVolumes = !applyInputVolumes.empty();
+  if (antsCommand.empty()){
+    // apply only, no registration
+    if (!useApplyVolumes || applyTransformFile.empty() || applyReferenceVolume.empty()){
+      std::cout << "ERROR: specify the volumes, transform file and reference volume to apply." << std::endl;
+      return EXIT_FAILURE;
+    }
+    int applyFailed = runApplyTransforms(applyTransformFile, applyReferenceVolume, applyInputVolumes, applyOutputVolumes,
+                                         applyInterpolations, useFloat, compressOutputs);
+    std::cout << "Peak resident memory (MB): " << getPeakResidentMemoryMB() << std::endl;
+    return applyFailed ? EXIT_FAILURE : EXIT_SUCCESS;
+  }
+
   bool useCompositeTransform = !outputCompositeTransform.empty();
   bool useDisplacementField = !outputDisplacementField.empty();
   bool useOutputVolume = !outputVolume.empty();
+  bool useInverseCompositeTransform = !outputInverseCompositeTransform.empty();
+  bool useInverseVolume = !outputInverseVolume.empty();
+  // the output volume is resampled from the native moving volume after the registration
+  bool useNativeResampling = useOutputVolume && !nativeMovingVolume.empty();
+  // written by the patched ANTs from the transform in memory, otherwise computed from the composite transform file
+  bool useDirectDisplacementField = useDisplacementField && displacementFieldMethod == "direct";
 
-  if (!useCompositeTransform && !useDisplacementField && !useOutputVolume){
+  if (!useCompositeTransform && !useDisplacementField && !useOutputVolume && !useInverseCompositeTransform && !useInverseVolume && !useApplyVolumes){
     std::cout << "ERROR: specify an output." << std::endl;
     return EXIT_FAILURE;
-  } else if (!useCompositeTransform && !useDisplacementField){
-    outputCompositeTransform = outputVolume;
-    replaceAll(outputCompositeTransform, ".nrrd", "Composite.h5");
-  } else if (!useCompositeTransform && useDisplacementField){
-    outputCompositeTransform = outputDisplacementField;
-    replaceAll(outputCompositeTransform, ".nrrd", "Composite.h5");
+  } else if (!useCompositeTransform){
+    outputCompositeTransform = getTemporaryOutputBase() + "Composite.h5";
   }
   std::string outputBase = outputCompositeTransform;
   replaceAll(outputBase, "Composite.h5", "");
+  std::string inverseCompositeTransform = outputBase + "InverseComposite.h5";
+  // the warped volume is an antsRegistration output preceding the inverse warped one
+  std::string unusedVolume = outputBase + "Unused.nrrd";
+
+  // only the requested transform files are written
+  std::vector<std::string> skippedOutputFiles;
+  if (!useCompositeTransform && (!useDisplacementField || useDirectDisplacementField) && !useNativeResampling && !useApplyVolumes){
+    skippedOutputFiles.push_back(outputCompositeTransform);
+  }
+  if (!useInverseCompositeTransform){
+    skippedOutputFiles.push_back(inverseCompositeTransform);
+  }
+  setSkippedOutputFiles(skippedOutputFiles);
 
-  replaceAll(antsCommand, "$outputBase", outputBase);
-  replaceAll(antsCommand, "$inputTransform", inputTransform);
-  replaceAll(antsCommand, "$outputVolume", outputVolume);
-  replaceAll(antsCommand, "$useFloat", std::to_string((int)useFloat));
-
-  if (!inputVolume01.empty()){replaceAll(antsCommand, "$inputVolume01", inputVolume01);}
-  if (!inputVolume02.empty()){replaceAll(antsCommand, "$inputVolume02", inputVolume02);}
-  if (!inputVolume03.empty()){replaceAll(antsCommand, "$inputVolume03", inputVolume03);}
-  if (!inputVolume04.empty()){replaceAll(antsCommand, "$inputVolume04", inputVolume04);}
-  if (!inputVolume05.empty()){replaceAll(antsCommand, "$inputVolume05", inputVolume05);}
-  if (!inputVolume06.empty()){replaceAll(antsCommand, "$inputVolume06", inputVolume06);}
-  if (!inputVolume06.empty()){replaceAll(antsCommand, "$inputVolume06", inputVolume06);}
-  if (!inputVolume07.empty()){replaceAll(antsCommand, "$inputVolume07", inputVolume07);}
-  if (!inputVolume08.empty()){replaceAll(antsCommand, "$inputVolume08", inputVolume08);}
-  if (!inputVolume09.empty()){replaceAll(antsCommand, "$inputVolume09", inputVolume09);}
-  if (!inputVolume10.empty()){replaceAll(antsCommand, "$inputVolume10", inputVolume10);}
-  if (!inputVolume11.empty()){replaceAll(antsCommand, "$inputVolume11", inputVolume11);}
-  if (!inputVolume12.empty()){replaceAll(antsCommand, "$inputVolume12", inputVolume12);}
-  if (!inputVolume13.empty()){replaceAll(antsCommand, "$inputVolume13", inputVolume13);}
-  if (!inputVolume14.empty()){replaceAll(antsCommand, "$inputVolume14", inputVolume14);}
-  if (!inputVolume15.empty()){replaceAll(antsCommand, "$inputVolume15", inputVolume15);}
-  if (!inputVolume16.empty()){replaceAll(antsCommand, "$inputVolume16", inputVolume16);}
-  if (!inputVolume17.empty()){replaceAll(antsCommand, "$inputVolume17", inputVolume17);}
-  if (!inputVolume18.empty()){replaceAll(antsCommand, "$inputVolume18", inputVolume18);}
-  if (!inputVolume19.empty()){replaceAll(antsCommand, "$inputVolume19", inputVolume19);}
-  if (!inputVolume20.empty()){replaceAll(antsCommand, "$inputVolume20", inputVolume20);}
+  std::map<std::string, std::string> placeholders;
+  placeholders["outputBase"] = outputBase;
+  placeholders["inputTransform"] = inputTransform;
+  placeholders["initialTransformFile"] = initialTransformFile;
+  placeholders["outputVolume"] = outputVolume;
+  placeholders["outputInverseVolume"] = outputInverseVolume;
+  placeholders["unusedVolume"] = unusedVolume;
+  placeholders["useFloat"] = std::to_string((int)useFloat);
+
+  const std::string* inputVolumes[] = {
+    &inputVolume01, &inputVolume02, &inputVolume03, &inputVolume04, &inputVolume05,
+    &inputVolume06, &inputVolume07, &inputVolume08, &inputVolume09, &inputVolume10,
+    &inputVolume11, &inputVolume12, &inputVolume13, &inputVolume14, &inputVolume15,
+    &inputVolume16, &inputVolume17, &inputVolume18, &inputVolume19, &inputVolume20};
+  for (size_t i = 0; i < sizeof(inputVolumes) / sizeof(inputVolumes[0]); ++i){
+    if (!inputVolumes[i]->empty()){
+      char name[16];
+      snprintf(name, sizeof(name), "inputVolume%02d", (int)(i + 1));
+      placeholders[name] = *inputVolumes[i];
+    }
+  }
+  // inputs beyond the declared volumes are passed as files, listed one per line
+  std::vector<std::string> inputVolumeFiles;
+  if (!inputVolumeList.empty()){
+    std::ifstream inputVolumeListStream(inputVolumeList);
+    if (!inputVolumeListStream){
+      std::cout << "ERROR: unable to read " << inputVolumeList << std::endl;
+      return EXIT_FAILURE;
+    }
+    std::string line;
+    while (std::getline(inputVolumeListStream, line)){
+      if (!line.empty() && line.back() == '\r'){
+        line.pop_back();
+      }
+      if (!line.empty()){
+        inputVolumeFiles.push_back(line);
+      }
+    }
+  }
+  for (size_t i = 0; i < inputVolumeFiles.size(); ++i){
+    placeholders["inputFile" + std::to_string(i + 1)] = inputVolumeFiles[i];
+  }
+
+  antsCommand = replacePlaceholders(antsCommand, placeholders);
+
+  std::string referenceVolume = nativeReferenceVolume.empty() ? inputVolume01 : nativeReferenceVolume;
+  if (referenceVolume.empty() && !inputVolumeFiles.empty()){
+    referenceVolume = inputVolumeFiles[0];
+  }
+
+  if (useDirectDisplacementField){
+    // not left over from a previous run, its presence tells that it was written
+    std::remove(outputDisplacementField.c_str());
+    setDisplacementFieldOutput(outputDisplacementField, referenceVolume);
+  }
 
   std::vector<std::string> commandArguments;
   std::stringstream ss(antsCommand);
@@ -77,7 +511,11 @@ int main( int argc, char * argv[] )
 
   int antsFailed = ants::antsRegistration(commandArguments, &std::cout);
 
-  if (antsFailed==0 && useDisplacementField){
+  if (antsFailed==0 && useDirectDisplacementField && !std::filesystem::exists(outputDisplacementField)){
+    std::cerr << "ERROR: the displacement field was not written" << std::endl;
+    antsFailed = 1;
+  } else if (antsFailed==0 && useDisplacementField && !useDirectDisplacementField){
+    std::chrono::steady_clock::time_point startTime = std::chrono::steady_clock::now();
     std::cout << "<filter-comment>" << "ANTs Apply Transforms " << "</filter-comment>" << std::endl << std::flush;
     std::cout << "<filter-progress>" << 0.99 << "</filter-progress>" << std::endl << std::flush;
     std::cout << "<filter-stage-progress>" << 1.0 << "</filter-stage-progress>" << std::endl << std::flush;
@@ -85,7 +523,7 @@ int main( int argc, char * argv[] )
     commandArguments.push_back("--transform");
     commandArguments.push_back(outputCompositeTransform);
     commandArguments.push_back("--reference-image");
-    commandArguments.push_back(inputVolume01);
+    commandArguments.push_back(referenceVolume);
     commandArguments.push_back("--output");
     commandArguments.push_back("[" + outputDisplacementField + ",1]");
     commandArguments.push_back("--float");
@@ -93,13 +531,55 @@ int main( int argc, char * argv[] )
     commandArguments.push_back("--verbose");
     commandArguments.push_back("1");
     antsFailed = ants::antsApplyTransforms(commandArguments, &std::cout);
+    std::cout << "Elapsed time (displacement field): "
+              << std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime).count() << std::endl;
+  }
+
+  if (antsFailed==0 && useNativeResampling){
+    std::chrono::steady_clock::time_point startTime = std::chrono::steady_clock::now();
+    std::cout << "<filter-comment>" << "Native Resolution Output " << "</filter-comment>" << std::endl << std::flush;
+    commandArguments.clear();
+    commandArguments.push_back("--dimensionality");
+    commandArguments.push_back("3");
+    commandArguments.push_back("--input");
+    commandArguments.push_back(nativeMovingVolume);
+    commandArguments.push_back("--reference-image");
+    commandArguments.push_back(referenceVolume);
+    commandArguments.push_back("--output");
+    commandArguments.push_back(outputVolume);
+    commandArguments.push_back("--interpolation");
+    commandArguments.push_back(outputInterpolation);
+    commandArguments.push_back("--transform");
+    commandArguments.push_back(outputCompositeTransform);
+    commandArguments.push_back("--float");
+    commandArguments.push_back(std::to_string((int)useFloat));
+    antsFailed = ants::antsApplyTransforms(commandArguments, &std::cout);
+    std::cout << "Elapsed time (native resolution output): "
+              << std::chrono::duration<double>(std::chrono::steady_clock::now() - startTime).count() << std::endl;
+  }
+
+  if (antsFailed==0 && useApplyVolumes){
+    antsFailed = runApplyTransforms(outputCompositeTransform, referenceVolume, applyInputVolumes, applyOutputVolumes,
+                                    applyInterpolations, useFloat, compressOutputs);
   }
 
   if (!useCompositeTransform){
     std::remove(outputCompositeTransform.c_str());
   }
 
-  std::remove(outputBase.append("InverseComposite.h5").c_str());
+  if (useInverseCompositeTransform){
+    if (antsFailed==0 && inverseCompositeTransform != outputInverseCompositeTransform && !moveFile(inverseCompositeTransform, outputInverseCompositeTransform)){
+      antsFailed = 1;
+    }
+  } else {
+    // not written by the patched ANTs, removed in case it was
+    std::remove(inverseCompositeTransform.c_str());
+  }
+  if (useInverseVolume && !useOutputVolume){
+    std::remove(unusedVolume.c_str());
+  }
+
+  std::cout << "Peak resident memory (MB): " << getPeakResidentMemoryMB() << std::endl;
 
   if (antsFailed){
      return EXIT_FAILURE;